@@ -171,6 +171,11 @@ def parse_arguments():
         help="destination where dbGaP whitelist files are saved",
         default=None,
     )
+    dbgap_sync.add_argument(
+        "--full-rebuild",
+        action="store_true",
+        help="sync the access of all the users, even if USERSYNC.incremental_sync is enabled",
+    )
 
     dbgap_download = subparsers.add_parser("dbgap-download-access-files")
     dbgap_download.add_argument(
@@ -472,6 +477,7 @@ def main():
             arborist=arborist,
             sync_from_visas=sync_from_visas,
             fallback_to_dbgap_sftp=fallback_to_dbgap_sftp,
+            full_rebuild=args.full_rebuild,
         )
     elif args.action == "dbgap-download-access-files":
         download_dbgap_files(
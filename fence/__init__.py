@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import flask
 from flask_cors import CORS
 from flask_sqlalchemy_session import flask_scoped_session, current_session
@@ -15,13 +16,20 @@ from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from fence.auth import logout, build_redirect_url
 from fence.blueprints.data.indexd import S3IndexedFileLocation
 from fence.blueprints.login.utils import allowed_login_redirects, domain
+from fence.cache import make_cache
 from fence.errors import UserError
+from fence.http_client import pool_arborist_connections
 from fence.jwt import keys
 from fence.models import migrate
 from fence.oidc.client import query_client
 from fence.oidc.server import server
 from fence.resources.audit.client import AuditServiceClient
 from fence.resources.aws.boto_manager import BotoManager
+from fence.resources.aws.bucket_regions import (
+    S3_BUCKET_NAME_REGEX,
+    S3BucketRegions,
+)
+from fence.resources.aws.s3_buckets import get_s3_bucket_index
 from fence.resources.openid.cilogon_oauth2 import CilogonOauth2Client as CilogonClient
 from fence.resources.openid.cognito_oauth2 import CognitoOauth2Client as CognitoClient
 from fence.resources.openid.google_oauth2 import GoogleOauth2Client as GoogleClient
@@ -88,6 +96,7 @@ def app_init(
         file_name=config_file_name,
     )
     app_sessions(app)
+    _warm_up_s3_bucket_regions(app)
     app_register_blueprints(app)
     server.init_app(app, query_client=query_client)
 
@@ -187,7 +196,7 @@ def app_register_blueprints(app):
 def _check_aws_creds_and_region(app):
     """
     Function to ensure that all s3_buckets have a valid credential.
-    Additionally, if there is no region it will produce a warning then try to fetch and cache the region.
+    Additionally, if there is no region it will produce a warning.
     """
     buckets = config.get("S3_BUCKETS") or {}
     aws_creds = config.get("AWS_CREDENTIALS") or {}
@@ -213,7 +222,8 @@ def _check_aws_creds_and_region(app):
             )
 
         # only require region when we're not specifying an
-        # s3-compatible endpoint URL (ex: no need for region when using cleversafe)
+        # s3-compatible endpoint URL (ex: no need for region when using cleversafe).
+        # the missing regions are fetched by `_warm_up_s3_bucket_regions`
         if not region and not bucket_details.get("endpoint_url"):
             logger.warning(
                 "WARNING: no region for S3_BUCKET: {}. Providing the region will reduce"
@@ -221,22 +231,6 @@ def _check_aws_creds_and_region(app):
                     bucket_name
                 )
             )
-            credential = S3IndexedFileLocation.get_credential_to_access_bucket(
-                bucket_name,
-                aws_creds,
-                config.get("MAX_PRESIGNED_URL_TTL", 3600),
-                app.boto,
-            )
-            if not getattr(app, "boto"):
-                logger.warning(
-                    "WARNING: boto not setup for app, probably b/c "
-                    "nothing in AWS_CREDENTIALS. Cannot attempt to get bucket "
-                    "bucket regions."
-                )
-                return
-
-            region = app.boto.get_bucket_region(bucket_name, credential)
-            config["S3_BUCKETS"][bucket_name]["region"] = region
 
     cred = config["PUSH_AUDIT_LOGS_CONFIG"].get("aws_sqs_config", {}).get("aws_cred")
     if cred and cred not in aws_creds:
@@ -279,6 +273,8 @@ def app_config(
     _setup_arborist_client(app)
     _setup_audit_service_client(app)
     _setup_data_endpoint_and_boto(app)
+    _setup_indexd_record_cache(app)
+    _setup_s3_bucket_regions(app)
     _load_keys(app, root_dir)
     _set_authlib_cfgs(app)
 
@@ -300,14 +296,100 @@ def app_config(
     with app.app_context():
         _check_aws_creds_and_region(app)
 
+    if app.config.get("S3_BUCKETS"):
+        # built now rather than on the first signed URL request
+        get_s3_bucket_index(app.config["S3_BUCKETS"])
+
 
 def _setup_data_endpoint_and_boto(app):
     if "AWS_CREDENTIALS" in config and len(config["AWS_CREDENTIALS"]) > 0:
         value = list(config["AWS_CREDENTIALS"].values())[0]
-        app.boto = BotoManager(value, logger=logger)
+        app.boto = BotoManager(
+            value,
+            logger=logger,
+            client_cache_settings=config.get("BOTO_CLIENT_CACHE"),
+        )
         app.register_blueprint(fence.blueprints.data.blueprint, url_prefix="/data")
 
 
+def _setup_indexd_record_cache(app):
+    cache_config = config["INDEXD_RECORD_CACHE"] or {}
+    if cache_config.get("enabled"):
+        logger.info("Enabling indexd record cache")
+        app.indexd_record_cache = make_cache(cache_config, prefix="fence:indexd")
+    else:
+        app.indexd_record_cache = None
+
+
+def _setup_s3_bucket_regions(app):
+    cache_config = config["S3_BUCKET_REGION_CACHE"] or {}
+    app.s3_bucket_regions = S3BucketRegions(
+        max_size=cache_config.get("max_size", 10000),
+        ttl=cache_config.get("ttl", 86400),
+    )
+
+
+def _warm_up_s3_bucket_regions(app):
+    """
+    Fetch in parallel the regions of the buckets in `S3_BUCKETS` that have no
+    `region` nor `endpoint_url`, so they are cached before the first request.
+    A failure is logged: the region will be fetched again when needed.
+    """
+    if not getattr(app, "boto", None):
+        return
+
+    aws_creds = config.get("AWS_CREDENTIALS") or {}
+    bucket_names = []
+    for bucket_name, bucket_details in (config.get("S3_BUCKETS") or {}).items():
+        if (
+            bucket_details.get("cred") == "*"
+            or bucket_details.get("region")
+            or bucket_details.get("endpoint_url")
+        ):
+            continue
+        # keys of `S3_BUCKETS` can be patterns: the regions of the buckets
+        # they match are fetched on first use
+        if not S3_BUCKET_NAME_REGEX.match(bucket_name):
+            logger.info(
+                "Not fetching the region of S3_BUCKET: {}, which is not a bucket name".format(
+                    bucket_name
+                )
+            )
+            continue
+        bucket_names.append(bucket_name)
+    if not bucket_names:
+        return
+
+    def warm_up(bucket_name):
+        with app.app_context():
+            credential = S3IndexedFileLocation.get_credential_to_access_bucket(
+                bucket_name,
+                aws_creds,
+                config.get("MAX_PRESIGNED_URL_TTL", 3600),
+                app.boto,
+            )
+            return app.s3_bucket_regions.get_region(
+                bucket_name, credential, app.boto, db=getattr(app, "db", None)
+            )
+
+    max_workers = (config["S3_BUCKET_REGION_CACHE"] or {}).get("warm_up_workers", 10)
+    logger.info("Fetching the regions of {} S3 buckets...".format(len(bucket_names)))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(warm_up, bucket_name): bucket_name
+            for bucket_name in bucket_names
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(
+                    "Unable to get the region of S3_BUCKET {}: {}".format(
+                        futures[future], e
+                    )
+                )
+
+
 def _load_keys(app, root_dir):
     if root_dir is None:
         root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -409,7 +491,9 @@ def _setup_oidc_clients(app):
 
 def _setup_arborist_client(app):
     if app.config.get("ARBORIST"):
-        app.arborist = ArboristClient(arborist_base_url=config["ARBORIST"])
+        app.arborist = pool_arborist_connections(
+            ArboristClient(arborist_base_url=config["ARBORIST"])
+        )
 
 
 def _setup_audit_service_client(app):
@@ -431,7 +515,13 @@ def _setup_prometheus(app):
     # More details on this awkwardness: https://github.com/prometheus/client_python/issues/250
     os.environ["prometheus_multiproc_dir"] = PROMETHEUS_TMP_COUNTER_DIR.name
 
-    from prometheus_client import CollectorRegistry, multiprocess, make_wsgi_app
+    from prometheus_client import (
+        CollectorRegistry,
+        Gauge,
+        Histogram,
+        multiprocess,
+        make_wsgi_app,
+    )
     from prometheus_flask_exporter import Counter
     from prometheus_flask_exporter.multiprocess import UWsgiPrometheusMetrics
 
@@ -451,6 +541,50 @@ def _setup_prometheus(app):
         "tracking presigned url requests",
         ["requested_protocol"],
     )
+    app.prometheus_counters["indexd_record_cache"] = Counter(
+        "indexd_record_cache",
+        "tracking indexd record cache hits and misses",
+        ["result"],
+    )
+    app.prometheus_counters["verified_token_cache"] = Counter(
+        "verified_token_cache",
+        "tracking verified token cache hits (token signature verifications avoided) and misses",
+        ["result"],
+    )
+    app.prometheus_counters["api_key_access_token_cache"] = Counter(
+        "api_key_access_token_cache",
+        "tracking API key access token cache hits (access tokens reused) and misses",
+        ["result"],
+    )
+    app.prometheus_counters["google_signing_key_cache"] = Counter(
+        "google_signing_key_cache",
+        "tracking Google signing key cache hits (service account key reads and creations avoided) and misses",
+        ["result"],
+    )
+    app.prometheus_counters["verified_client_secret_cache"] = Counter(
+        "verified_client_secret_cache",
+        "tracking verified client secret cache hits (client secret hashes avoided) and misses",
+        ["result"],
+    )
+    app.prometheus_counters["outbound_http_request_duration"] = Histogram(
+        "outbound_http_request_duration_seconds",
+        "latency of the requests made to upstream services (indexd, arborist...)",
+        ["upstream", "method"],
+    )
+    app.prometheus_counters["audit_log_queue_depth"] = Gauge(
+        "audit_log_queue_depth",
+        "number of audit logs waiting to be shipped",
+        multiprocess_mode="livesum",
+    )
+    app.prometheus_counters["audit_log_dropped"] = Counter(
+        "audit_log_dropped",
+        "tracking audit logs that could not be shipped",
+        ["reason"],
+    )
+    app.prometheus_counters["audit_log_flush_duration"] = Histogram(
+        "audit_log_flush_duration_seconds",
+        "time taken to ship a batch of audit logs",
+    )
 
 
 @app.errorhandler(Exception)
@@ -4,16 +4,11 @@ from functools import wraps
 import urllib.request, urllib.parse, urllib.error
 
 from authutils.errors import JWTError, JWTExpiredError
-from authutils.token.validate import (
-    current_token,
-    require_auth_header,
-    set_current_token,
-    validate_request,
-)
+from authutils.token.validate import current_token, set_current_token
 from cdislogging import get_logger
 
 from fence.errors import Unauthorized, InternalError
-from fence.jwt.validate import validate_jwt
+from fence.jwt.validate import require_auth_header, validate_jwt, validate_request
 from fence.models import User, IdentityProvider, query_for_user
 from fence.user import get_current_user
 from fence.utils import clear_cookies
@@ -8,7 +8,9 @@ from fence.blueprints.data.indexd import (
     BlankIndex,
     IndexedFile,
     get_signed_url_for_file,
+    get_signed_urls_for_files,
 )
+from fence.config import config
 from fence.errors import Forbidden, InternalError, UserError, Forbidden
 from fence.resources.audit.utils import enable_audit_logging
 from fence.utils import get_valid_expiration
@@ -302,3 +304,61 @@ def download_file(file_id):
     if not "redirect" in flask.request.args or not "url" in result:
         return flask.jsonify(result)
     return flask.redirect(result["url"])
+
+
+@blueprint.route("/download", methods=["POST"])
+@enable_audit_logging
+def download_files():
+    """
+    Get presigned urls to download many files at once.
+
+    The body is a JSON object with a `guids` list; each item is either a GUID
+    or an object with a `guid` and an optional `protocol`. The optional
+    `protocol`, `expires_in`, `no_force_sign` and `userProject` fields apply to
+    every file (a per-item `protocol` takes precedence).
+
+    Errors are reported per file, so the response is a 200 with a `results`
+    list matching the order of the requested GUIDs.
+    """
+    params = flask.request.get_json()
+    if not params:
+        raise UserError("wrong Content-Type; expected application/json")
+
+    guids = params.get("guids")
+    if not guids or not isinstance(guids, list):
+        raise UserError("missing required argument `guids` (list)")
+
+    max_guids = config["MAX_BULK_PRESIGNED_URL_REQUEST_SIZE"]
+    if len(guids) > max_guids:
+        raise UserError(
+            "cannot request more than {} presigned URLs at once".format(max_guids)
+        )
+
+    default_protocol = params.get("protocol")
+    requested_files = []
+    for item in guids:
+        if isinstance(item, str):
+            item = {"guid": item}
+        if not isinstance(item, dict) or not isinstance(item.get("guid"), str):
+            raise UserError(
+                "items in `guids` must be GUIDs or objects with a `guid` field"
+            )
+        requested_files.append(
+            {"guid": item["guid"], "protocol": item.get("protocol", default_protocol)}
+        )
+
+    default_expires_in = flask.current_app.config.get("MAX_PRESIGNED_URL_TTL", 3600)
+    expires_in = get_valid_expiration(
+        params.get("expires_in"),
+        max_limit=default_expires_in,
+        default=default_expires_in,
+    )
+
+    results = get_signed_urls_for_files(
+        "download",
+        requested_files,
+        expires_in=expires_in,
+        force_signed_url=str(params.get("no_force_sign", "")).lower() != "true",
+        r_pays_project=params.get("userProject"),
+    )
+    return flask.jsonify({"results": results})
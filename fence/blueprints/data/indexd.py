@@ -1,4 +1,5 @@
 import re
+import threading
 import time
 import json
 from urllib.parse import urlparse
@@ -8,9 +9,7 @@ import cirrus
 from cirrus import GoogleCloudManager
 from cdislogging import get_logger
 from cdispyutils.config import get_value
-from cdispyutils.hmac4 import generate_aws_presigned_url
 import flask
-import requests
 
 from fence.auth import (
     get_jwt,
@@ -20,14 +19,19 @@ from fence.auth import (
     validate_request,
     JWTError,
 )
+from fence import http_client
+from fence.cache import MISSING, make_cache
 from fence.config import config
 from fence.errors import (
+    APIError,
     InternalError,
     NotFound,
     NotSupported,
     Unauthorized,
     UnavailableError,
 )
+from fence.resources.aws.presigner import generate_aws_presigned_url
+from fence.resources.aws.s3_buckets import get_s3_bucket_index
 from fence.resources.google.utils import (
     get_or_create_primary_service_account_key,
     create_primary_service_account_key,
@@ -98,6 +102,197 @@ def get_signed_url_for_file(action, file_id, file_name=None):
     return {"url": signed_url}
 
 
+def get_signed_urls_for_files(action, requested_files, **kwargs):
+    """
+    Bulk counterpart of `get_signed_url_for_file`: sign the locations for many
+    files at once, reusing the work that doesn't depend on the file.
+
+    The token is validated once, the records are fetched from indexd in a
+    single request, and Arborist is asked once per distinct `authz` list (its
+    response is a single boolean for all the requested resources, so the
+    records sharing an `authz` list share an Arborist call).
+
+    Args:
+        action (str): only "download" is supported
+        requested_files (List[dict]): dicts with a `guid` and an optional
+            `protocol`
+        kwargs: the options applied to every file: `expires_in`,
+            `force_signed_url`, `r_pays_project`
+
+    Return:
+        List[dict]: one result per requested file, in the same order. Each
+            result contains the `guid` and either the signed `url` or an
+            `error` with the `message` and HTTP status `code`.
+    """
+    if action != "download":
+        raise NotSupported("action {} is not supported in bulk".format(action))
+
+    expires_in = kwargs.get("expires_in")
+    force_signed_url = kwargs.get("force_signed_url", True)
+    r_pays_project = kwargs.get("r_pays_project")
+
+    user_info = _get_user_info()
+    flask.g.audit_data = {
+        "username": user_info["username"],
+        "sub": None if _is_anonymous_user(user_info) else int(user_info["user_id"]),
+    }
+    flask.g.bulk_audit_data = []
+
+    try:
+        token = get_jwt()
+    except Unauthorized:
+        # anonymous users may still have access to public data
+        token = None
+
+    index_documents = get_index_documents(
+        set(requested_file["guid"] for requested_file in requested_files)
+    )
+    authz_results = {}
+    counter = flask.current_app.prometheus_counters.get("pre_signed_url_req")
+
+    results = []
+    for requested_file in requested_files:
+        guid = requested_file["guid"]
+        protocol = requested_file.get("protocol")
+        audit_data = {"guid": guid, "protocol": protocol}
+        try:
+            indexed_file = IndexedFile(guid, index_document=index_documents.get(guid))
+            audit_data["resource_paths"] = indexed_file.index_document.get(
+                "authz", []
+            ) or indexed_file.index_document.get("acl", [])
+            if not protocol and indexed_file.indexed_file_locations:
+                audit_data["protocol"] = indexed_file.indexed_file_locations[0].protocol
+
+            authz = indexed_file.index_document.get("authz")
+            if authz:
+                authz_key = tuple(sorted(authz))
+                if authz_key not in authz_results:
+                    authz_results[authz_key] = flask.current_app.arborist.auth_request(
+                        jwt=token,
+                        service="fence",
+                        methods="read-storage",
+                        resources=authz,
+                    )
+                if not authz_results[authz_key]:
+                    raise Unauthorized(
+                        f"Either you weren't logged in or you don't have "
+                        f"read-storage permission on {authz} for fence"
+                    )
+                signed_url = indexed_file._get_signed_url(
+                    protocol,
+                    action,
+                    expires_in,
+                    force_signed_url,
+                    r_pays_project,
+                    None,
+                    user_info=user_info,
+                )
+            else:
+                # records without `authz` go through the ACL checks
+                signed_url = indexed_file.get_signed_url(
+                    protocol,
+                    action,
+                    expires_in,
+                    force_signed_url=force_signed_url,
+                    r_pays_project=r_pays_project,
+                    user_info=user_info,
+                )
+        except APIError as e:
+            logger.info("unable to sign URL for {}: {}".format(guid, e))
+            audit_data["status_code"] = e.code
+            results.append(
+                {"guid": guid, "error": {"message": e.message, "code": e.code}}
+            )
+        else:
+            audit_data["status_code"] = 200
+            results.append({"guid": guid, "url": signed_url})
+            if counter:
+                counter.labels(protocol).inc()
+        flask.g.bulk_audit_data.append(audit_data)
+
+    return results
+
+
+def get_index_documents(file_ids):
+    """
+    Get the records for the given GUIDs from indexd in a single request.
+
+    GUIDs indexd does not return are simply missing from the result; callers
+    can still look them up one by one (`IndexedFile.index_document` raises the
+    appropriate error if they really don't exist).
+
+    Args:
+        file_ids (Iterable[str]): GUIDs to look up
+
+    Return:
+        dict: GUID to indexd record
+    """
+    documents = {}
+    cache = getattr(flask.current_app, "indexd_record_cache", None)
+    if cache is not None:
+        missing_ids = []
+        for file_id in file_ids:
+            document = cache.get(file_id)
+            if document is MISSING:
+                _count_indexd_record_cache_request("miss")
+                missing_ids.append(file_id)
+            else:
+                _count_indexd_record_cache_request("hit")
+                # cached 404s are left out, the caller raises the error
+                if document is not None:
+                    documents[file_id] = document
+        file_ids = missing_ids
+
+    file_ids = list(file_ids)
+    if not file_ids:
+        return documents
+    indexd_server = config.get("INDEXD") or config["BASE_URL"] + "/index"
+    url = indexd_server.rstrip("/") + "/bulk/documents"
+    try:
+        res = http_client.indexd.post(url, json=file_ids)
+    except Exception as e:
+        logger.error("failed to reach indexd at {0}: {1}".format(url, e))
+        raise UnavailableError("Fail to reach id service to find data location")
+    if res.status_code != 200:
+        logger.error(
+            "indexd bulk lookup at {} failed ({}): {}".format(
+                url, res.status_code, res.text
+            )
+        )
+        raise UnavailableError(res.text)
+    for document in res.json():
+        if "urls" in document and "did" in document:
+            documents[document["did"]] = document
+            if cache is not None:
+                cache.set(document["did"], document)
+    return documents
+
+
+def _count_indexd_record_cache_request(result):
+    """
+    Increment the indexd record cache counter for gen3-metrics.
+
+    Args:
+        result (str): "hit" or "miss"
+    """
+    counter = flask.current_app.prometheus_counters.get("indexd_record_cache")
+    if counter:
+        counter.labels(result).inc()
+
+
+def _count_google_signing_key_cache_request(result):
+    """
+    Increment the Google signing key cache counter for gen3-metrics.
+
+    Args:
+        result (str): "hit", "db_hit" (no need to read or create the user's
+            service account key) or "miss"
+    """
+    counter = flask.current_app.prometheus_counters.get("google_signing_key_cache")
+    if counter:
+        counter.labels(result).inc()
+
+
 def prepare_presigned_url_audit_log(protocol, indexed_file):
     """
     Store in `flask.g.audit_data` the data needed to record an audit log.
@@ -173,7 +368,7 @@ class BlankIndex(object):
             auth = (config["INDEXD_USERNAME"], config["INDEXD_PASSWORD"])
             headers = {}
 
-        indexd_response = requests.post(
+        indexd_response = http_client.indexd.post(
             index_url, json=params, headers=headers, auth=auth
         )
         if indexd_response.status_code not in [200, 201]:
@@ -305,10 +500,16 @@ class IndexedFile(object):
 
     Args:
         file_id (str): GUID for the file.
+        index_document (Optional[dict]): the indexd record for the file, if it
+            was already fetched (for example in bulk); otherwise it is
+            retrieved from indexd when first needed.
     """
 
-    def __init__(self, file_id):
+    def __init__(self, file_id, index_document=None):
         self.file_id = file_id
+        if index_document is not None:
+            # pre-populate the `cached_property`
+            self.__dict__["index_document"] = index_document
 
     @cached_property
     def indexd_server(self):
@@ -320,10 +521,40 @@ class IndexedFile(object):
 
     @cached_property
     def index_document(self):
+        """
+        Get the record from indexd for this file, going through the indexd
+        record cache if it is enabled (see `INDEXD_RECORD_CACHE`). GUIDs not
+        found in indexd are cached too, for a shorter time.
+        """
+        cache = getattr(flask.current_app, "indexd_record_cache", None)
+        if cache is None:
+            return self._get_index_document()
+
+        document = cache.get(self.file_id)
+        if document is not MISSING:
+            _count_indexd_record_cache_request("hit")
+            if document is None:
+                raise NotFound(
+                    "No indexed document found with id {}".format(self.file_id)
+                )
+            return document
+
+        _count_indexd_record_cache_request("miss")
+        try:
+            document = self._get_index_document()
+        except NotFound:
+            cache.set(
+                self.file_id, None, ttl=config["INDEXD_RECORD_CACHE"]["not_found_ttl"]
+            )
+            raise
+        cache.set(self.file_id, document)
+        return document
+
+    def _get_index_document(self):
         indexd_server = config.get("INDEXD") or config["BASE_URL"] + "/index"
         url = indexd_server + "/index/"
         try:
-            res = requests.get(url + self.file_id)
+            res = http_client.indexd.get(url + self.file_id)
         except Exception as e:
             logger.error(
                 "failed to reach indexd at {0}: {1}".format(url + self.file_id, e)
@@ -367,6 +598,7 @@ class IndexedFile(object):
         force_signed_url=True,
         r_pays_project=None,
         file_name=None,
+        user_info=None,
     ):
         if self.index_document.get("authz"):
             action_to_permission = {
@@ -394,11 +626,24 @@ class IndexedFile(object):
         if action is not None and action not in SUPPORTED_ACTIONS:
             raise NotSupported("action {} is not supported".format(action))
         return self._get_signed_url(
-            protocol, action, expires_in, force_signed_url, r_pays_project, file_name
+            protocol,
+            action,
+            expires_in,
+            force_signed_url,
+            r_pays_project,
+            file_name,
+            user_info=user_info,
         )
 
     def _get_signed_url(
-        self, protocol, action, expires_in, force_signed_url, r_pays_project, file_name
+        self,
+        protocol,
+        action,
+        expires_in,
+        force_signed_url,
+        r_pays_project,
+        file_name,
+        user_info=None,
     ):
         if action == "upload":
             # NOTE: self.index_document ensures the GUID exists in indexd and raises
@@ -418,6 +663,7 @@ class IndexedFile(object):
                     public_data=self.public,
                     force_signed_url=force_signed_url,
                     r_pays_project=r_pays_project,
+                    user_info=user_info,
                 )
             except IndexError:
                 raise NotFound("Can't find any file locations.")
@@ -433,6 +679,7 @@ class IndexedFile(object):
                     public_data=self.public,
                     force_signed_url=force_signed_url,
                     r_pays_project=r_pays_project,
+                    user_info=user_info,
                 )
 
         raise NotFound(
@@ -557,11 +804,14 @@ class IndexedFile(object):
         path = "{}/index/{}".format(self.indexd_server, self.file_id)
         auth = (config["INDEXD_USERNAME"], config["INDEXD_PASSWORD"])
         params = {"rev": rev}
-        response = requests.delete(path, auth=auth, params=params)
+        response = http_client.indexd.delete(path, auth=auth, params=params)
         # it's possible that for some reason (something else modified the record in the
         # meantime) that the revision doesn't match, which would lead to error here
         if response.status_code != 200:
             return (flask.jsonify(response.json()), 500)
+        cache = getattr(flask.current_app, "indexd_record_cache", None)
+        if cache is not None:
+            cache.delete(self.file_id)
         return ("", 204)
 
 
@@ -601,15 +851,46 @@ class S3IndexedFileLocation(IndexedFileLocation):
     """
     An indexed file that lives in an AWS S3 bucket.
 
-    _assume_role_cache is used as an in mem cache for holding role credentials
+    _assume_role_cache is used as a cache for holding role credentials. It is
+    kept in memory, or shared between the workers in Redis (see the
+    `ASSUME_ROLE_SHARED_CACHE` configuration), and backed by the
+    `assume_role_cache` DB table.
     """
 
-    # expected structure { role_arn: (rv, expires_at) }
-    _assume_role_cache = {}
+    # expected structure { role_arn: {"credentials": rv, "expires_at": ts} }
+    # created on first use by `_get_assume_role_cache`
+    _assume_role_cache = None
+    # expected structure { role_arn: threading.Lock }
+    _assume_role_locks = {}
+    _assume_role_locks_lock = threading.Lock()
+
+    @classmethod
+    def _get_assume_role_cache(cls):
+        if cls._assume_role_cache is None:
+            cls._assume_role_cache = make_cache(
+                config["ASSUME_ROLE_SHARED_CACHE"],
+                prefix="fence:assume_role",
+                encryption_key=config["ENCRYPTION_KEY"],
+            )
+        return cls._assume_role_cache
+
+    @classmethod
+    def _get_assume_role_lock(cls, role_arn):
+        with cls._assume_role_locks_lock:
+            return cls._assume_role_locks.setdefault(role_arn, threading.Lock())
 
     @classmethod
     def assume_role(cls, bucket_cred, expires_in, aws_creds_config, boto=None):
         """
+        Return credentials for the role of the bucket, valid for at least
+        `expires_in` seconds.
+
+        Only one thread per process, and one process at a time when the DB is
+        available, calls AWS STS for a given role; the others wait and then
+        use the credentials it stored. Cached credentials that will soon be
+        too old are refreshed by a single request while the others keep using
+        them.
+
         Args:
             bucket_cred
             expires_in
@@ -622,29 +903,125 @@ class S3IndexedFileLocation(IndexedFileLocation):
             bucket_cred, "role-arn", InternalError("role-arn of that bucket is missing")
         )
         expiry = time.time() + expires_in
+        refresh_before_expiry = config["ASSUME_ROLE_SHARED_CACHE"][
+            "refresh_before_expiry"
+        ]
+
+        # try to retrieve from the in-memory or shared cache
+        cache = cls._get_assume_role_cache()
+        cached = cache.get(role_arn, None)
+        if cached and cached["expires_at"] > expiry:
+            if cached["expires_at"] > expiry + refresh_before_expiry:
+                return cached["credentials"]
+            # the credentials will soon be too old: refresh them now, unless
+            # another thread is already doing it
+            lock = cls._get_assume_role_lock(role_arn)
+            if not lock.acquire(blocking=False):
+                return cached["credentials"]
+            try:
+                return cls._refresh_assumed_role(
+                    role_arn,
+                    expiry + refresh_before_expiry,
+                    expires_in,
+                    aws_creds_config,
+                    boto,
+                )
+            except Exception as e:
+                logger.warning(
+                    "Unable to refresh the credentials for role {}, using the cached ones: {}".format(
+                        role_arn, e
+                    )
+                )
+                return cached["credentials"]
+            finally:
+                lock.release()
+
+        with cls._get_assume_role_lock(role_arn):
+            # another thread may have refreshed the credentials while we waited
+            cached = cache.get(role_arn, None)
+            if cached and cached["expires_at"] > expiry:
+                return cached["credentials"]
+            return cls._refresh_assumed_role(
+                role_arn, expiry, expires_in, aws_creds_config, boto
+            )
 
-        # try to retrieve from local in-memory cache
-        rv, expires_at = cls._assume_role_cache.get(role_arn, (None, 0))
-        if expires_at > expiry:
-            return rv
+    @classmethod
+    def _refresh_assumed_role(
+        cls, role_arn, min_expires_at, expires_in, aws_creds_config, boto=None
+    ):
+        """
+        Get credentials that expire after `min_expires_at` from the database
+        cache, or else from AWS STS, and store them in the caches.
 
-        # try to retrieve from database cache
-        if hasattr(flask.current_app, "db"):  # we don't have db in startup
+        While checking the database and calling STS, a database lock on the
+        role ARN is held, so the other workers wait for these credentials
+        instead of calling STS too.
+        """
+        if not hasattr(flask.current_app, "db"):  # we don't have db in startup
+            rv, expires_at = cls._assume_role_from_sts(
+                role_arn, expires_in, aws_creds_config, boto
+            )
+        else:
             with flask.current_app.db.session as session:
-                cache = (
+                # released at the end of the transaction
+                session.execute(
+                    "SELECT pg_advisory_xact_lock(hashtext(:arn))", dict(arn=role_arn)
+                )
+                db_cache = (
                     session.query(AssumeRoleCacheAWS)
                     .filter(AssumeRoleCacheAWS.arn == role_arn)
                     .first()
                 )
-                if cache and cache.expires_at and cache.expires_at > expiry:
+                if (
+                    db_cache
+                    and db_cache.expires_at
+                    and db_cache.expires_at > min_expires_at
+                ):
                     rv = dict(
-                        aws_access_key_id=cache.aws_access_key_id,
-                        aws_secret_access_key=cache.aws_secret_access_key,
-                        aws_session_token=cache.aws_session_token,
+                        aws_access_key_id=db_cache.aws_access_key_id,
+                        aws_secret_access_key=db_cache.aws_secret_access_key,
+                        aws_session_token=db_cache.aws_session_token,
+                    )
+                    expires_at = db_cache.expires_at
+                else:
+                    rv, expires_at = cls._assume_role_from_sts(
+                        role_arn, expires_in, aws_creds_config, boto
+                    )
+                    session.execute(
+                        """\
+                        INSERT INTO assume_role_cache (
+                            arn,
+                            expires_at,
+                            aws_access_key_id,
+                            aws_secret_access_key,
+                            aws_session_token
+                        ) VALUES (
+                            :arn,
+                            :expires_at,
+                            :aws_access_key_id,
+                            :aws_secret_access_key,
+                            :aws_session_token
+                        ) ON CONFLICT (arn) DO UPDATE SET
+                            expires_at = EXCLUDED.expires_at,
+                            aws_access_key_id = EXCLUDED.aws_access_key_id,
+                            aws_secret_access_key = EXCLUDED.aws_secret_access_key,
+                            aws_session_token = EXCLUDED.aws_session_token;""",
+                        dict(arn=role_arn, expires_at=expires_at, **rv),
                     )
-                    cls._assume_role_cache[role_arn] = rv, cache.expires_at
-                    return rv
 
+        cls._get_assume_role_cache().set(
+            role_arn,
+            {"credentials": rv, "expires_at": expires_at},
+            ttl=int(expires_at - time.time()),
+        )
+        return rv
+
+    @classmethod
+    def _assume_role_from_sts(cls, role_arn, expires_in, aws_creds_config, boto=None):
+        """
+        Return:
+            Tuple[dict, float]: the credentials and their expiration timestamp
+        """
         # retrieve from AWS, with additional ASSUME_ROLE_CACHE_SECONDS buffer for cache
         boto = boto or flask.current_app.boto
 
@@ -682,48 +1059,28 @@ class S3IndexedFileLocation(IndexedFileLocation):
         expires_at = get_value(
             cred, "Expiration", InternalError("outdated format. Expiration missing")
         ).timestamp()
+        return rv, expires_at
 
-        # stores back to cache
-        cls._assume_role_cache[role_arn] = rv, expires_at
-        if hasattr(flask.current_app, "db"):  # we don't have db in startup
-            with flask.current_app.db.session as session:
-                session.execute(
-                    """\
-                    INSERT INTO assume_role_cache (
-                        arn,
-                        expires_at,
-                        aws_access_key_id,
-                        aws_secret_access_key,
-                        aws_session_token
-                    ) VALUES (
-                        :arn,
-                        :expires_at,
-                        :aws_access_key_id,
-                        :aws_secret_access_key,
-                        :aws_session_token
-                    ) ON CONFLICT (arn) DO UPDATE SET
-                        expires_at = EXCLUDED.expires_at,
-                        aws_access_key_id = EXCLUDED.aws_access_key_id,
-                        aws_secret_access_key = EXCLUDED.aws_secret_access_key,
-                        aws_session_token = EXCLUDED.aws_session_token;""",
-                    dict(arn=role_arn, expires_at=expires_at, **rv),
-                )
-        return rv
-
-    def bucket_name(self):
+    @cached_property
+    def resolved_bucket(self):
         """
         Return:
-            Optional[str]: bucket name or None if not not in cofig
+            ResolvedS3Bucket: the `S3_BUCKETS` entry for this file's bucket,
+                with its endpoint URL and region
         """
         s3_buckets = get_value(
             flask.current_app.config,
             "S3_BUCKETS",
             InternalError("buckets not configured"),
         )
-        for bucket in s3_buckets:
-            if re.match("^" + bucket + "$", self.parsed_url.netloc):
-                return bucket
-        return None
+        return get_s3_bucket_index(s3_buckets).resolve(self.parsed_url.netloc)
+
+    def bucket_name(self):
+        """
+        Return:
+            Optional[str]: bucket name or None if not not in cofig
+        """
+        return self.resolved_bucket.name
 
     def file_name(self):
         file_name = self.parsed_url.path[1:]
@@ -771,37 +1128,45 @@ class S3IndexedFileLocation(IndexedFileLocation):
             )
 
     def get_bucket_region(self):
-        s3_buckets = get_value(
-            config, "S3_BUCKETS", InternalError("buckets not configured")
-        )
-        if len(s3_buckets) == 0:
-            return None
-
-        bucket_cred = s3_buckets.get(self.bucket_name())
-        if bucket_cred is None:
-            return None
+        return self.resolved_bucket.region
 
-        if "region" not in bucket_cred:
-            return None
-        else:
-            return bucket_cred["region"]
+    def discover_bucket_region(self, credential):
+        """
+        Return the region of this file's bucket, which is not configured in
+        `S3_BUCKETS`. The regions of the configured buckets are fetched when
+        the app starts, so this usually hits the cache.
+        """
+        bucket_regions = getattr(flask.current_app, "s3_bucket_regions", None)
+        if bucket_regions is None:
+            return flask.current_app.boto.get_bucket_region(
+                self.parsed_url.netloc, credential
+            )
+        return bucket_regions.get_region(
+            self.parsed_url.netloc,
+            credential,
+            flask.current_app.boto,
+            db=getattr(flask.current_app, "db", None),
+        )
 
     def get_signed_url(
-        self, action, expires_in, public_data=False, force_signed_url=True, **kwargs
+        self,
+        action,
+        expires_in,
+        public_data=False,
+        force_signed_url=True,
+        user_info=None,
+        **kwargs,
     ):
 
         aws_creds = get_value(
             config, "AWS_CREDENTIALS", InternalError("credentials not configured")
         )
-        s3_buckets = get_value(
-            config, "S3_BUCKETS", InternalError("buckets not configured")
-        )
 
-        bucket_name = self.bucket_name()
-        bucket = s3_buckets.get(bucket_name)
+        bucket = self.resolved_bucket
+        bucket_name = bucket.name
 
-        if bucket and bucket.get("endpoint_url"):
-            http_url = bucket["endpoint_url"].strip("/") + "/{}/{}".format(
+        if bucket.endpoint_url:
+            http_url = bucket.endpoint_url.strip("/") + "/{}/{}".format(
                 self.parsed_url.netloc, self.parsed_url.path.strip("/")
             )
         else:
@@ -826,13 +1191,11 @@ class S3IndexedFileLocation(IndexedFileLocation):
         if aws_access_key_id == "*" or (public_data and not force_signed_url):
             return http_url
 
-        region = self.get_bucket_region()
-        if not region and not bucket.get("endpoint_url"):
-            region = flask.current_app.boto.get_bucket_region(
-                self.parsed_url.netloc, credential
-            )
+        region = bucket.region
+        if not region and not bucket.endpoint_url:
+            region = self.discover_bucket_region(credential)
 
-        user_info = _get_user_info()
+        user_info = user_info or _get_user_info()
 
         url = generate_aws_presigned_url(
             http_url,
@@ -888,9 +1251,7 @@ class S3IndexedFileLocation(IndexedFileLocation):
 
         region = self.get_bucket_region()
         if not region:
-            region = flask.current_app.boto.get_bucket_region(
-                self.parsed_url.netloc, credential
-            )
+            region = self.discover_bucket_region(credential)
 
         return multipart_upload.generate_presigned_url_for_uploading_part(
             self.parsed_url.netloc,
@@ -939,11 +1300,33 @@ class GoogleStorageIndexedFileLocation(IndexedFileLocation):
     """
     An indexed file that lives in a Google Storage bucket.
 
-    _assume_role_cache_gs is used for in mem caching of GCP role credentials
+    _signing_key_cache is used as a cache for holding the users' service
+    account keys used to sign URLs. It is kept in memory, or shared between
+    the workers in Redis (see the `ASSUME_ROLE_SHARED_CACHE` configuration),
+    and backed by the `gcp_assume_role_cache` DB table.
     """
 
-    # expected structore { proxy_group_id: (private_key, key_db_entry) }
-    _assume_role_cache_gs = {}
+    # expected structure { proxy_group_id: {"private_key": dict, "expires_at": ts} }
+    # created on first use by `_get_signing_key_cache`
+    _signing_key_cache = None
+    # expected structure { proxy_group_id: threading.Lock }
+    _signing_key_locks = {}
+    _signing_key_locks_lock = threading.Lock()
+
+    @classmethod
+    def _get_signing_key_cache(cls):
+        if cls._signing_key_cache is None:
+            cls._signing_key_cache = make_cache(
+                config["ASSUME_ROLE_SHARED_CACHE"],
+                prefix="fence:gs_signing_key",
+                encryption_key=config["ENCRYPTION_KEY"],
+            )
+        return cls._signing_key_cache
+
+    @classmethod
+    def _get_signing_key_lock(cls, proxy_group_id):
+        with cls._signing_key_locks_lock:
+            return cls._signing_key_locks.setdefault(proxy_group_id, threading.Lock())
 
     def get_resource_path(self):
         return self.parsed_url.netloc.strip("/") + "/" + self.parsed_url.path.strip("/")
@@ -955,10 +1338,11 @@ class GoogleStorageIndexedFileLocation(IndexedFileLocation):
         public_data=False,
         force_signed_url=True,
         r_pays_project=None,
+        user_info=None,
     ):
         resource_path = self.get_resource_path()
 
-        user_info = _get_user_info()
+        user_info = user_info or _get_user_info()
 
         if public_data and not force_signed_url:
             url = "https://storage.cloud.google.com/" + resource_path
@@ -1017,6 +1401,163 @@ class GoogleStorageIndexedFileLocation(IndexedFileLocation):
 
         return file_name
 
+    @classmethod
+    def get_signing_key(cls, proxy_group_id, user_id, username, expiration_time):
+        """
+        Return the private key of the user's service account, valid until at
+        least `expiration_time`, to sign URLs with.
+
+        Only one thread per process, and one process at a time when the DB is
+        available, reads or creates the key of a given proxy group; the others
+        wait and then use the key it stored.
+
+        Args:
+            proxy_group_id (str): the user's proxy group ID
+            user_id (int)
+            username (str)
+            expiration_time (int): timestamp at which the signed URL expires
+
+        Returns:
+            dict: JSON Google Credentials
+        """
+        cache = cls._get_signing_key_cache()
+        cached = cache.get(proxy_group_id, None)
+        if cached and cached["expires_at"] > expiration_time:
+            _count_google_signing_key_cache_request("hit")
+            return cached["private_key"]
+
+        with cls._get_signing_key_lock(proxy_group_id):
+            # another thread may have stored the key while we waited
+            cached = cache.get(proxy_group_id, None)
+            if cached and cached["expires_at"] > expiration_time:
+                _count_google_signing_key_cache_request("hit")
+                return cached["private_key"]
+            private_key, expires_at = cls._refresh_signing_key(
+                proxy_group_id, user_id, username, expiration_time
+            )
+
+        cache.set(
+            proxy_group_id,
+            {"private_key": private_key, "expires_at": expires_at},
+            ttl=int(expires_at - time.time()),
+        )
+        return private_key
+
+    @classmethod
+    def _refresh_signing_key(cls, proxy_group_id, user_id, username, expiration_time):
+        """
+        Get a key that expires after `expiration_time` from the database
+        cache, or else from the user's service account keys, creating one if
+        needed, and store it in the database cache.
+
+        While checking the database and creating the key, a database lock on
+        the proxy group is held, so the other workers wait for this key
+        instead of creating another one.
+
+        Return:
+            Tuple[dict, int]: the private key and its expiration timestamp
+        """
+        if not hasattr(flask.current_app, "db"):  # we don't have db in startup
+            _count_google_signing_key_cache_request("miss")
+            return cls._get_or_create_signing_key(
+                proxy_group_id, user_id, username, expiration_time
+            )
+
+        with flask.current_app.db.session as session:
+            # released at the end of the transaction
+            session.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(:proxy_group_id))",
+                dict(proxy_group_id=proxy_group_id),
+            )
+            db_cache = (
+                session.query(AssumeRoleCacheGCP)
+                .filter(AssumeRoleCacheGCP.gcp_proxy_group_id == proxy_group_id)
+                .first()
+            )
+            if (
+                db_cache
+                and db_cache.expires_at
+                and db_cache.expires_at > expiration_time
+            ):
+                try:
+                    private_key = json.loads(db_cache.gcp_private_key)
+                except ValueError:
+                    # entries stored by older versions are not valid JSON
+                    logger.debug(
+                        "Ignoring invalid cached key for proxy group {}".format(
+                            proxy_group_id
+                        )
+                    )
+                else:
+                    _count_google_signing_key_cache_request("db_hit")
+                    return private_key, db_cache.expires_at
+
+            _count_google_signing_key_cache_request("miss")
+            private_key, expires_at = cls._get_or_create_signing_key(
+                proxy_group_id, user_id, username, expiration_time
+            )
+            session.execute(
+                """\
+                INSERT INTO gcp_assume_role_cache (
+                    expires_at,
+                    gcp_proxy_group_id,
+                    gcp_private_key,
+                    gcp_key_db_entry
+                ) VALUES (
+                    :expires_at,
+                    :gcp_proxy_group_id,
+                    :gcp_private_key,
+                    :gcp_key_db_entry
+                ) ON CONFLICT (gcp_proxy_group_id) DO UPDATE SET
+                    expires_at = EXCLUDED.expires_at,
+                    gcp_proxy_group_id = EXCLUDED.gcp_proxy_group_id,
+                    gcp_private_key = EXCLUDED.gcp_private_key,
+                    gcp_key_db_entry = EXCLUDED.gcp_key_db_entry;""",
+                dict(
+                    expires_at=expires_at,
+                    gcp_proxy_group_id=proxy_group_id,
+                    gcp_private_key=json.dumps(private_key),
+                    gcp_key_db_entry=json.dumps({"expires": expires_at}),
+                ),
+            )
+        return private_key, expires_at
+
+    @staticmethod
+    def _get_or_create_signing_key(proxy_group_id, user_id, username, expiration_time):
+        """
+        Return:
+            Tuple[dict, int]: the private key of the user's primary service
+                account and its expiration timestamp
+        """
+        key_lifetime = config["GOOGLE_SERVICE_ACCOUNT_KEY_FOR_URL_SIGNING_EXPIRES_IN"]
+        private_key, key_db_entry = get_or_create_primary_service_account_key(
+            user_id=user_id, username=username, proxy_group_id=proxy_group_id
+        )
+        if key_db_entry and key_db_entry.expires:
+            expires_at = key_db_entry.expires
+        else:
+            # the key was just created, or has no custom expiration: check it
+            # again after the lifetime of a new key
+            expires_at = int(time.time()) + key_lifetime
+
+        # Make sure the service account key expiration is later
+        # than the expiration for the signed url. If it's not, we need to
+        # provision a new service account key.
+        #
+        # NOTE: This should occur very rarely: only when the service account key
+        #       already exists and is very close to expiring.
+        #
+        #       If our scheduled maintainence script removes the url-signing key
+        #       before the expiration of the url then the url will NOT work
+        #       (even though the url itself isn't expired)
+        if expires_at < expiration_time:
+            private_key = create_primary_service_account_key(
+                user_id=user_id, username=username, proxy_group_id=proxy_group_id
+            )
+            expires_at = int(time.time()) + key_lifetime
+
+        return private_key, expires_at
+
     def _generate_google_storage_signed_url(
         self,
         http_verb,
@@ -1029,79 +1570,9 @@ class GoogleStorageIndexedFileLocation(IndexedFileLocation):
 
         proxy_group_id = get_or_create_proxy_group_id()
         expiration_time = int(time.time()) + expires_in
-
-        is_cached = False
-
-        if proxy_group_id in self._assume_role_cache_gs:
-            private_key, key_db_entry = self._assume_role_cache_gs.get(proxy_group_id)
-            is_cached = True
-        elif hasattr(flask.current_app, "db"):
-            with flask.current_app.db.session as session:
-                cache = (
-                    session.query(AssumeRoleCacheGCP)
-                    .filter(AssumeRoleCacheGCP.gcp_proxy_group_id == proxy_group_id)
-                    .first()
-                )
-                if cache and cache.expires_at > expiration_time:
-                    rv = (
-                        json.loads(cache.gcp_private_key),
-                        json.loads(cache.gcp_key_db_entry),
-                    )
-                    self._assume_role_cache_gs[proxy_group_id] = rv
-                    private_key, key_db_entry = self._assume_role_cache_gs.get(
-                        proxy_group_id
-                    )
-                    is_cached = True
-
-        # check again to see if we cached the creds if not we need to
-        if is_cached == False:
-            private_key, key_db_entry = get_or_create_primary_service_account_key(
-                user_id=user_id, username=username, proxy_group_id=proxy_group_id
-            )
-
-            # Make sure the service account key expiration is later
-            # than the expiration for the signed url. If it's not, we need to
-            # provision a new service account key.
-            #
-            # NOTE: This should occur very rarely: only when the service account key
-            #       already exists and is very close to expiring.
-            #
-            #       If our scheduled maintainence script removes the url-signing key
-            #       before the expiration of the url then the url will NOT work
-            #       (even though the url itself isn't expired)
-            if key_db_entry and key_db_entry.expires < expiration_time:
-                private_key = create_primary_service_account_key(
-                    user_id=user_id, username=username, proxy_group_id=proxy_group_id
-                )
-            self._assume_role_cache_gs[proxy_group_id] = (private_key, key_db_entry)
-
-            db_entry = {}
-            db_entry["gcp_proxy_group_id"] = proxy_group_id
-            db_entry["gcp_private_key"] = str(private_key)
-            db_entry["gcp_key_db_entry"] = str(key_db_entry)
-            db_entry["expires_at"] = expiration_time
-
-            if hasattr(flask.current_app, "db"):  # we don't have db in startup
-                with flask.current_app.db.session as session:
-                    session.execute(
-                        """\
-                        INSERT INTO gcp_assume_role_cache (
-                            expires_at,
-                            gcp_proxy_group_id,
-                            gcp_private_key,
-                            gcp_key_db_entry
-                        ) VALUES (
-                            :expires_at,
-                            :gcp_proxy_group_id,
-                            :gcp_private_key,
-                            :gcp_key_db_entry
-                        ) ON CONFLICT (gcp_proxy_group_id) DO UPDATE SET
-                            expires_at = EXCLUDED.expires_at,
-                            gcp_proxy_group_id = EXCLUDED.gcp_proxy_group_id,
-                            gcp_private_key = EXCLUDED.gcp_private_key,
-                            gcp_key_db_entry = EXCLUDED.gcp_key_db_entry;""",
-                        db_entry,
-                    )
+        private_key = self.get_signing_key(
+            proxy_group_id, user_id, username, expiration_time
+        )
 
         if config["ENABLE_AUTOMATIC_BILLING_PERMISSION_SIGNED_URLS"]:
             give_service_account_billing_access_if_necessary(
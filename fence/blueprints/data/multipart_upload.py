@@ -2,9 +2,9 @@ import boto3
 from botocore.exceptions import ClientError
 from retry.api import retry_call
 
-from cdispyutils.hmac4 import generate_aws_presigned_url
 from cdislogging import get_logger
 from fence.errors import InternalError
+from fence.resources.aws.presigner import generate_aws_presigned_url
 
 MAX_TRIES = 5
 
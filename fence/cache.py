@@ -0,0 +1,196 @@
+"""
+Process-wide caches with a time-to-live.
+
+``TTLCache`` keeps entries in memory, bounded by a maximum size with
+least-recently-used eviction. ``RedisCache`` has the same interface but stores
+entries in Redis so they can be shared by all the workers on a host; it
+requires the optional ``redis`` package. A ``RedisCache`` holding secrets should
+be given an ``encryption_key`` so the values are not stored in Redis in clear.
+
+Both caches store ``None`` like any other value: use ``get(key, MISSING)`` (or
+``key in cache``) to tell a cached ``None`` apart from a cache miss.
+"""
+
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from cdislogging import get_logger
+from cryptography.fernet import Fernet, InvalidToken
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+logger = get_logger(__name__)
+
+# returned by `get` on a cache miss when no default is provided
+MISSING = object()
+
+
+class TTLCache(object):
+    """
+    Thread-safe in-memory cache, bounded in size (least recently used entries
+    are evicted first) and whose entries expire ``ttl`` seconds after being set.
+
+    Args:
+        max_size (int): maximum number of entries
+        ttl (int): default time-to-live of the entries, in seconds
+        timer (Callable[[], float]): clock, overridable for testing
+    """
+
+    def __init__(self, max_size=1024, ttl=60, timer=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._timer = timer
+        # key -> (value, expires_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= self._timer():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self._timer() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not MISSING
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(object):
+    """
+    Cache backed by Redis, with the same interface as ``TTLCache``. Values must
+    be JSON-serializable.
+
+    The size of the cache is bounded by the Redis server (``maxmemory`` and an
+    LRU ``maxmemory-policy``), not by this client.
+
+    Args:
+        url (str): Redis connection URL, for example `redis://localhost:6379/0`
+        prefix (str): prefix for the keys, so caches can share a database
+        ttl (int): default time-to-live of the entries, in seconds
+        encryption_key (str): Fernet key used to encrypt the values. If it is
+            provided but empty, the cache cannot be created, so that values
+            meant to be encrypted are never stored in clear
+    """
+
+    def __init__(self, url, prefix="fence", ttl=60, encryption_key=None):
+        if encryption_key is not None and not encryption_key:
+            raise Exception(
+                "A Redis cache is configured for values that must be encrypted, "
+                "but the encryption key is empty"
+            )
+        if redis is None:
+            raise Exception(
+                "A Redis cache is configured but the `redis` package is not installed"
+            )
+        self.prefix = prefix
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+        self._fernet = (
+            Fernet(str(encryption_key)) if encryption_key is not None else None
+        )
+
+    def _key(self, key):
+        return "{}:{}".format(self.prefix, key)
+
+    def get(self, key, default=MISSING):
+        try:
+            value = self._redis.get(self._key(key))
+        except redis.RedisError as e:
+            logger.warning("Unable to read from Redis cache: {}".format(e))
+            return default
+        if value is None:
+            return default
+        if self._fernet:
+            try:
+                value = self._fernet.decrypt(value)
+            except InvalidToken:
+                # stored in clear or with another key: treat it as a miss
+                logger.warning(
+                    "Unable to decrypt Redis cache entry {}".format(self._key(key))
+                )
+                return default
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        value = json.dumps(value)
+        if self._fernet:
+            value = self._fernet.encrypt(value.encode("utf-8"))
+        try:
+            self._redis.setex(self._key(key), int(ttl), value)
+        except redis.RedisError as e:
+            logger.warning("Unable to write to Redis cache: {}".format(e))
+
+    def delete(self, key):
+        try:
+            self._redis.delete(self._key(key))
+        except redis.RedisError as e:
+            logger.warning("Unable to delete from Redis cache: {}".format(e))
+
+    def clear(self):
+        for key in self._redis.scan_iter(match=self._key("*")):
+            self._redis.delete(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not MISSING
+
+
+def make_cache(cache_config, prefix, encryption_key=None):
+    """
+    Create a cache from a configuration block with the fields `max_size`, `ttl`
+    and an optional `redis_url`.
+
+    Args:
+        cache_config (dict): configuration block
+        prefix (str): key prefix, when the cache is stored in Redis
+        encryption_key (str): Fernet key used to encrypt the values, when the
+            cache is stored in Redis. Creating a Redis cache with an empty key
+            raises an exception
+
+    Return:
+        TTLCache or RedisCache
+    """
+    if cache_config.get("redis_url"):
+        return RedisCache(
+            cache_config["redis_url"],
+            prefix=prefix,
+            ttl=cache_config.get("ttl", 60),
+            encryption_key=encryption_key,
+        )
+    return TTLCache(
+        max_size=cache_config.get("max_size", 1024), ttl=cache_config.get("ttl", 60)
+    )
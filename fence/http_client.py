@@ -0,0 +1,154 @@
+"""
+Shared HTTP clients for the services fence calls on the request path.
+
+Each upstream service gets a client with a ``requests`` compatible interface
+(``get``, ``post``, ``put``, ``delete``) backed by a keep-alive session, so
+connections (and TLS handshakes) are reused between requests instead of being
+opened for every call. Connections are pooled per host; the pool sizes and the
+default timeouts come from the ``OUTBOUND_HTTP`` configuration.
+
+When Prometheus metrics are enabled, the latency of every call is recorded in
+the ``outbound_http_request_duration_seconds`` histogram, labeled by upstream.
+
+Usage:
+
+    from fence import http_client
+    response = http_client.indexd.get(url)
+"""
+
+import threading
+import time
+
+from cdislogging import get_logger
+import flask
+from gen3authz.client.arborist.client import SyncClient
+import requests
+from requests.adapters import HTTPAdapter
+
+from fence.config import config
+
+
+logger = get_logger(__name__)
+
+
+class PooledHTTPClient(object):
+    """
+    ``requests`` compatible client for one upstream service.
+
+    The session is created on first use (so after uWSGI forks its workers, and
+    after the configuration is loaded) and then shared by all the threads of
+    the process.
+
+    Args:
+        upstream (str): name of the upstream service, used in metrics
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._make_session()
+        return self._session
+
+    def _make_session(self):
+        http_config = config["OUTBOUND_HTTP"]
+        adapter = HTTPAdapter(
+            pool_connections=http_config["pool_connections"],
+            pool_maxsize=http_config["pool_maxsize"],
+            max_retries=http_config["max_retries"],
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        http_config = config["OUTBOUND_HTTP"]
+        kwargs.setdefault(
+            "timeout", (http_config["connect_timeout"], http_config["read_timeout"])
+        )
+        start = time.time()
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            _observe_latency(self.upstream, method, time.time() - start)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class PooledArboristSyncClient(SyncClient):
+    """
+    The Arborist client opens (and closes) a new ``httpx`` client for every
+    call. This one is shared instead: opening and closing it are no-ops (recent
+    ``httpx`` versions refuse to open a client twice) so connections stay open
+    between calls, and call latencies are recorded like for the other upstream
+    services.
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def request(self, method, url, *args, **kwargs):
+        start = time.time()
+        try:
+            return await super(PooledArboristSyncClient, self).request(
+                method, url, *args, **kwargs
+            )
+        finally:
+            _observe_latency("arborist", method, time.time() - start)
+
+
+def pool_arborist_connections(arborist_client):
+    """
+    Make the given ``ArboristClient`` reuse a single ``httpx`` client (and
+    therefore its connections) for all its calls.
+    """
+    shared_client = PooledArboristSyncClient()
+    arborist_client.client_cls = lambda: shared_client
+    return arborist_client
+
+
+def _observe_latency(upstream, method, duration):
+    if not flask.has_app_context():
+        return
+    histogram = getattr(flask.current_app, "prometheus_counters", {}).get(
+        "outbound_http_request_duration"
+    )
+    if histogram:
+        histogram.labels(upstream, method.upper()).observe(duration)
+
+
+#: shared clients, one per upstream service
+indexd = PooledHTTPClient("indexd")
+audit_service = PooledHTTPClient("audit_service")
@@ -47,7 +47,13 @@ def blacklist_token(jti, exp):
 
     Side Effects:
         - Add entry with ``jti`` to ``BlacklistedToken`` table
+        - Remove the token from this process' verified token cache
     """
+    # imported here to avoid a circular import
+    from fence.jwt.validate import forget_verified_token
+
+    forget_verified_token(jti)
+
     # Do nothing if JWT id is already blacklisted.
     with flask.current_app.db.session as session:
         if session.query(BlacklistedToken).filter_by(jti=jti).first():
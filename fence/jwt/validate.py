@@ -1,9 +1,15 @@
+import functools
+import hashlib
+import time
+
 import authutils.errors
+import authutils.token.core
 import authutils.token.keys
 import authutils.token.validate
 import flask
 import jwt
 
+from fence.cache import TTLCache
 from fence.config import config
 from fence.errors import Unauthorized
 from fence.jwt.blacklist import is_blacklisted
@@ -11,6 +17,226 @@ from fence.jwt.errors import JWTError, JWTPurposeError
 from fence.jwt.utils import get_jwt_header
 
 
+def _get_request_cache(name):
+    """
+    Return a dict stored in ``flask.g``, so it only lives as long as the
+    current request. Outside of the app context, return a new empty dict.
+    """
+    if not flask.has_app_context():
+        return {}
+    cache = getattr(flask.g, name, None)
+    if cache is None:
+        cache = {}
+        setattr(flask.g, name, cache)
+    return cache
+
+
+def get_unverified_claims(encoded_token):
+    """
+    Decode a JWT without verifying it. The result is memoized for the
+    duration of the request.
+
+    Raises:
+        jwt.InvalidTokenError: if the token cannot be decoded
+    """
+    cache = _get_request_cache("_unverified_jwt_claims")
+    if encoded_token not in cache:
+        cache[encoded_token] = jwt.decode(encoded_token, verify=False)
+    return cache[encoded_token]
+
+
+# process-wide caches of the tokens whose signature was verified, created on
+# first use (see `_get_verified_token_cache`)
+_verified_tokens = None
+_verified_token_hashes_by_jti = None
+
+
+def _get_verified_token_cache():
+    """
+    Return the process-wide cache mapping the hash of a token to the public
+    key that verified its signature, or None if `VERIFIED_TOKEN_CACHE` is
+    disabled.
+
+    This cache is always kept in memory: sharing it (for example in Redis)
+    would allow anyone with write access to it to bypass the signature
+    verification.
+    """
+    global _verified_tokens, _verified_token_hashes_by_jti
+    cache_config = config["VERIFIED_TOKEN_CACHE"]
+    if not cache_config.get("enabled"):
+        return None
+    if _verified_tokens is None:
+        _verified_token_hashes_by_jti = TTLCache(
+            max_size=cache_config["max_size"], ttl=cache_config["ttl"]
+        )
+        _verified_tokens = TTLCache(
+            max_size=cache_config["max_size"], ttl=cache_config["ttl"]
+        )
+    return _verified_tokens
+
+
+def _hash_token(encoded_token):
+    return hashlib.sha256(encoded_token.encode("utf-8")).hexdigest()
+
+
+def _remember_verified_token(encoded_token, public_key):
+    cache = _get_verified_token_cache()
+    if cache is None:
+        return
+    claims = get_unverified_claims(encoded_token)
+    try:
+        ttl = min(int(claims["exp"] - time.time()), cache.ttl)
+    except (KeyError, TypeError, ValueError):
+        return
+    token_hash = _hash_token(encoded_token)
+    cache.set(token_hash, public_key, ttl=ttl)
+    if claims.get("jti"):
+        _verified_token_hashes_by_jti.set(claims["jti"], token_hash, ttl=ttl)
+
+
+def _count_verified_token_cache_request(result):
+    if not flask.has_app_context():
+        return
+    counter = getattr(flask.current_app, "prometheus_counters", {}).get(
+        "verified_token_cache"
+    )
+    if counter:
+        counter.labels(result).inc()
+
+
+def forget_verified_token(jti):
+    """
+    Remove the token with JWT id ``jti`` from the verified token cache of
+    this process, so the next validation verifies its signature again.
+
+    Other processes don't need to be notified: the cache only skips the
+    signature verification, so a blacklisted refresh token or API key is
+    rejected everywhere by the blacklist check (the `blacklisted_token` table
+    is shared by all the workers), and the workers evict it from their own
+    cache when that check fails.
+    """
+    if _get_verified_token_cache() is None:
+        return
+    token_hash = _verified_token_hashes_by_jti.get(jti, None)
+    if token_hash:
+        _verified_tokens.delete(token_hash)
+        _verified_token_hashes_by_jti.delete(jti)
+
+
+def _validate_signed_jwt(encoded_token, public_key, aud, scope, issuers, options=None):
+    """
+    Wrap ``authutils.token.core.validate_jwt`` so that the (RSA) signature of
+    a token is only verified once: the token is remembered with the public
+    key that verified it, for the duration of the request and in the
+    process-wide verified token cache (until the token expires), and later
+    calls with the same token and key skip the signature verification. All
+    the other checks (expiration, audience, issuer, scopes) still happen on
+    every call, since they depend on the arguments.
+    """
+    verified = _get_request_cache("_verified_jwt_signatures")
+    options = dict(options or {})
+    if verified.get(encoded_token) == public_key:
+        options["verify_signature"] = False
+    else:
+        cache = _get_verified_token_cache()
+        if cache is not None:
+            if cache.get(_hash_token(encoded_token), None) == public_key:
+                options["verify_signature"] = False
+                _count_verified_token_cache_request("hit")
+            else:
+                _count_verified_token_cache_request("miss")
+
+    try:
+        claims = authutils.token.core.validate_jwt(
+            encoded_token, public_key, aud, scope, issuers, options
+        )
+    except (authutils.errors.JWTAudienceError, authutils.errors.JWTScopeError):
+        # these are only raised once the signature is verified
+        if verified.get(encoded_token) != public_key:
+            verified[encoded_token] = public_key
+            _remember_verified_token(encoded_token, public_key)
+        raise
+    except authutils.errors.JWTExpiredError:
+        verified[encoded_token] = public_key
+        raise
+    if verified.get(encoded_token) != public_key:
+        verified[encoded_token] = public_key
+        _remember_verified_token(encoded_token, public_key)
+    return claims
+
+
+def _validate_jwt_with_key(
+    encoded_token, aud, scope, purpose, issuers, public_key, options=None, **kwargs
+):
+    """
+    Same as ``authutils.token.validate.validate_jwt`` when the public key is
+    known, but using ``_validate_signed_jwt``.
+    """
+    claims = _validate_signed_jwt(
+        encoded_token, public_key, aud, scope, issuers, options
+    )
+    if purpose:
+        authutils.token.core.validate_purpose(claims, purpose)
+    return claims
+
+
+def validate_request(scope={}, audience=None, purpose="access", logger=None):
+    """
+    Same as ``authutils.token.validate.validate_request`` (and raising the
+    same ``authutils`` errors), but the signature of the token is only
+    verified once per request, even if the request is validated many times.
+    """
+    # the header is parsed like in authutils: the scheme is not checked
+    try:
+        encoded_token = flask.request.headers["Authorization"].split(" ")[1]
+    except IndexError:
+        raise authutils.errors.JWTError("could not parse authorization header")
+    except KeyError:
+        raise authutils.errors.JWTError("no authorization header provided")
+
+    issuers = [
+        flask.current_app.config[config_var]
+        for config_var in ["OIDC_ISSUER", "USER_API", "BASE_URL"]
+        if flask.current_app.config.get(config_var)
+    ]
+    if audience is None:
+        audience = flask.current_app.config.get(
+            "BASE_URL"
+        ) or flask.current_app.config.get("USER_API")
+    public_key = authutils.token.keys.get_public_key_for_token(
+        encoded_token, attempt_refresh=True, logger=logger
+    )
+    return _validate_jwt_with_key(
+        encoded_token,
+        aud=audience,
+        scope=scope,
+        purpose=purpose,
+        issuers=issuers,
+        public_key=public_key,
+    )
+
+
+def require_auth_header(scope={}, audience=None, purpose=None, logger=None):
+    """
+    Same as ``authutils.token.validate.require_auth_header``, using the
+    ``validate_request`` above.
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            authutils.token.validate.set_current_token(
+                validate_request(
+                    scope=scope, audience=audience, purpose=purpose, logger=logger
+                )
+            )
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 def validate_purpose(claims, pur):
     """
     Check that the claims from a JWT have the expected purpose ``pur``
@@ -101,7 +327,7 @@ def validate_jwt(
     if oidc_iss:
         issuers.append(oidc_iss)
     try:
-        token_iss = jwt.decode(encoded_token, verify=False).get("iss")
+        token_iss = get_unverified_claims(encoded_token).get("iss")
     except jwt.InvalidTokenError as e:
         raise JWTError(e)
     attempt_refresh = attempt_refresh and (token_iss != iss)
@@ -109,7 +335,7 @@ def validate_jwt(
         encoded_token, attempt_refresh=attempt_refresh
     )
     try:
-        claims = authutils.token.validate.validate_jwt(
+        claims = _validate_jwt_with_key(
             encoded_token=encoded_token,
             aud=aud,
             scope=scope,
@@ -129,13 +355,13 @@ def validate_jwt(
         # remove patch in next tag. Refresh tokens and API keys have default TTL of 30 days.
         from authutils.errors import JWTAudienceError
 
-        unverified_claims = jwt.decode(encoded_token, verify=False)
+        unverified_claims = get_unverified_claims(encoded_token)
         if unverified_claims.get("pur") == "refresh" and isinstance(
             e, JWTAudienceError
         ):
             # Check everything else is fine minus the audience
             try:
-                claims = authutils.token.validate.validate_jwt(
+                claims = _validate_jwt_with_key(
                     encoded_token=encoded_token,
                     aud="openid",
                     scope=None,
@@ -152,7 +378,7 @@ def validate_jwt(
         ):
             # Check everything else is fine minus the audience
             try:
-                claims = authutils.token.validate.validate_jwt(
+                claims = _validate_jwt_with_key(
                     encoded_token=encoded_token,
                     aud="fence",
                     scope=None,
@@ -167,7 +393,6 @@ def validate_jwt(
         else:
             ##### end refresh token, API key patch block #####
             msg = "Invalid token : {}".format(str(e))
-            unverified_claims = jwt.decode(encoded_token, verify=False)
             if not unverified_claims.get("scope") or "" in unverified_claims["scope"]:
                 msg += "; was OIDC client configured with scopes?"
             raise JWTError(msg)
@@ -180,6 +405,7 @@ def validate_jwt(
     # blacklisted.
     if claims["pur"] == "refresh" or claims["pur"] == "api_key":
         if is_blacklisted(claims["jti"]):
+            forget_verified_token(claims["jti"])
             raise JWTError("token is blacklisted")
 
     return claims
@@ -8,6 +8,9 @@ database migrations.
 """
 
 from enum import Enum
+import hashlib
+import hmac
+import os
 
 from authlib.flask.oauth2.sqla import OAuth2AuthorizationCodeMixin, OAuth2ClientMixin
 import bcrypt
@@ -55,9 +58,59 @@ from userdatamodel.models import (
 )
 import warnings
 
+from fence.cache import TTLCache
 from fence.config import config
 
 
+# process-wide cache of the client secrets that were verified, created on first
+# use (see `_get_verified_client_secret_cache`)
+_verified_client_secrets = None
+# key of the HMAC of the client secrets used in the cache keys, so the cache
+# never holds the secrets or a fast hash of them
+_client_secret_hmac_key = os.urandom(32)
+
+
+def _get_verified_client_secret_cache():
+    """
+    Return the process-wide cache mapping a client ID and the HMAC of a
+    client secret to the stored secret hash that the secret was verified
+    against, or None if `VERIFIED_CLIENT_SECRET_CACHE` is disabled.
+    """
+    global _verified_client_secrets
+    cache_config = config.get("VERIFIED_CLIENT_SECRET_CACHE") or {}
+    if not cache_config.get("enabled"):
+        return None
+    if _verified_client_secrets is None:
+        _verified_client_secrets = TTLCache(
+            max_size=cache_config.get("max_size", 1000),
+            ttl=cache_config.get("ttl", 300),
+        )
+    return _verified_client_secrets
+
+
+def _count_verified_client_secret_cache_request(result):
+    if not flask.has_app_context():
+        return
+    counter = getattr(flask.current_app, "prometheus_counters", {}).get(
+        "verified_client_secret_cache"
+    )
+    if counter:
+        counter.labels(result).inc()
+
+
+def forget_verified_client_secrets():
+    """
+    Empty the verified client secret cache of this process.
+
+    Other processes don't need to be notified: a cached secret is only
+    accepted for a client that is still in the database and whose stored
+    secret hash is the one the secret was verified against, so the secrets of
+    deleted clients and rotated secrets are rejected everywhere.
+    """
+    if _verified_client_secrets is not None:
+        _verified_client_secrets.clear()
+
+
 def query_for_user(session, username):
     return (
         session.query(User)
@@ -196,10 +249,34 @@ class Client(Base, OAuth2ClientMixin):
         )
 
     def check_client_secret(self, client_secret):
+        """
+        Check the client secret against the stored hash. The (bcrypt) hash is
+        only computed once for a given secret and stored hash within
+        `VERIFIED_CLIENT_SECRET_CACHE.ttl` seconds.
+        """
+        if not self.client_secret:
+            # public client
+            return False
+        cache = _get_verified_client_secret_cache()
+        if cache is not None:
+            secret_hmac = hmac.new(
+                _client_secret_hmac_key, client_secret.encode("utf-8"), hashlib.sha256
+            ).hexdigest()
+            cache_key = (self.client_id, secret_hmac)
+            # the secret hash changes when the secret is rotated
+            if cache.get(cache_key, None) == self.client_secret:
+                _count_verified_client_secret_cache_request("hit")
+                return True
+            _count_verified_client_secret_cache_request("miss")
+
         check_hash = bcrypt.hashpw(
             client_secret.encode("utf-8"), self.client_secret.encode("utf-8")
         ).decode("utf-8")
-        return check_hash == self.client_secret
+        if check_hash != self.client_secret:
+            return False
+        if cache is not None:
+            cache.set(cache_key, self.client_secret)
+        return True
 
     def check_requested_scopes(self, scopes):
         if "openid" not in scopes:
@@ -551,6 +628,42 @@ class AssumeRoleCacheGCP(Base):
     gcp_key_db_entry = Column(String())
 
 
+class S3BucketRegionCache(Base):
+    __tablename__ = "s3_bucket_region_cache"
+
+    bucket_name = Column(String(), primary_key=True)
+    region = Column(String())
+    expires_at = Column(Integer())
+
+
+class GoogleMonitorProgress(Base):
+    """
+    Last time the Google project was validated by the Google monitor, so
+    that the projects that were not validated recently are validated first.
+    """
+
+    __tablename__ = "google_monitor_progress"
+
+    google_project_id = Column(String(), primary_key=True)
+    last_validated = Column(Integer())
+
+
+class UserSyncSnapshot(Base):
+    """
+    Fingerprint of the usersync input files, and access of each user,
+    computed by the last successful usersync.
+    """
+
+    __tablename__ = "usersync_snapshot"
+
+    name = Column(String(), primary_key=True)
+    fingerprint = Column(String())
+    users = Column(JSONB())
+    updated_at = Column(
+        DateTime(timezone=False), server_default=func.now(), onupdate=func.now()
+    )
+
+
 class GA4GHVisaV1(Base):
 
     __tablename__ = "ga4gh_visa_v1"
@@ -1,6 +1,5 @@
 from authlib.oauth2.rfc6749.errors import InvalidClientError, OAuth2Error
 import authlib.oauth2.rfc7009
-import bcrypt
 import flask
 
 from cdislogging import get_logger
@@ -62,13 +61,7 @@ class RevocationEndpoint(authlib.oauth2.rfc7009.RevocationEndpoint):
 
         # The stored client secret is hashed, so hash the secret from basic
         # authorization header to check against stored hash.
-        hashed = client.client_secret
-        if (
-            bcrypt.hashpw(client_secret.encode("utf-8"), hashed.encode("utf-8")).decode(
-                "utf-8"
-            )
-            != hashed
-        ):
+        if not client.check_client_secret(client_secret):
             logger.debug("client secret hash does not match stored secret hash")
             raise InvalidClientError(uri=self.uri)
 
@@ -1,5 +1,3 @@
-import bcrypt
-
 from authlib.common.security import generate_token
 from authlib.oauth2.rfc6749.errors import InvalidClientError, UnauthorizedClientError
 from authlib.oauth2.rfc6749.grants import (
@@ -133,13 +131,7 @@ class AuthorizationCodeGrant(AuthlibAuthorizationCodeGrant):
             client_id, client_secret = client_params
             client = self.get_and_validate_client(client_id)
             # Client secrets are stored as hash.
-            hashed = client.client_secret
-            if (
-                bcrypt.hashpw(
-                    client_secret.encode("utf-8"), hashed.encode("utf-8")
-                ).decode("utf-8")
-                != hashed
-            ):
+            if not client.check_client_secret(client_secret):
                 raise InvalidClientError(uri=self.uri)
 
             return client
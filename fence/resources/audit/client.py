@@ -1,11 +1,13 @@
 import backoff
 import boto3
+import flask
 import json
-import requests
 import traceback
 
+from fence import http_client
 from fence.config import config
 from fence.errors import InternalError
+from fence.resources.audit.shipper import AuditLogShipper
 from fence.resources.audit.utils import is_audit_enabled
 from fence.utils import DEFAULT_BACKOFF_SETTINGS
 
@@ -15,6 +17,7 @@ class AuditServiceClient:
         self.service_url = service_url.rstrip("/")
         self.logger = logger
         self.push_type = config["PUSH_AUDIT_LOGS_CONFIG"].get("type", "api")
+        self.shipper = None
 
         # audit logs should not be enabled if the audit-service is unavailable
         if is_audit_enabled():
@@ -61,6 +64,18 @@ class AuditServiceClient:
                 aws_secret_access_key=aws_creds.get("aws_secret_access_key"),
             )
 
+        shipping_config = config["AUDIT_LOG_SHIPPING"]
+        if shipping_config.get("enabled"):
+            self.logger.info("Audit logs will be shipped in the background")
+            self.shipper = AuditLogShipper(
+                self._send_audit_logs,
+                max_queue_size=shipping_config["max_queue_size"],
+                batch_size=shipping_config["batch_size"],
+                flush_interval=shipping_config["flush_interval"],
+                queue_full_policy=shipping_config["queue_full_policy"],
+                block_timeout=shipping_config["block_timeout"],
+            )
+
     @backoff.on_exception(backoff.expo, Exception, **DEFAULT_BACKOFF_SETTINGS)
     def _ping(self):
         """
@@ -68,7 +83,7 @@ class AuditServiceClient:
         """
         status_url = f"{self.service_url}/_status"
         self.logger.debug(f"Checking audit-service availability at {status_url}")
-        requests.get(status_url)
+        http_client.audit_service.get(status_url)
 
     def _validate_config(self):
         """
@@ -118,18 +133,29 @@ class AuditServiceClient:
     def _create_audit_log(self, category, data):
         """
         Create an audit log - make an API call or push to a queue depending
-        on the configuration.
+        on the configuration. If background shipping is enabled, the log is
+        only queued here.
 
         Args:
             category (str): audit log category
             data (dict): audit log data
         """
+        if self.shipper:
+            self.shipper.start(
+                metrics=getattr(flask.current_app, "prometheus_counters", None)
+            )
+            self.shipper.put(category, data)
+            return
+
+        self._push_audit_log(category, data)
+
+    def _push_audit_log(self, category, data):
         self.logger.debug(
             f"Creating {category} audit log (push type: {self.push_type})"
         )
         if self.push_type == "api":
             url = f"{self.service_url}/log/{category}"
-            resp = requests.post(url, json=data)
+            resp = http_client.audit_service.post(url, json=data)
             self._check_response(resp, data)
         elif self.push_type == "aws_sqs":
             data["category"] = category
@@ -140,6 +166,49 @@ class AuditServiceClient:
                 self.logger.error(f"Error pushing audit log to SQS '{sqs_url}'")
                 raise
 
+    def _send_audit_logs(self, logs):
+        """
+        Send a batch of queued audit logs. The audit-service API does not
+        support batches, so with the "api" push type the logs are sent one by
+        one; SQS messages are sent 10 at a time (the SQS maximum).
+
+        Args:
+            logs (list): `(category, data)` tuples
+
+        Return:
+            list: the `(category, data)` tuples that could not be sent
+        """
+        failed = []
+        if self.push_type == "api":
+            for category, data in logs:
+                try:
+                    self._push_audit_log(category, data)
+                except Exception:
+                    failed.append((category, data))
+            return failed
+
+        sqs_url = config["PUSH_AUDIT_LOGS_CONFIG"]["aws_sqs_config"]["sqs_url"]
+        for i in range(0, len(logs), 10):
+            chunk = logs[i : i + 10]
+            entries = []
+            for j, (category, data) in enumerate(chunk):
+                data["category"] = category
+                entries.append({"Id": str(j), "MessageBody": json.dumps(data)})
+            try:
+                resp = self.sqs.send_message_batch(QueueUrl=sqs_url, Entries=entries)
+            except Exception as e:
+                self.logger.error(
+                    f"Error pushing {len(chunk)} audit logs to SQS '{sqs_url}': {e}"
+                )
+                failed.extend(chunk)
+                continue
+            for failure in resp.get("Failed", []):
+                self.logger.error(
+                    f"Error pushing audit log to SQS '{sqs_url}': {failure}"
+                )
+                failed.append(chunk[int(failure["Id"])])
+        return failed
+
     def create_presigned_url_log(
         self,
         request_url,
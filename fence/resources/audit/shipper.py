@@ -0,0 +1,203 @@
+"""
+Background shipping of audit logs.
+
+When enabled (`AUDIT_LOG_SHIPPING.enabled`), audit logs are not pushed to the
+audit-service (or SQS) before the response is returned: they are added to a
+bounded in-memory queue, and a worker thread sends them in batches, as soon
+as a batch is full or `flush_interval` seconds after the first queued log.
+
+When the queue is full, new logs are dropped (`queue_full_policy: drop`) or
+the request waits up to `block_timeout` seconds for room in the queue before
+dropping the log (`queue_full_policy: block`). The queue is flushed when the
+process exits.
+"""
+
+import atexit
+import queue
+import threading
+import time
+
+from cdislogging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+QUEUE_FULL_POLICIES = ["drop", "block"]
+
+# queued by `stop` to wake up the worker thread
+_WAKE_UP = object()
+
+
+class AuditLogShipper(object):
+    """
+    Args:
+        send_batch (Callable[[list], list]): sends a list of
+            `(category, data)` tuples and returns the ones that could not be
+            sent. Called from the worker thread only
+        max_queue_size (int): maximum number of logs waiting to be sent
+        batch_size (int): maximum number of logs sent by `send_batch` at once
+        flush_interval (float): maximum time (in seconds) a log waits in the
+            queue before a (partial) batch is sent
+        queue_full_policy (str): "drop" or "block", see module docstring
+        block_timeout (float): with the "block" policy, maximum time (in
+            seconds) to wait for room in the queue
+    """
+
+    def __init__(
+        self,
+        send_batch,
+        max_queue_size=10000,
+        batch_size=10,
+        flush_interval=1,
+        queue_full_policy="drop",
+        block_timeout=1,
+    ):
+        if queue_full_policy not in QUEUE_FULL_POLICIES:
+            raise Exception(
+                f"Audit log shipping `queue_full_policy` '{queue_full_policy}' is not one of {QUEUE_FULL_POLICIES}"
+            )
+        self.send_batch = send_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_full_policy = queue_full_policy
+        self.block_timeout = block_timeout
+        self.metrics = {}
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, metrics=None):
+        """
+        Start the worker thread if it is not running yet. The thread is only
+        started on first use so it is created in each uWSGI worker, after the
+        fork.
+
+        Args:
+            metrics (dict): Prometheus metrics, captured here because the
+                worker thread runs outside of the app context
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.metrics = metrics or {}
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="audit-log-shipper", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def put(self, category, data):
+        """
+        Queue an audit log.
+
+        Return:
+            bool: whether the log was queued (False if it was dropped)
+        """
+        try:
+            if self.queue_full_policy == "block":
+                self._queue.put((category, data), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((category, data))
+        except queue.Full:
+            logger.error(
+                f"Audit log queue is full: dropping {category} audit log {data}"
+            )
+            self._count_dropped("queue_full", 1)
+            return False
+        self._set_queue_depth()
+        return True
+
+    def stop(self, timeout=10):
+        """
+        Stop the worker thread after it has sent the queued logs.
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stop_event.set()
+            try:
+                self._queue.put_nowait(_WAKE_UP)
+            except queue.Full:
+                # the worker is not waiting for logs
+                pass
+            thread.join(timeout)
+            self._thread = None
+        try:
+            atexit.unregister(self.stop)
+        except Exception:
+            pass
+        if not self._queue.empty():
+            logger.error(
+                f"Stopped the audit log shipper with {self._queue.qsize()} logs left in the queue"
+            )
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+            elif self._stop_event.is_set():
+                return
+
+    def _next_batch(self):
+        """
+        Wait for the first log, then for more logs until the batch is full or
+        `flush_interval` is over. When stopping, return whatever is left
+        without waiting.
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if self._stop_event.is_set():
+                timeout = 0
+            elif deadline is None:
+                timeout = self.flush_interval
+            else:
+                timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                if batch or self._stop_event.is_set():
+                    break
+                continue
+            if item is _WAKE_UP:
+                continue
+            batch.append(item)
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+        return batch
+
+    def _flush(self, batch):
+        start = time.time()
+        try:
+            failed = self.send_batch(batch) or []
+        except Exception as e:
+            logger.error(f"Unable to ship {len(batch)} audit logs: {e}")
+            failed = batch
+        if failed:
+            self._count_dropped("send_error", len(failed))
+
+        histogram = self.metrics.get("audit_log_flush_duration")
+        if histogram:
+            histogram.observe(time.time() - start)
+        self._set_queue_depth()
+
+    def _set_queue_depth(self):
+        gauge = self.metrics.get("audit_log_queue_depth")
+        if gauge:
+            gauge.set(self._queue.qsize())
+
+    def _count_dropped(self, reason, count):
+        counter = self.metrics.get("audit_log_dropped")
+        if counter:
+            counter.labels(reason).inc(count)
@@ -57,6 +57,15 @@ def create_audit_log_for_request(response):
                 action="download",
                 **audit_data,
             )
+        elif method == "POST" and endpoint.rstrip("/") == "/data/download":
+            # bulk presigned URL request: one log per requested file
+            for file_audit_data in getattr(flask.g, "bulk_audit_data", []):
+                flask.current_app.audit_service_client.create_presigned_url_log(
+                    request_url=request_url,
+                    action="download",
+                    **audit_data,
+                    **file_audit_data,
+                )
         elif method == "GET" and endpoint.startswith("/login/"):
             request_url = _clean_authorization_request_url(request_url)
             if audit_data:  # ignore login calls with no `username`/`sub`/`idp`
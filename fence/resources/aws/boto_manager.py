@@ -1,11 +1,59 @@
+import threading
+import time
 import uuid
 
 from boto3 import client
 from boto3.exceptions import Boto3Error
 
+from fence.cache import MISSING, TTLCache
 from fence.errors import UserError, InternalError, UnavailableError, NotFound
 
 
+class BotoClientCache(object):
+    """
+    Thread-safe cache of the boto3 clients, keyed by service and credentials
+    (access key, secret, session token, region, endpoint...), so that a
+    client is not built for every call made with non-default credentials.
+
+    Clients built with temporary credentials (with an `aws_session_token`)
+    are evicted after `session_ttl` seconds, since the credentials expire;
+    the other clients are evicted after `ttl` seconds. The least recently
+    used clients are evicted first when there are more than `max_size`.
+
+    Args:
+        max_size (int): maximum number of clients
+        ttl (int): number of seconds a client is kept for
+        session_ttl (int): number of seconds a client built with temporary
+            credentials is kept for
+        timer (Callable[[], float]): clock, overridable for testing
+    """
+
+    def __init__(self, max_size=128, ttl=3600, session_ttl=900, timer=time.time):
+        self.session_ttl = min(ttl, session_ttl)
+        self._clients = TTLCache(max_size=max_size, ttl=ttl, timer=timer)
+        self._lock = threading.Lock()
+
+    def get(self, service, config):
+        key = (service,) + tuple(sorted(config.items()))
+        boto_client = self._clients.get(key)
+        if boto_client is not MISSING:
+            return boto_client
+        with self._lock:
+            # the client may have been built while waiting for the lock
+            boto_client = self._clients.get(key)
+            if boto_client is MISSING:
+                boto_client = client(service, **config)
+                ttl = self.session_ttl if config.get("aws_session_token") else None
+                self._clients.set(key, boto_client, ttl=ttl)
+        return boto_client
+
+    def clear(self):
+        self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
+
+
 class BotoManager(object):
     """
     AWS manager singleton.
@@ -17,13 +65,23 @@ class BotoManager(object):
         900  # minimum time for aws assume role is 900 seconds as per boto docs
     )
 
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, client_cache_settings=None):
         self.sts_client = client("sts", **config)
         self.s3_client = client("s3", **config)
+        self.clients = BotoClientCache(**(client_cache_settings or {}))
         self.logger = logger
         self.ec2 = None
         self.iam = None
 
+    def _get_client(self, service, config):
+        """
+        Return the default client of the service, or a cached client for the
+        credentials in `config` if it has an `aws_access_key_id`.
+        """
+        if config and "aws_access_key_id" in config:
+            return self.clients.get(service, config)
+        return self.sts_client if service == "sts" else self.s3_client
+
     def delete_data_file(self, bucket, prefix):
         """
         We use buckets with versioning disabled.
@@ -66,13 +124,12 @@ class BotoManager(object):
             duration_seconds
         ), 'assume_role() cannot be called without "duration_seconds" parameter; please check your "expires_in" parameters'
         try:
-            if config and "aws_access_key_id" in config:
-                self.sts_client = client("sts", **config)
+            sts_client = self._get_client("sts", config)
             session_name_postfix = uuid.uuid4()
             duration_seconds = max(
                 self.AWS_ASSUME_ROLE_MIN_EXPIRATION, duration_seconds
             )  # Since minimum time for aws assume role is 900 seconds as per boto docs
-            return self.sts_client.assume_role(
+            return sts_client.assume_role(
                 RoleArn=role_arn,
                 DurationSeconds=duration_seconds,
                 RoleSessionName="{}-{}".format("gen3", session_name_postfix),
@@ -95,22 +152,20 @@ class BotoManager(object):
         """
         if method not in ["get_object", "put_object"]:
             raise UserError("method {} not allowed".format(method))
-        if "aws_access_key_id" in config:
-            self.s3_client = client("s3", **config)
+        s3_client = self._get_client("s3", config)
         expires = int(expires) or self.URL_EXPIRATION_DEFAULT
         expires = min(expires, self.URL_EXPIRATION_MAX)
         params = {"Bucket": bucket, "Key": key}
         if method == "put_object":
             params["ServerSideEncryption"] = "AES256"
-        return self.s3_client.generate_presigned_url(
+        return s3_client.generate_presigned_url(
             ClientMethod=method, Params=params, ExpiresIn=expires
         )
 
     def get_bucket_region(self, bucket, config):
         try:
-            if "aws_access_key_id" in config:
-                self.s3_client = client("s3", **config)
-            response = self.s3_client.get_bucket_location(Bucket=bucket)
+            s3_client = self._get_client("s3", config)
+            response = s3_client.get_bucket_location(Bucket=bucket)
             region = response.get("LocationConstraint")
         except Boto3Error as ex:
             self.logger.exception(ex)
@@ -0,0 +1,105 @@
+"""
+Cache of the regions of the S3 buckets.
+
+Signing a URL requires the region of the bucket. When a bucket in `S3_BUCKETS`
+has no `region` (and no `endpoint_url`), its region is discovered with a
+GetBucketLocation call to AWS. The discovered regions are kept in memory and
+in the `s3_bucket_region_cache` DB table, so they are shared by all the
+workers and survive restarts, for `S3_BUCKET_REGION_CACHE.ttl` seconds.
+
+The regions of the configured buckets are fetched in parallel when the app
+starts (see `fence._warm_up_s3_bucket_regions`), so that requests do not wait
+for AWS.
+"""
+
+import re
+import time
+
+from cdislogging import get_logger
+
+from fence.cache import TTLCache
+from fence.models import S3BucketRegionCache
+
+
+logger = get_logger(__name__)
+
+# valid S3 bucket names, as opposed to the patterns allowed in `S3_BUCKETS`
+S3_BUCKET_NAME_REGEX = re.compile(r"^[a-z0-9][a-z0-9.-]{1,61}[a-z0-9]$")
+
+
+class S3BucketRegions(object):
+    """
+    Args:
+        max_size (int): maximum number of regions kept in memory
+        ttl (int): number of seconds a discovered region is cached for
+        timer (Callable[[], float]): clock, overridable for testing
+    """
+
+    def __init__(self, max_size=10000, ttl=86400, timer=time.time):
+        self.ttl = ttl
+        self._timer = timer
+        self._regions = TTLCache(max_size=max_size, ttl=ttl, timer=timer)
+
+    def get_region(self, bucket_name, credential, boto, db=None):
+        """
+        Return the region of the bucket from the memory cache, or else from
+        the DB cache, or else from AWS.
+
+        Args:
+            bucket_name (str): name of the bucket (not a `S3_BUCKETS` pattern)
+            credential (dict): AWS credentials allowed to get the bucket location
+            boto (BotoManager): used to get the bucket location
+            db (SQLAlchemyDriver): database with the DB cache. If None, the
+                regions are only cached in memory
+
+        Return:
+            str: the bucket region
+        """
+        region = self._regions.get(bucket_name, None)
+        if region:
+            return region
+
+        expires_at = None
+        if db is not None:
+            region, expires_at = self._get_from_db(db, bucket_name)
+        if not region:
+            region = boto.get_bucket_region(bucket_name, credential)
+            expires_at = int(self._timer()) + self.ttl
+            if db is not None:
+                self._store_in_db(db, bucket_name, region, expires_at)
+
+        self._regions.set(bucket_name, region, ttl=expires_at - self._timer())
+        return region
+
+    def _get_from_db(self, db, bucket_name):
+        try:
+            with db.session as session:
+                cached = (
+                    session.query(S3BucketRegionCache)
+                    .filter(S3BucketRegionCache.bucket_name == bucket_name)
+                    .first()
+                )
+                if cached and cached.expires_at and cached.expires_at > self._timer():
+                    return cached.region, cached.expires_at
+        except Exception as e:
+            logger.warning(
+                "Unable to get the region of bucket {} from the database: {}".format(
+                    bucket_name, e
+                )
+            )
+        return None, None
+
+    def _store_in_db(self, db, bucket_name, region, expires_at):
+        try:
+            with db.session as session:
+                session.merge(
+                    S3BucketRegionCache(
+                        bucket_name=bucket_name, region=region, expires_at=expires_at
+                    )
+                )
+        except Exception as e:
+            logger.warning(
+                "Unable to store the region of bucket {} in the database: {}".format(
+                    bucket_name, e
+                )
+            )
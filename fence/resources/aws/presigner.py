@@ -0,0 +1,161 @@
+"""
+In-process AWS Signature Version 4 presigning of S3 URLs.
+
+Presigning a URL only requires HMAC-SHA256 computations, but the signing key
+derived from the secret key takes 4 HMACs and only depends on the secret key,
+the date, the region and the service. The signing keys are cached so that
+signing a URL takes 2 hashes, without any network call or boto3 client.
+
+The URLs are the same, byte for byte, as the ones generated by
+`cdispyutils.hmac4.generate_aws_presigned_url`, which this module replaces on
+the signed URL paths.
+"""
+
+import datetime
+import hashlib
+import hmac
+from urllib.parse import quote
+
+from fence.cache import MISSING, TTLCache
+
+
+AWS_ALGORITHM = "AWS4-HMAC-SHA256"
+AWS_REQUEST = "aws4_request"
+FULL_DATE_TIME_FORMAT = "%Y%m%dT%H%M%SZ"
+ABRIDGED_DATE_TIME_FORMAT = "%Y%m%d"
+
+
+def _sign(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+class SigV4Presigner(object):
+    """
+    Thread-safe presigner, caching the signing keys.
+
+    Args:
+        max_size (int): maximum number of cached signing keys
+    """
+
+    # a signing key is only valid on its date
+    SIGNING_KEY_TTL = 86400 * 2
+
+    def __init__(self, max_size=1024):
+        self._signing_keys = TTLCache(max_size=max_size, ttl=self.SIGNING_KEY_TTL)
+
+    def get_signing_key(self, secret_key, date, region, service):
+        """
+        Return the signing key derived from the secret key for the date (as
+        YYYYMMDD), region and service.
+        """
+        cache_key = (secret_key, date, region, service)
+        signing_key = self._signing_keys.get(cache_key)
+        if signing_key is MISSING:
+            signing_key = _sign(("AWS4" + secret_key).encode("utf-8"), date)
+            if region is not None:
+                signing_key = _sign(signing_key, region)
+            signing_key = _sign(_sign(signing_key, service), AWS_REQUEST)
+            self._signing_keys.set(cache_key, signing_key)
+        return signing_key
+
+    def presign(
+        self,
+        url,
+        method,
+        credential,
+        service,
+        region,
+        expires,
+        additional_signed_qs,
+        request_date=None,
+    ):
+        """
+        Return the URL presigned with the credential.
+
+        Args:
+            url (str): URL to sign, for example `https://bucket.s3.amazonaws.com/key`
+            method (str): HTTP method the URL is signed for
+            credential (dict): `aws_access_key_id`, `aws_secret_access_key` and
+                optionally `aws_session_token`
+            service (str): AWS service, for example "s3"
+            region (str): AWS region. If None, the region is not part of the
+                credential scope
+            expires (int): number of seconds the URL is valid for
+            additional_signed_qs (dict): query parameters to add and sign
+            request_date (datetime.datetime): signing time (UTC), now by default
+
+        Returns:
+            str: the presigned URL
+        """
+        request_date = request_date or datetime.datetime.utcnow()
+        date = request_date.strftime(ABRIDGED_DATE_TIME_FORMAT)
+        amz_date = request_date.strftime(FULL_DATE_TIME_FORMAT)
+        signing_key = self.get_signing_key(
+            credential.get("aws_secret_access_key"), date, region, service
+        )
+
+        credential_scope = "/".join(
+            part for part in (date, region, service, AWS_REQUEST) if part is not None
+        )
+        querystring = {
+            "X-Amz-Algorithm": AWS_ALGORITHM,
+            "X-Amz-Credential": quote(
+                credential.get("aws_access_key_id") + "/" + credential_scope, safe=""
+            ),
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(expires),
+            "X-Amz-SignedHeaders": "host",
+        }
+        session_token = credential.get("aws_session_token")
+        if session_token:
+            querystring["X-Amz-Security-Token"] = quote(session_token, safe="")
+        canonical_qs = "&".join(
+            key + "=" + querystring[key] for key in sorted(querystring)
+        )
+        for key in sorted(additional_signed_qs):
+            canonical_qs += "&" + key + "=" + quote(additional_signed_qs[key], safe="")
+
+        url_parts = url.split("://")
+        encoded_url = "://".join(quote(part) for part in url_parts)
+        # sign the non-escaped URL, like the provider does with the non-escaped
+        # file name
+        host, _, path = url_parts[1].partition("/")
+        canonical_uri = quote("/" + path)
+        canonical_request = "\n".join(
+            [
+                method.upper(),
+                canonical_uri,
+                canonical_qs,
+                "host:" + host + "\n",
+                "host",
+                "UNSIGNED-PAYLOAD",
+            ]
+        )
+        string_to_sign = "\n".join(
+            [
+                AWS_ALGORITHM,
+                amz_date,
+                credential_scope,
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            ]
+        )
+        signature = hmac.new(
+            signing_key, string_to_sign.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+
+        return encoded_url + "?" + canonical_qs + "&X-Amz-Signature=" + signature
+
+
+_presigner = SigV4Presigner()
+
+
+def generate_aws_presigned_url(
+    url, method, cred, service, region, expires, additional_signed_qs
+):
+    """
+    Drop-in replacement for `cdispyutils.hmac4.generate_aws_presigned_url`,
+    using the shared signing key cache.
+    """
+    return _presigner.presign(
+        url, method, cred, service, region, expires, additional_signed_qs
+    )
@@ -0,0 +1,159 @@
+"""
+Resolution of S3 bucket names to their `S3_BUCKETS` configuration.
+
+The keys of `S3_BUCKETS` are regular expressions matched against the whole
+bucket name. Instead of trying every key for every signed URL, an index is
+built once per configuration (when the app config is loaded): bucket names
+that are keys of `S3_BUCKETS` are found with a dict lookup, and the other
+names are matched against a single compiled alternation of the patterns.
+Resolutions are memoized, along with the endpoint URL and region of the
+bucket.
+
+Usage:
+
+    from fence.resources.aws.s3_buckets import get_s3_bucket_index
+    bucket = get_s3_bucket_index(config["S3_BUCKETS"]).resolve(bucket_name)
+"""
+
+from collections import namedtuple
+import functools
+import re
+import threading
+
+from cdislogging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+#: `name` is the matching key of `S3_BUCKETS` (None if the bucket is not
+#: configured) and `config` its value
+ResolvedS3Bucket = namedtuple(
+    "ResolvedS3Bucket", ["name", "config", "endpoint_url", "region"]
+)
+
+UNCONFIGURED_BUCKET = ResolvedS3Bucket(None, None, None, None)
+
+# name of the group of each pattern in the combined expression
+_GROUP_PREFIX = "_fence_bucket_"
+
+
+class S3BucketIndex(object):
+    """
+    Args:
+        s3_buckets (dict): the `S3_BUCKETS` configuration
+        max_resolutions (int): maximum number of memoized resolutions
+    """
+
+    def __init__(self, s3_buckets, max_resolutions=10000):
+        self.s3_buckets = s3_buckets
+
+        # keys that match themselves: a lookup of the bucket name is enough.
+        # when several keys match a name, the first one in `S3_BUCKETS` wins
+        self._exact = {}
+        # keys that can match other names, in the `S3_BUCKETS` order
+        self._pattern_keys = []
+        for key in s3_buckets:
+            try:
+                matches_itself = re.fullmatch(key, key) is not None
+            except re.error as e:
+                logger.error(
+                    "S3_BUCKETS key '{}' is not a valid regular expression: {}".format(
+                        key, e
+                    )
+                )
+                self._exact.setdefault(key, key)
+                continue
+            if matches_itself:
+                self._exact.setdefault(key, key)
+            if re.escape(key) != key:
+                self._pattern_keys.append(key)
+        self._patterns = self._compile_patterns(self._pattern_keys)
+
+        self.resolve = functools.lru_cache(maxsize=max_resolutions)(self._resolve)
+
+    @staticmethod
+    def _compile_patterns(pattern_keys):
+        """
+        Compile the patterns into a single regular expression, with one named
+        group per pattern to know which one matched. If the patterns cannot be
+        combined (for example if several of them define the same group name),
+        they are compiled separately.
+
+        Return:
+            List[Tuple[re.Pattern, Optional[List[str]]]]: compiled expressions,
+                and the keys matching their groups for a combined expression
+        """
+        if not pattern_keys:
+            return []
+        try:
+            expression = re.compile(
+                "|".join(
+                    "(?P<{}{}>{})".format(_GROUP_PREFIX, i, key)
+                    for i, key in enumerate(pattern_keys)
+                )
+            )
+            return [(expression, pattern_keys)]
+        except re.error as e:
+            logger.warning(
+                "Unable to combine the S3_BUCKETS patterns, matching them one by one: {}".format(
+                    e
+                )
+            )
+        compiled = []
+        for key in pattern_keys:
+            try:
+                compiled.append((re.compile(key), None))
+            except re.error:
+                pass
+        return compiled
+
+    def _resolve(self, bucket_name):
+        """
+        Return:
+            ResolvedS3Bucket: the configuration of the bucket
+        """
+        key = self._exact.get(bucket_name)
+        if key is None:
+            key = self._match_patterns(bucket_name)
+        if key is None:
+            return UNCONFIGURED_BUCKET
+        bucket_config = self.s3_buckets[key]
+        return ResolvedS3Bucket(
+            name=key,
+            config=bucket_config,
+            endpoint_url=bucket_config.get("endpoint_url"),
+            region=bucket_config.get("region"),
+        )
+
+    def _match_patterns(self, bucket_name):
+        for expression, group_keys in self._patterns:
+            match = expression.fullmatch(bucket_name)
+            if not match:
+                continue
+            if group_keys is None:
+                return expression.pattern
+            return group_keys[int(match.lastgroup[len(_GROUP_PREFIX) :])]
+        return None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_s3_bucket_index(s3_buckets):
+    """
+    Return the index for the given `S3_BUCKETS` configuration. It is built
+    when the app config is loaded (or on first use), and rebuilt if another
+    `S3_BUCKETS` dict is given. The configuration is not modified in place,
+    so only the identity of the dict is checked.
+    """
+    global _index
+    index = _index
+    if index is None or index.s3_buckets is not s3_buckets:
+        with _index_lock:
+            index = _index
+            if index is None or index.s3_buckets is not s3_buckets:
+                index = S3BucketIndex(s3_buckets)
+                _index = index
+    return index
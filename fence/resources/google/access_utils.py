@@ -2,6 +2,10 @@
 Utilities for determine access and validity for service account
 registration.
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+import json
+import threading
 import time
 import flask
 from urllib.parse import unquote
@@ -37,24 +41,44 @@ from fence.utils import get_valid_expiration_from_request
 logger = get_logger(__name__)
 
 
-def bulk_update_google_groups(google_bulk_mapping):
+def bulk_update_google_groups(google_bulk_mapping, dry_run=None):
     """
     Update Google Groups based on mapping provided from Group -> Users.
 
+    The members of the groups are listed in parallel, then the membership
+    changes are applied in parallel in batches of
+    `GOOGLE_BULK_UPDATES_SETTINGS.batch_size` changes. Each of the
+    `GOOGLE_BULK_UPDATES_SETTINGS.max_workers` threads uses its own
+    GoogleCloudManager. The GoogleCloudManager methods retry the calls that
+    Google rate limits or fails.
+
     Args:
         google_bulk_mapping (dict): {"googlegroup@google.com": ["member1", "member2"]}
+        dry_run (bool): only compute and log the changes, without applying
+            them. Defaults to `GOOGLE_BULK_UPDATES_SETTINGS.dry_run`
+
+    Returns:
+        dict: {"googlegroup@google.com": {"add": ["member3"], "remove": ["member1"]}}
     """
+    settings = config.get("GOOGLE_BULK_UPDATES_SETTINGS") or {}
+    if dry_run is None:
+        dry_run = settings.get("dry_run", False)
+    max_workers = max(1, settings.get("max_workers", 10))
+    batch_size = max(1, settings.get("batch_size", 100))
     google_project_id = (
         config["STORAGE_CREDENTIALS"].get("google", {}).get("google_project_id")
     )
-    with GoogleCloudManager(google_project_id) as gcm:
-        for group, expected_members in google_bulk_mapping.items():
+
+    with _GoogleCloudManagers(google_project_id) as managers:
+
+        def get_changes(group, expected_members):
             expected_members = set(expected_members)
             logger.debug(f"Starting diff for group {group}...")
 
             # get members list from google
             google_members = set(
-                member.get("email") for member in gcm.get_group_members(group)
+                member.get("email")
+                for member in managers.get().get_group_members(group)
             )
             logger.debug(f"Google membership for {group}: {google_members}")
             logger.debug(f"Expected membership for {group}: {expected_members}")
@@ -65,16 +89,188 @@ def bulk_update_google_groups(google_bulk_mapping):
             no_update = set.intersection(google_members, expected_members)
 
             logger.info(f"All already in group {group}: {no_update}")
+            return group, {"add": sorted(to_add), "remove": sorted(to_delete)}
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            changes = dict(
+                executor.map(
+                    lambda item: get_changes(*item), google_bulk_mapping.items()
+                )
+            )
+        logger.info(
+            "Listed the members of {} Google groups in {:.2f}s: {} members to add, "
+            "{} members to remove".format(
+                len(changes),
+                time.time() - start,
+                sum(len(group_changes["add"]) for group_changes in changes.values()),
+                sum(len(group_changes["remove"]) for group_changes in changes.values()),
+            )
+        )
+
+        if dry_run:
+            logger.info(
+                "Dry run, not updating the Google groups. Changes: {}".format(
+                    json.dumps(
+                        {
+                            group: group_changes
+                            for group, group_changes in changes.items()
+                            if group_changes["add"] or group_changes["remove"]
+                        }
+                    )
+                )
+            )
+            return changes
+
+        def apply_changes(group, operations):
+            gcm = managers.get()
+            for operation, member_email in operations:
+                if operation == "add":
+                    logger.info(f"Adding to group {group}: {member_email}")
+                    gcm.add_member_to_group(member_email, group)
+                else:
+                    logger.info(f"Removing from group {group}: {member_email}")
+                    gcm.remove_member_from_group(member_email, group)
+
+        batches = []
+        for group, group_changes in changes.items():
+            operations = [("add", member) for member in group_changes["add"]] + [
+                ("remove", member) for member in group_changes["remove"]
+            ]
+            for i in range(0, len(operations), batch_size):
+                batches.append((group, operations[i : i + batch_size]))
+
+        start = time.time()
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(apply_changes, group, operations): group
+                for group, operations in batches
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(
+                        "Unable to update the members of Google group {}: {}".format(
+                            futures[future], e
+                        )
+                    )
+                    errors.append(e)
+        logger.info(
+            "Applied {} batches of Google group membership changes in {:.2f}s "
+            "({} failed)".format(len(batches), time.time() - start, len(errors))
+        )
+        if errors:
+            raise errors[0]
+
+    return changes
+
+
+def bulk_remove_expired_from_google(session, records, remove_from_google, name):
+    """
+    Remove expired access from Google, and delete the corresponding records
+    from the database.
+
+    The Google calls are made in parallel by
+    `GOOGLE_BULK_UPDATES_SETTINGS.max_workers` threads. The records
+    are deleted and committed by chunks of
+    `GOOGLE_BULK_UPDATES_SETTINGS.db_chunk_size`, so that an interrupted
+    sweep does not lose its progress.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): session the records were
+            loaded with. It is only used by the calling thread
+        records (List[Tuple[Any, tuple]]): (record, args) pairs. The args are
+            passed to `remove_from_google`, and should not be database objects
+            since they are used by other threads. A None record is not
+            deleted from the database
+        remove_from_google (Callable[..., bool]): called with a
+            GoogleCloudManager and the args of a record. Returns whether the
+            record should be deleted from the database
+        name (str): name of the sweep, for logging
+
+    Returns:
+        dict: {"processed": int, "deleted": int, "failed": int}
+    """
+    settings = config.get("GOOGLE_BULK_UPDATES_SETTINGS") or {}
+    max_workers = max(1, settings.get("max_workers", 10))
+    db_chunk_size = max(1, settings.get("db_chunk_size", 500))
+    summary = {"processed": 0, "deleted": 0, "failed": 0}
+    if not records:
+        logger.info("{}: nothing to remove".format(name))
+        return summary
+
+    start = time.time()
+    with _GoogleCloudManagers() as managers:
+
+        def remove(args):
+            return remove_from_google(managers.get(), *args)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(remove, args): (record, args)
+                for record, args in records
+            }
+            uncommitted = 0
+            for future in as_completed(futures):
+                record, args = futures[future]
+                summary["processed"] += 1
+                try:
+                    removed = future.result()
+                except Exception as e:
+                    logger.error(
+                        "{}: unable to remove {} from Google. Details: {}".format(
+                            name, args, e
+                        )
+                    )
+                    removed = False
+                if not removed:
+                    summary["failed"] += 1
+                    continue
+                if record is not None:
+                    session.delete(record)
+                    summary["deleted"] += 1
+                    uncommitted += 1
+                if uncommitted >= db_chunk_size:
+                    session.commit()
+                    uncommitted = 0
+    session.commit()
+
+    logger.info(
+        "{}: processed {processed}, deleted {deleted}, failed {failed} "
+        "in {seconds:.2f}s".format(name, seconds=time.time() - start, **summary)
+    )
+    return summary
+
+
+class _GoogleCloudManagers(object):
+    """
+    Open one GoogleCloudManager per thread, since the Google API clients are
+    not thread-safe, and close them all on exit.
+    """
+
+    def __init__(self, google_project_id=None):
+        self.google_project_id = google_project_id
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._exit_stack = ExitStack()
+
+    def get(self):
+        gcm = getattr(self._local, "gcm", None)
+        if gcm is None:
+            with self._lock:
+                gcm = self._exit_stack.enter_context(
+                    GoogleCloudManager(self.google_project_id)
+                )
+            self._local.gcm = gcm
+        return gcm
 
-            # do add
-            for member_email in to_add:
-                logger.info(f"Adding to group {group}: {member_email}")
-                gcm.add_member_to_group(member_email, group)
+    def __enter__(self):
+        return self
 
-            # do remove
-            for member_email in to_delete:
-                logger.info(f"Removing from group {group}: {member_email}")
-                gcm.remove_member_from_group(member_email, group)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._exit_stack.close()
 
 
 def get_google_project_number(google_project_id, google_cloud_manager):
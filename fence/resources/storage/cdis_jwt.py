@@ -1,13 +1,24 @@
+import hashlib
+import time
+
 import flask
 
 from fence.auth import get_user_from_claims
+from fence.cache import TTLCache
+from fence.config import config
 from fence.errors import Unauthorized
 from fence.jwt import token
+from fence.jwt.blacklist import is_blacklisted
 from fence.jwt.errors import JWTError
 from fence.jwt.validate import validate_jwt
 from fence.models import UserRefreshToken
 
 
+# process-wide cache of the access tokens issued for API keys, created on
+# first use (see `_get_api_key_access_token_cache`)
+_api_key_access_tokens = None
+
+
 def create_access_token(user, keypair, api_key, expires_in, scopes):
     try:
         claims = validate_jwt(api_key, scope=scopes, purpose="api_key")
@@ -42,9 +53,49 @@ def create_session_token(keypair, expires_in, context=None):
     ).token
 
 
+def _get_api_key_access_token_cache():
+    """
+    Return the process-wide cache of the access tokens issued for API keys,
+    or None if `API_KEY_ACCESS_TOKEN_CACHE` is disabled.
+
+    This cache is always kept in memory: sharing it (for example in Redis)
+    would allow anyone with access to it to get the users' access tokens.
+    """
+    global _api_key_access_tokens
+    cache_config = config.get("API_KEY_ACCESS_TOKEN_CACHE") or {}
+    if not cache_config.get("enabled"):
+        return None
+    if _api_key_access_tokens is None:
+        _api_key_access_tokens = TTLCache(
+            max_size=cache_config.get("max_size", 10000),
+            ttl=cache_config.get("max_age", 300),
+        )
+    return _api_key_access_tokens
+
+
+def _count_api_key_access_token_cache_request(result):
+    """
+    Increment the API key access token cache counter for gen3-metrics.
+
+    Args:
+        result (str): "hit" or "miss"
+    """
+    counter = getattr(flask.current_app, "prometheus_counters", {}).get(
+        "api_key_access_token_cache"
+    )
+    if counter:
+        counter.labels(result).inc()
+
+
 def create_user_access_token(keypair, api_key, expires_in):
     """
     create access token given a user's api key
+
+    If `API_KEY_ACCESS_TOKEN_CACHE` is enabled, an access token issued for
+    the same API key and a close `expires_in` less than `max_age` seconds ago
+    is returned instead of a new one, as long as the API key is not
+    blacklisted.
+
     Args:
         keypair: RSA keypair for signing jwt
         api_key: user created jwt token, the azp should match with user.id
@@ -52,6 +103,52 @@ def create_user_access_token(keypair, api_key, expires_in):
     Return:
         access token
     """
+    cache = _get_api_key_access_token_cache()
+    if cache is None:
+        return _create_user_access_token(keypair, api_key, expires_in)[0].token
+
+    # the scopes and the JWT id are the ones of the API key, which is part of
+    # the cache key: an entry can only be found by a caller knowing the key
+    cache_key = "{}:{}:{}".format(
+        hashlib.sha256(api_key.encode("utf-8")).hexdigest(),
+        keypair.kid,
+        expires_in // cache.ttl,
+    )
+    # only reuse tokens with at least half the requested lifetime left
+    reuse_window = min(cache.ttl, expires_in // 2)
+    cached = cache.get(cache_key, None)
+    if cached:
+        remaining = cached["exp"] - time.time()
+        if expires_in - reuse_window <= remaining <= expires_in:
+            # the blacklist is shared by all the workers, so a blacklisted
+            # API key is rejected everywhere
+            if not is_blacklisted(cached["api_key_jti"]):
+                _count_api_key_access_token_cache_request("hit")
+                return cached["token"]
+        cache.delete(cache_key)
+    _count_api_key_access_token_cache_request("miss")
+
+    jwt_result, api_key_claims = _create_user_access_token(keypair, api_key, expires_in)
+    ttl = min(reuse_window, int(api_key_claims["exp"] - time.time()))
+    if ttl > 0:
+        cache.set(
+            cache_key,
+            {
+                "token": jwt_result.token,
+                "exp": jwt_result.claims["exp"],
+                "api_key_jti": api_key_claims["jti"],
+            },
+            ttl=ttl,
+        )
+    return jwt_result.token
+
+
+def _create_user_access_token(keypair, api_key, expires_in):
+    """
+    Return:
+        Tuple[JWTResult, dict]: the new access token and the claims of the
+            API key
+    """
     try:
         claims = validate_jwt(api_key, scope={"fence"}, purpose="api_key")
         # scopes = claims["scope"]
@@ -69,6 +166,7 @@ def create_user_access_token(keypair, api_key, expires_in):
         user = get_user_from_claims(claims)
     except Exception as e:
         raise Unauthorized(str(e))
-    return token.generate_signed_access_token(
+    jwt_result = token.generate_signed_access_token(
         keypair.kid, keypair.private_key, user, expires_in, scopes
-    ).token
+    )
+    return jwt_result, claims
@@ -11,6 +11,7 @@ from cirrus.google_cloud.errors import GoogleAuthError
 from cirrus.config import config as cirrus_config
 from cdislogging import get_logger
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from userdatamodel.driver import SQLAlchemyDriver
 from userdatamodel.models import (
     AccessPrivilege,
@@ -36,6 +37,7 @@ from fence.jwt.token import (
     issued_and_expiration_times,
 )
 from fence.job.visa_update_cronjob import Visa_Token_Update
+from fence.resources.google.access_utils import bulk_remove_expired_from_google
 from fence.models import (
     Client,
     GoogleServiceAccount,
@@ -46,6 +48,7 @@ from fence.models import (
     GoogleProxyGroupToGoogleBucketAccessGroup,
     UserRefreshToken,
     ServiceAccountToGoogleBucketAccessGroup,
+    forget_verified_client_secrets,
     query_for_user,
     migrate,
 )
@@ -166,6 +169,7 @@ def delete_client_action(DB, client_name):
                 _remove_client_service_accounts(current_session, client)
                 current_session.delete(client)
             current_session.commit()
+        forget_verified_client_secrets()
 
         logger.info("Client {} deleted".format(client_name))
     except Exception as e:
@@ -212,6 +216,7 @@ def init_syncer(
     folder=None,
     sync_from_visas=False,
     fallback_to_dbgap_sftp=False,
+    full_rebuild=False,
 ):
     """
     sync ACL files from dbGap to auth db and storage backends
@@ -221,6 +226,8 @@ def init_syncer(
     Args:
         projects: path to project_mapping yaml file which contains mapping
         from dbgap phsids to projects in fence database
+        full_rebuild: sync all the users even if USERSYNC.incremental_sync
+        is enabled
     Returns:
         None
     Examples:
@@ -272,6 +279,7 @@ def init_syncer(
         folder=folder,
         sync_from_visas=sync_from_visas,
         fallback_to_dbgap_sftp=fallback_to_dbgap_sftp,
+        full_rebuild=full_rebuild,
     )
 
 
@@ -315,6 +323,7 @@ def sync_users(
     folder=None,
     sync_from_visas=False,
     fallback_to_dbgap_sftp=False,
+    full_rebuild=False,
 ):
     syncer = init_syncer(
         dbGaP,
@@ -328,6 +337,7 @@ def sync_users(
         folder,
         sync_from_visas,
         fallback_to_dbgap_sftp,
+        full_rebuild,
     )
     if not syncer:
         exit(1)
@@ -538,70 +548,86 @@ def remove_expired_google_service_account_keys(db):
 
     db = SQLAlchemyDriver(db)
     with db.session as current_session:
-        client_service_accounts = current_session.query(
-            GoogleServiceAccount, Client
-        ).filter(GoogleServiceAccount.client_id == Client.client_id)
+        client_service_accounts = (
+            current_session.query(GoogleServiceAccount)
+            .join(Client, GoogleServiceAccount.client_id == Client.client_id)
+            .order_by(GoogleServiceAccount.id)
+            .all()
+        )
 
         current_time = int(time.time())
         logger.info("Current time: {}\n".format(current_time))
 
-        expired_sa_keys_for_users = current_session.query(
-            GoogleServiceAccountKey
-        ).filter(GoogleServiceAccountKey.expires <= current_time)
+        expired_sa_keys_for_users = (
+            current_session.query(GoogleServiceAccountKey)
+            .options(joinedload(GoogleServiceAccountKey.google_service_account))
+            .filter(GoogleServiceAccountKey.expires <= current_time)
+            .order_by(GoogleServiceAccountKey.id)
+            .all()
+        )
 
-        with GoogleCloudManager() as g_mgr:
-            # handle service accounts with default max expiration
-            for service_account, client in client_service_accounts:
-                g_mgr.handle_expired_service_account_keys(service_account.email)
-
-            # handle service accounts with custom expiration
-            for expired_user_key in expired_sa_keys_for_users:
-                logger.info("expired_user_key: {}\n".format(expired_user_key))
-                sa = (
-                    current_session.query(GoogleServiceAccount)
-                    .filter(
-                        GoogleServiceAccount.id == expired_user_key.service_account_id
+        # handle service accounts with default max expiration
+        def handle_expired_keys(g_mgr, service_account_email):
+            g_mgr.handle_expired_service_account_keys(service_account_email)
+            return True
+
+        bulk_remove_expired_from_google(
+            current_session,
+            [(None, (sa.email,)) for sa in client_service_accounts],
+            handle_expired_keys,
+            "Expired client service account keys",
+        )
+
+        # handle service accounts with custom expiration
+        def delete_key(g_mgr, key_id, sa_email, sa_user_id):
+            response = g_mgr.delete_service_account_key(
+                account=sa_email, key_name=key_id
+            )
+            response_error_code = response.get("error", {}).get("code")
+            response_error_status = response.get("error", {}).get("status")
+
+            if not response_error_code:
+                logger.info(
+                    "INFO: Removed expired service account key {} "
+                    "for service account {} (owned by user with id {}).\n".format(
+                        key_id, sa_email, sa_user_id
                     )
-                    .first()
                 )
-
-                response = g_mgr.delete_service_account_key(
-                    account=sa.email, key_name=expired_user_key.key_id
+                return True
+            elif (
+                response_error_code == 404
+                or response_error_status == "FAILED_PRECONDITION"
+            ):
+                logger.info(
+                    "INFO: Service account key {} for service account {} "
+                    "(owned by user with id {}) does not exist in Google. "
+                    "Removing from database...\n".format(key_id, sa_email, sa_user_id)
                 )
-                response_error_code = response.get("error", {}).get("code")
-                response_error_status = response.get("error", {}).get("status")
-                logger.info("response_error_code: {}\n".format(response_error_code))
-                logger.info("response_error_status: {}\n".format(response_error_status))
-
-                if not response_error_code:
-                    current_session.delete(expired_user_key)
-                    logger.info(
-                        "INFO: Removed expired service account key {} "
-                        "for service account {} (owned by user with id {}).\n".format(
-                            expired_user_key.key_id, sa.email, sa.user_id
-                        )
-                    )
-                elif (
-                    response_error_code == 404
-                    or response_error_status == "FAILED_PRECONDITION"
-                ):
-                    logger.info(
-                        "INFO: Service account key {} for service account {} "
-                        "(owned by user with id {}) does not exist in Google. "
-                        "Removing from database...\n".format(
-                            expired_user_key.key_id, sa.email, sa.user_id
-                        )
-                    )
-                    current_session.delete(expired_user_key)
-                else:
-                    logger.error(
-                        "ERROR: Google returned an error when attempting to "
-                        "remove service account key {} "
-                        "for service account {} (owned by user with id {}). "
-                        "Error:\n{}\n".format(
-                            expired_user_key.key_id, sa.email, sa.user_id, response
-                        )
-                    )
+                return True
+            logger.error(
+                "ERROR: Google returned an error when attempting to "
+                "remove service account key {} "
+                "for service account {} (owned by user with id {}). "
+                "Error:\n{}\n".format(key_id, sa_email, sa_user_id, response)
+            )
+            return False
+
+        bulk_remove_expired_from_google(
+            current_session,
+            [
+                (
+                    key,
+                    (
+                        key.key_id,
+                        key.google_service_account.email,
+                        key.google_service_account.user_id,
+                    ),
+                )
+                for key in expired_sa_keys_for_users
+            ],
+            delete_key,
+            "Expired service account keys",
+        )
 
 
 def remove_expired_google_accounts_from_proxy_groups(db):
@@ -612,50 +638,50 @@ def remove_expired_google_accounts_from_proxy_groups(db):
         current_time = int(time.time())
         logger.info("Current time: {}".format(current_time))
 
-        expired_accounts = current_session.query(UserGoogleAccountToProxyGroup).filter(
-            UserGoogleAccountToProxyGroup.expires <= current_time
+        expired_accounts = (
+            current_session.query(UserGoogleAccountToProxyGroup)
+            .options(joinedload(UserGoogleAccountToProxyGroup.user_google_account))
+            .filter(UserGoogleAccountToProxyGroup.expires <= current_time)
+            .order_by(UserGoogleAccountToProxyGroup.id)
+            .all()
         )
 
-        with GoogleCloudManager() as g_mgr:
-            for expired_account_access in expired_accounts:
-                g_account = (
-                    current_session.query(UserGoogleAccount)
-                    .filter(
-                        UserGoogleAccount.id
-                        == expired_account_access.user_google_account_id
+        def remove_from_proxy_group(g_mgr, member_email, proxy_group_id):
+            response = g_mgr.remove_member_from_group(
+                member_email=member_email, group_id=proxy_group_id
+            )
+            response_error_code = response.get("error", {}).get("code")
+
+            if not response_error_code:
+                logger.info(
+                    "INFO: Removed {} from proxy group with id {}.\n".format(
+                        member_email, proxy_group_id
                     )
-                    .first()
                 )
-                try:
-                    response = g_mgr.remove_member_from_group(
-                        member_email=g_account.email,
-                        group_id=expired_account_access.proxy_group_id,
-                    )
-                    response_error_code = response.get("error", {}).get("code")
-
-                    if not response_error_code:
-                        current_session.delete(expired_account_access)
-                        logger.info(
-                            "INFO: Removed {} from proxy group with id {}.\n".format(
-                                g_account.email, expired_account_access.proxy_group_id
-                            )
-                        )
-                    else:
-                        logger.error(
-                            "ERROR: Google returned an error when attempting to "
-                            "remove member {} from proxy group {}. Error:\n{}\n".format(
-                                g_account.email,
-                                expired_account_access.proxy_group_id,
-                                response,
-                            )
-                        )
-                except Exception as exc:
-                    logger.error(
-                        "ERROR: Google returned an error when attempting to "
-                        "remove member {} from proxy group {}. Error:\n{}\n".format(
-                            g_account.email, expired_account_access.proxy_group_id, exc
-                        )
-                    )
+                return True
+            logger.error(
+                "ERROR: Google returned an error when attempting to "
+                "remove member {} from proxy group {}. Error:\n{}\n".format(
+                    member_email, proxy_group_id, response
+                )
+            )
+            return False
+
+        bulk_remove_expired_from_google(
+            current_session,
+            [
+                (
+                    expired_account_access,
+                    (
+                        expired_account_access.user_google_account.email,
+                        expired_account_access.proxy_group_id,
+                    ),
+                )
+                for expired_account_access in expired_accounts
+            ],
+            remove_from_proxy_group,
+            "Expired Google accounts in proxy groups",
+        )
 
 
 def delete_users(DB, usernames):
@@ -685,30 +711,31 @@ def delete_expired_service_accounts(DB):
         current_time = int(time.time())
         records_to_delete = (
             session.query(ServiceAccountToGoogleBucketAccessGroup)
+            .options(
+                joinedload(ServiceAccountToGoogleBucketAccessGroup.service_account),
+                joinedload(ServiceAccountToGoogleBucketAccessGroup.access_group),
+            )
             .filter(ServiceAccountToGoogleBucketAccessGroup.expires < current_time)
+            .order_by(ServiceAccountToGoogleBucketAccessGroup.id)
             .all()
         )
-        if len(records_to_delete):
-            with GoogleCloudManager() as manager:
-                for record in records_to_delete:
-                    try:
-                        manager.remove_member_from_group(
-                            record.service_account.email, record.access_group.email
-                        )
-                        session.delete(record)
-                        logger.info(
-                            "Removed expired service account: {}".format(
-                                record.service_account.email
-                            )
-                        )
-                    except Exception as e:
-                        logger.error(
-                            "ERROR: Could not delete service account {}. Details: {}".format(
-                                record.service_account.email, e
-                            )
-                        )
 
-                session.commit()
+        def remove_from_access_group(manager, service_account_email, group_email):
+            manager.remove_member_from_group(service_account_email, group_email)
+            logger.info(
+                "Removed expired service account: {}".format(service_account_email)
+            )
+            return True
+
+        bulk_remove_expired_from_google(
+            session,
+            [
+                (record, (record.service_account.email, record.access_group.email))
+                for record in records_to_delete
+            ],
+            remove_from_access_group,
+            "Expired service accounts",
+        )
 
 
 def verify_bucket_access_group(DB):
@@ -5,6 +5,9 @@ This file contains scripts to monitor user-registered service accounts and
 their respective Google projects. The functions in this file will also
 handle invalid service accounts and projects.
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
 import traceback
 
 from cirrus.google_cloud.iam import GooglePolicyMember
@@ -20,6 +23,7 @@ from fence.resources.google.validity import (
 
 from fence.resources.google.utils import (
     get_all_registered_service_accounts,
+    get_db_session,
     get_linked_google_account_email,
     is_google_managed_service_account,
 )
@@ -36,7 +40,7 @@ from fence.resources.google.access_utils import (
 
 from fence import utils
 from fence.config import config
-from fence.models import User
+from fence.models import GoogleMonitorProgress, User
 from fence.errors import Unauthorized
 
 logger = get_logger(__name__)
@@ -52,145 +56,351 @@ def validation_check(db):
     itself is invalid.
 
     NOTE: This entire function should be time-efficient and finish in less
-          than 90 seconds.
-          TODO: Test this function with various amounts of service accounts
-                and delays from the google API
+          than 90 seconds. The projects are validated in parallel by up to
+          `GOOGLE_MONITOR.max_workers` threads, the Google API responses are
+          cached for the duration of the run, and the projects that are not
+          started within `GOOGLE_MONITOR.time_budget` seconds are skipped.
+          The projects that were validated the longest time ago are
+          validated first, so the skipped projects are validated by the next
+          run.
     """
+    monitor_config = config.get("GOOGLE_MONITOR") or {}
+    max_workers = max(1, monitor_config.get("max_workers", 10))
+    time_budget = monitor_config.get("time_budget")
+    start = time.time()
+
     registered_service_accounts = get_all_registered_service_accounts(db=db)
     project_service_account_mapping = _get_project_service_account_mapping(
         registered_service_accounts
     )
+    google_project_ids = _get_google_projects_in_validation_order(
+        project_service_account_mapping, db=db
+    )
+    google_api_cache = _GoogleAPICache()
+
+    def validate(google_project_id):
+        if time_budget and time.time() - start > time_budget:
+            return False
+        _validate_google_project(
+            google_project_id,
+            project_service_account_mapping[google_project_id],
+            google_api_cache,
+            db=db,
+        )
+        return True
 
-    for google_project_id, sa_emails in project_service_account_mapping.items():
-        email_required = False
-        invalid_registered_service_account_reasons = {}
-        invalid_project_reasons = {}
-        sa_emails_removed = []
-        for sa_email in sa_emails:
-            logger.debug("Validating Google Service Account: {}".format(sa_email))
-            # Do some basic service account checks, this won't validate
-            # the data access, that's done when the project's validated
+    validated = []
+    if db is None or max_workers == 1:
+        # without `db`, the DB session is the flask session of the current
+        # thread, so the projects are validated one by one
+        for google_project_id in google_project_ids:
             try:
-                validity_info = _is_valid_service_account(sa_email, google_project_id)
-            except Unauthorized:
-                """
-                is_validity_service_account can raise an exception if the monitor does
-                not have access, which will be caught and handled during the Project check below
-                The logic in the endpoints is reversed (Project is checked first,
-                not SAs) which is why there's is a sort of weird handling of it here.
-                """
-                logger.info(
-                    "Monitor does not have access to validate "
-                    "service account {}. This should be handled "
-                    "in project validation.".format(sa_email)
-                )
-                continue
-
-            if not validity_info:
-                logger.info(
-                    "INVALID SERVICE ACCOUNT {} DETECTED. REMOVING. Validity Information: {}".format(
-                        sa_email, str(getattr(validity_info, "_info", None))
+                if validate(google_project_id):
+                    validated.append(google_project_id)
+            except Exception as e:
+                logger.error(
+                    "Unable to validate Google project {}: {}".format(
+                        google_project_id, e
                     )
                 )
-                force_remove_service_account_from_access(
-                    sa_email, google_project_id, db=db
-                )
-                if validity_info["policy_accessible"] is False:
-                    logger.info(
-                        "SERVICE ACCOUNT POLICY NOT ACCESSIBLE OR DOES NOT "
-                        "EXIST. SERVICE ACCOUNT WILL BE REMOVED FROM FENCE DB"
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(validate, google_project_id): google_project_id
+                for google_project_id in google_project_ids
+            }
+            for future in as_completed(futures):
+                try:
+                    if future.result():
+                        validated.append(futures[future])
+                except Exception as e:
+                    logger.error(
+                        "Unable to validate Google project {}: {}".format(
+                            futures[future], e
+                        )
                     )
-                    force_remove_service_account_from_db(sa_email, db=db)
 
-                # remove from list so we don't try to remove again
-                # if project is invalid too
-                sa_emails_removed.append(sa_email)
+    _set_google_projects_validated(validated, int(start), db=db)
+    logger.info(
+        "Validated {}/{} Google projects in {:.2f}s ({} Google API calls, {} "
+        "served from the cache)".format(
+            len(validated),
+            len(google_project_ids),
+            time.time() - start,
+            google_api_cache.misses,
+            google_api_cache.hits,
+        )
+    )
+    if len(validated) < len(google_project_ids):
+        logger.warning(
+            "{} Google projects were not validated, they will be validated first "
+            "by the next run".format(len(google_project_ids) - len(validated))
+        )
+
 
-                invalid_registered_service_account_reasons[
-                    sa_email
-                ] = _get_service_account_removal_reasons(validity_info)
-                email_required = True
-
-        for sa_email in sa_emails_removed:
-            sa_emails.remove(sa_email)
-
-        logger.debug("Validating Google Project: {}".format(google_project_id))
-        google_project_validity = _is_valid_google_project(google_project_id, db=db)
-
-        if not google_project_validity:
-            # for now, if we detect in invalid project, remove ALL service
-            # accounts from access for that project.
-            #
-            # TODO: If the issue is ONLY a specific service account,
-            # it may be possible to isolate it and only remove that
-            # from access.
+def _validate_google_project(google_project_id, sa_emails, google_api_cache, db=None):
+    """
+    Validate the registered service accounts of a Google project, then the
+    project itself, and remove the invalid ones.
+
+    Args:
+        google_project_id (str): Google project id
+        sa_emails (List[str]): registered service accounts of the project
+        google_api_cache (_GoogleAPICache): cache of the Google API responses
+        db (str): database connection string
+    """
+    gcm = _CachedGoogleCloudManager(
+        GoogleCloudManager(google_project_id), google_api_cache
+    )
+    gcm.open()
+    try:
+        _validate_google_project_with_manager(google_project_id, sa_emails, gcm, db=db)
+    finally:
+        gcm.close()
+
+
+def _validate_google_project_with_manager(google_project_id, sa_emails, gcm, db=None):
+    email_required = False
+    invalid_registered_service_account_reasons = {}
+    invalid_project_reasons = {}
+    sa_emails_removed = []
+    for sa_email in sa_emails:
+        logger.debug("Validating Google Service Account: {}".format(sa_email))
+        # Do some basic service account checks, this won't validate
+        # the data access, that's done when the project's validated
+        try:
+            validity_info = _is_valid_service_account(
+                sa_email, google_project_id, google_cloud_manager=gcm
+            )
+        except Unauthorized:
+            """
+            is_validity_service_account can raise an exception if the monitor does
+            not have access, which will be caught and handled during the Project check below
+            The logic in the endpoints is reversed (Project is checked first,
+            not SAs) which is why there's is a sort of weird handling of it here.
+            """
+            logger.info(
+                "Monitor does not have access to validate "
+                "service account {}. This should be handled "
+                "in project validation.".format(sa_email)
+            )
+            continue
+
+        if not validity_info:
             logger.info(
-                "INVALID GOOGLE PROJECT {} DETECTED. REMOVING ALL SERVICE ACCOUNTS. "
-                "Validity Information: {}".format(
-                    google_project_id,
-                    str(getattr(google_project_validity, "_info", None)),
+                "INVALID SERVICE ACCOUNT {} DETECTED. REMOVING. Validity Information: {}".format(
+                    sa_email, str(getattr(validity_info, "_info", None))
                 )
             )
-            for sa_email in sa_emails:
-                force_remove_service_account_from_access(
-                    sa_email, google_project_id, db=db
+            force_remove_service_account_from_access(sa_email, google_project_id, db=db)
+            if validity_info["policy_accessible"] is False:
+                logger.info(
+                    "SERVICE ACCOUNT POLICY NOT ACCESSIBLE OR DOES NOT "
+                    "EXIST. SERVICE ACCOUNT WILL BE REMOVED FROM FENCE DB"
                 )
+                force_remove_service_account_from_db(sa_email, db=db)
+
+            # remove from list so we don't try to remove again
+            # if project is invalid too
+            sa_emails_removed.append(sa_email)
+
+            invalid_registered_service_account_reasons[
+                sa_email
+            ] = _get_service_account_removal_reasons(validity_info)
+            email_required = True
+
+    for sa_email in sa_emails_removed:
+        sa_emails.remove(sa_email)
 
-            # projects can be invalid for project-related reasons or because
-            # of NON-registered service accounts
-            invalid_project_reasons["general"] = _get_general_project_removal_reasons(
-                google_project_validity
+    logger.debug("Validating Google Project: {}".format(google_project_id))
+    google_project_validity = _is_valid_google_project(
+        google_project_id, db=db, google_cloud_manager=gcm
+    )
+
+    if not google_project_validity:
+        # for now, if we detect in invalid project, remove ALL service
+        # accounts from access for that project.
+        #
+        # TODO: If the issue is ONLY a specific service account,
+        # it may be possible to isolate it and only remove that
+        # from access.
+        logger.info(
+            "INVALID GOOGLE PROJECT {} DETECTED. REMOVING ALL SERVICE ACCOUNTS. "
+            "Validity Information: {}".format(
+                google_project_id,
+                str(getattr(google_project_validity, "_info", None)),
             )
-            invalid_project_reasons[
-                "non_registered_service_accounts"
-            ] = _get_invalid_sa_project_removal_reasons(google_project_validity)
-            invalid_project_reasons["access"] = _get_access_removal_reasons(
-                google_project_validity
+        )
+        for sa_email in sa_emails:
+            force_remove_service_account_from_access(sa_email, google_project_id, db=db)
+
+        # projects can be invalid for project-related reasons or because
+        # of NON-registered service accounts
+        invalid_project_reasons["general"] = _get_general_project_removal_reasons(
+            google_project_validity
+        )
+        invalid_project_reasons[
+            "non_registered_service_accounts"
+        ] = _get_invalid_sa_project_removal_reasons(google_project_validity)
+        invalid_project_reasons["access"] = _get_access_removal_reasons(
+            google_project_validity
+        )
+        email_required = True
+
+    email_required &= config["REMOVE_SERVICE_ACCOUNT_EMAIL_NOTIFICATION"]["enable"]
+    if email_required:
+        logger.debug(
+            "Sending email with service account removal reasons: {} and project "
+            "removal reasons: {}.".format(
+                invalid_registered_service_account_reasons, invalid_project_reasons
             )
-            email_required = True
+        )
 
-        email_required &= config["REMOVE_SERVICE_ACCOUNT_EMAIL_NOTIFICATION"]["enable"]
-        if email_required:
-            logger.debug(
-                "Sending email with service account removal reasons: {} and project "
-                "removal reasons: {}.".format(
-                    invalid_registered_service_account_reasons, invalid_project_reasons
+        try:
+            user_email_list = _get_user_email_list_from_google_project_with_owner_role(
+                google_project_id
+            )
+        except GoogleAPIError:
+            logger.warning(
+                "DID NOT EMAIL USERS. Unable to get user(s) email(s) about service account "
+                "removal in Google project {}. If fence's monitoring SA is not present "
+                "then we cannot make the Google API call to know who to email.".format(
+                    google_project_id
                 )
             )
+            return
 
-            try:
-                user_email_list = (
-                    _get_user_email_list_from_google_project_with_owner_role(
-                        google_project_id
-                    )
-                )
-            except GoogleAPIError:
-                logger.warning(
-                    "DID NOT EMAIL USERS. Unable to get user(s) email(s) about service account "
-                    "removal in Google project {}. If fence's monitoring SA is not present "
-                    "then we cannot make the Google API call to know who to email.".format(
-                        google_project_id
-                    )
-                )
-                return
+        _send_emails_informing_service_account_removal(
+            user_email_list,
+            invalid_registered_service_account_reasons,
+            invalid_project_reasons,
+            google_project_id,
+        )
 
-            _send_emails_informing_service_account_removal(
-                user_email_list,
-                invalid_registered_service_account_reasons,
-                invalid_project_reasons,
-                google_project_id,
+
+class _GoogleAPICache(object):
+    """
+    Responses of the read-only Google API calls made during a validation
+    check, shared by all the projects validated by the check. The errors are
+    not cached.
+    """
+
+    def __init__(self):
+        self._responses = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, func, *args, **kwargs):
+        with self._lock:
+            if key in self._responses:
+                self.hits += 1
+                return self._responses[key]
+        response = func(*args, **kwargs)
+        with self._lock:
+            self.misses += 1
+            self._responses[key] = response
+        return response
+
+
+class _CachedGoogleCloudManager(object):
+    """
+    GoogleCloudManager serving the IAM policies, project memberships and
+    parent organizations from a `_GoogleAPICache`. Other attributes are the
+    ones of the wrapped manager.
+    """
+
+    # calls that only depend on the google project
+    PROJECT_CALLS = [
+        "get_project_info",
+        "get_project_membership",
+        "get_project_organization",
+    ]
+    # calls that only depend on the service account
+    SERVICE_ACCOUNT_CALLS = [
+        "get_service_account_policy",
+        "get_service_account_keys_info",
+        "get_service_account_type",
+    ]
+
+    def __init__(self, google_cloud_manager, google_api_cache):
+        self._google_cloud_manager = google_cloud_manager
+        self._google_api_cache = google_api_cache
+
+    def __getattr__(self, name):
+        attr = getattr(self._google_cloud_manager, name)
+        if name in self.PROJECT_CALLS:
+            prefix = (self._google_cloud_manager.project_id, name)
+        elif name in self.SERVICE_ACCOUNT_CALLS:
+            prefix = (name,)
+        else:
+            return attr
+
+        def cached_call(*args, **kwargs):
+            key = prefix + args + tuple(sorted(kwargs.items()))
+            return self._google_api_cache.get(key, attr, *args, **kwargs)
+
+        return cached_call
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _get_google_projects_in_validation_order(project_service_account_mapping, db=None):
+    """
+    Return the google project ids, ordered so that the projects that were
+    never validated, then the ones validated the longest time ago, come first.
+    """
+    if not project_service_account_mapping:
+        return []
+    session = get_db_session(db)
+    last_validated = dict(
+        session.query(
+            GoogleMonitorProgress.google_project_id,
+            GoogleMonitorProgress.last_validated,
+        )
+        .filter(
+            GoogleMonitorProgress.google_project_id.in_(
+                list(project_service_account_mapping)
+            )
+        )
+        .all()
+    )
+    return sorted(
+        project_service_account_mapping,
+        key=lambda google_project_id: last_validated.get(google_project_id) or 0,
+    )
+
+
+def _set_google_projects_validated(google_project_ids, timestamp, db=None):
+    if not google_project_ids:
+        return
+    session = get_db_session(db)
+    for google_project_id in google_project_ids:
+        session.merge(
+            GoogleMonitorProgress(
+                google_project_id=google_project_id, last_validated=timestamp
             )
+        )
+    session.commit()
 
 
-def _is_valid_service_account(sa_email, google_project_id):
+def _is_valid_service_account(sa_email, google_project_id, google_cloud_manager=None):
     """
     Validate the given registered service account and remove if invalid.
 
     Args:
         sa_email(str): service account email
         google_project_id(str): google project id
+        google_cloud_manager(GoogleCloudManager): cloud manager instance for
+            the google project, a new one is created if not provided
     """
-    with GoogleCloudManager(google_project_id) as gcm:
+    gcm = google_cloud_manager or GoogleCloudManager(google_project_id)
+    with gcm:
         google_project_number = get_google_project_number(google_project_id, gcm)
 
     has_access = bool(google_project_number)
@@ -206,7 +416,10 @@ def _is_valid_service_account(sa_email, google_project_id):
 
     try:
         sa_validity = GoogleServiceAccountValidity(
-            sa_email, google_project_id, google_project_number=google_project_number
+            sa_email,
+            google_project_id,
+            google_cloud_manager=google_cloud_manager,
+            google_project_number=google_project_number,
         )
 
         if is_google_managed_service_account(sa_email):
@@ -237,13 +450,15 @@ def _is_valid_service_account(sa_email, google_project_id):
     return sa_validity
 
 
-def _is_valid_google_project(google_project_id, db=None):
+def _is_valid_google_project(google_project_id, db=None, google_cloud_manager=None):
     """
     Validate the given google project id and remove all registered service
     accounts under that project if invalid.
     """
     try:
-        project_validity = GoogleProjectValidity(google_project_id)
+        project_validity = GoogleProjectValidity(
+            google_project_id, google_cloud_manager=google_cloud_manager
+        )
         project_validity.check_validity(early_return=True, db=db)
     except Exception as exc:
         # any issues, assume invalid
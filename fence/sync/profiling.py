@@ -0,0 +1,178 @@
+"""
+Instrumentation of the usersync phases.
+
+Each phase records its wall time and, when `USERSYNC.profiling` is enabled,
+its number of processed rows, of DB queries and of outbound HTTP calls. A JSON
+summary of all the phases is logged at the end of the sync and, if
+`USERSYNC.profiling_pushgateway` is set, pushed to a Prometheus pushgateway so
+that the sync performance can be compared across releases.
+
+The outbound HTTP calls are counted by hooking into `http.client` (used by
+`requests` and the Google clients) and `httpx` (used by the Arborist client)
+while the sync runs.
+"""
+
+from contextlib import contextmanager
+import http.client
+import json
+import threading
+import time
+
+import httpx
+from sqlalchemy import event
+
+
+class SyncProfiler(object):
+    """
+    Args:
+        logger: where the phase durations and the summary are logged
+        timer (Callable[[], float]): clock, overridable for testing
+    """
+
+    def __init__(self, logger, timer=time.time):
+        self.logger = logger
+        self._timer = timer
+        self._lock = threading.Lock()
+        self.enabled = False
+        self.phases = {}
+        self.counters = {"db_queries": 0, "http_calls": 0}
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Record the wall time and the counts of a phase. Phases can be nested,
+        and the counts of a nested phase are included in the parent phase. If
+        a phase runs several times, its times and counts are summed.
+
+        Yields:
+            dict: the caller can set the number of processed rows in `rows`
+        """
+        stats = {"rows": None}
+        counters = dict(self.counters)
+        start = self._timer()
+        try:
+            yield stats
+        finally:
+            duration = self._timer() - start
+            with self._lock:
+                phase = self.phases.setdefault(
+                    name,
+                    {"calls": 0, "seconds": 0.0, "db_queries": 0, "http_calls": 0},
+                )
+                phase["calls"] += 1
+                phase["seconds"] += duration
+                for counter, value in self.counters.items():
+                    phase[counter] += value - counters[counter]
+                if stats["rows"] is not None:
+                    phase["rows"] = phase.get("rows", 0) + stats["rows"]
+            self.logger.info("{} done in {:.2f}s".format(name, duration))
+
+    @contextmanager
+    def profile(self, session, enabled=False, pushgateway=None, job="usersync"):
+        """
+        Count the DB queries made with `session` and the outbound HTTP calls
+        while the sync runs, then log the summary of the phases of this sync
+        and push it to `pushgateway`.
+        """
+        self.enabled = enabled
+        if not enabled:
+            yield
+            return
+
+        # the summary only covers this sync, even if the syncer is reused
+        with self._lock:
+            self.phases = {}
+        connectable = session.get_bind()
+
+        def count_db_query(*args, **kwargs):
+            self.increment("db_queries")
+
+        event.listen(connectable, "before_cursor_execute", count_db_query)
+        try:
+            with self._count_http_calls(), self.phase("total"):
+                yield
+        finally:
+            event.remove(connectable, "before_cursor_execute", count_db_query)
+            summary = self.summary()
+            self.logger.info("usersync profile: {}".format(json.dumps(summary)))
+            if pushgateway:
+                self.push_to_gateway(summary, pushgateway, job)
+
+    @contextmanager
+    def _count_http_calls(self):
+        original_putrequest = http.client.HTTPConnection.putrequest
+        original_send = httpx.Client.send
+        profiler = self
+
+        def putrequest(*args, **kwargs):
+            profiler.increment("http_calls")
+            return original_putrequest(*args, **kwargs)
+
+        def send(*args, **kwargs):
+            profiler.increment("http_calls")
+            return original_send(*args, **kwargs)
+
+        http.client.HTTPConnection.putrequest = putrequest
+        httpx.Client.send = send
+        try:
+            yield
+        finally:
+            http.client.HTTPConnection.putrequest = original_putrequest
+            httpx.Client.send = original_send
+
+    def summary(self):
+        """
+        Return:
+            dict: {"phases": {phase: {calls, seconds, rows, db_queries, http_calls}}}
+        """
+        with self._lock:
+            phases = {
+                name: dict(phase, seconds=round(phase["seconds"], 3))
+                for name, phase in self.phases.items()
+            }
+        return {"phases": phases}
+
+    def push_to_gateway(self, summary, pushgateway, job):
+        from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+
+        registry = CollectorRegistry()
+        gauges = {
+            "seconds": Gauge(
+                "usersync_phase_duration_seconds",
+                "wall time of the usersync phases",
+                ["phase"],
+                registry=registry,
+            ),
+            "rows": Gauge(
+                "usersync_phase_rows",
+                "number of rows processed by the usersync phases",
+                ["phase"],
+                registry=registry,
+            ),
+            "db_queries": Gauge(
+                "usersync_phase_db_queries",
+                "number of DB queries made by the usersync phases",
+                ["phase"],
+                registry=registry,
+            ),
+            "http_calls": Gauge(
+                "usersync_phase_http_calls",
+                "number of outbound HTTP calls made by the usersync phases",
+                ["phase"],
+                registry=registry,
+            ),
+        }
+        for name, phase in summary["phases"].items():
+            for key, gauge in gauges.items():
+                if key in phase:
+                    gauge.labels(name).set(phase[key])
+        try:
+            push_to_gateway(pushgateway, job=job, registry=registry)
+        except Exception as e:
+            self.logger.warning(
+                "Unable to push the usersync profile to {}: {}".format(pushgateway, e)
+            )
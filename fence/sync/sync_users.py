@@ -1,15 +1,22 @@
+import functools
 import glob
+import hashlib
+import httpx
+import json
 import jwt
 import os
 import re
+import shutil
 import subprocess as sp
+import threading
+import time
 import yaml
 import copy
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 from collections import defaultdict
 from csv import DictReader
-from io import StringIO
 from stat import S_ISDIR
 
 import paramiko
@@ -20,6 +27,7 @@ from gen3users.validation import validate_user_yaml
 from paramiko.proxy import ProxyCommand
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from userdatamodel.driver import SQLAlchemyDriver
 
 from fence.config import config
@@ -29,37 +37,146 @@ from fence.models import (
     Project,
     Tag,
     User,
+    UserSyncSnapshot,
     query_for_user,
     Client,
 )
 from fence.resources.storage import StorageManager
 from fence.resources.google.access_utils import bulk_update_google_groups
 from fence.sync import utils
+from fence.sync.profiling import SyncProfiler
 from fence.sync.passport_sync.ras_sync import RASVisa
 
 
+# maximum number of policies created by a single arborist bulk call
+ARBORIST_BULK_POLICY_CHUNK_SIZE = 1000
+
+# name of the `usersync_snapshot` row used by the incremental sync
+USERSYNC_SNAPSHOT_NAME = "usersync"
+
+
 def _format_policy_id(path, privilege):
     resource = ".".join(name for name in path.split("/") if name)
     return "{}-{}".format(resource, privilege)
 
 
-def download_dir(sftp, remote_dir, local_dir):
+# name of the file, in the local download directory, listing the size and
+# modification time of the downloaded files
+DOWNLOAD_MANIFEST = ".download_manifest.json"
+
+
+def _list_remote_files(sftp, remote_dir, local_dir):
+    """
+    Return:
+        List[Tuple[str, str, int, int]]: (remote path, local path, size,
+            modification time) of the files in remote_dir and its subdirectories
+    """
+    files = []
+    for item in sftp.listdir_attr(remote_dir):
+        remote_path = remote_dir + "/" + item.filename
+        local_path = os.path.join(local_dir, item.filename)
+        if S_ISDIR(item.st_mode):
+            files.extend(_list_remote_files(sftp, remote_path, local_path))
+        else:
+            files.append((remote_path, local_path, item.st_size, item.st_mtime))
+    return files
+
+
+def download_dir(sftp, remote_dir, local_dir, max_workers=1, logger=None):
     """
     Recursively download file from remote_dir to local_dir
+
+    Files whose size and modification time did not change since they were
+    downloaded (according to the `DOWNLOAD_MANIFEST` in local_dir) are not
+    downloaded again. The other files are downloaded in parallel by up to
+    `max_workers` SFTP sessions, to temporary files renamed once complete.
+
     Args:
+        sftp (paramiko.SFTPClient)
         remote_dir(str)
         local_dir(str)
+        max_workers (int): maximum number of SFTP sessions
+        logger (Logger)
     Returns: None
     """
-    dir_items = sftp.listdir_attr(remote_dir)
+    manifest_path = os.path.join(local_dir, DOWNLOAD_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    new_manifest = {}
+    to_download = []
+    for remote_path, local_path, size, mtime in _list_remote_files(
+        sftp, remote_dir, local_dir
+    ):
+        key = os.path.relpath(local_path, local_dir)
+        new_manifest[key] = {"size": size, "mtime": mtime}
+        if (
+            manifest.get(key) == new_manifest[key]
+            and os.path.isfile(local_path)
+            and os.path.getsize(local_path) == size
+        ):
+            continue
+        to_download.append((key, remote_path, local_path))
+    if logger:
+        logger.info(
+            "Downloading {} files, {} files did not change".format(
+                len(to_download), len(new_manifest) - len(to_download)
+            )
+        )
 
-    for item in dir_items:
-        remote_path = remote_dir + "/" + item.filename
-        local_path = os.path.join(local_dir, item.filename)
-        if S_ISDIR(item.st_mode):
-            download_dir(sftp, remote_path, local_path)
-        else:
-            sftp.get(remote_path, local_path)
+    sessions = []
+    thread_data = threading.local()
+
+    def get_sftp():
+        if max_workers <= 1:
+            return sftp
+        if not hasattr(thread_data, "sftp"):
+            transport = sftp.get_channel().get_transport()
+            thread_data.sftp = paramiko.SFTPClient.from_transport(transport)
+            sessions.append(thread_data.sftp)
+        return thread_data.sftp
+
+    def download(remote_path, local_path):
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = os.path.join(
+            os.path.dirname(local_path), "." + os.path.basename(local_path) + ".part"
+        )
+        get_sftp().get(remote_path, tmp_path)
+        os.replace(tmp_path, local_path)
+
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {
+                executor.submit(download, remote_path, local_path): key
+                for key, remote_path, local_path in to_download
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    if logger:
+                        logger.error(
+                            "Could not download {}: {}".format(futures[future], e)
+                        )
+                    # download it again next time
+                    new_manifest.pop(futures[future], None)
+                    errors.append(e)
+    finally:
+        for session in sessions:
+            session.close()
+
+    os.makedirs(local_dir, exist_ok=True)
+    tmp_manifest_path = manifest_path + ".part"
+    with open(tmp_manifest_path, "w") as f:
+        json.dump(new_manifest, f)
+    os.replace(tmp_manifest_path, manifest_path)
+
+    if errors:
+        raise errors[0]
 
 
 def arborist_role_for_permission(permission):
@@ -77,12 +194,21 @@ def arborist_role_for_permission(permission):
     }
 
 
+@functools.lru_cache(maxsize=None)
+def _has_mcrypt():
+    return shutil.which("mcrypt") is not None
+
+
 @contextmanager
 def _read_file(filepath, encrypted=True, key=None, logger=None):
     """
     Context manager for reading and optionally decrypting file it only
     decrypts files encrypted by unix 'crypt' tool which is used by dbGaP.
 
+    The decrypted contents are streamed from the output of `mcrypt` instead
+    of being loaded in memory. An error is raised once the file is closed if
+    `mcrypt` failed, so a partially decrypted file is never used silently.
+
     Args:
         filepath (str): path to the file
         encrypted (bool): whether the file is encrypted
@@ -91,41 +217,119 @@ def _read_file(filepath, encrypted=True, key=None, logger=None):
         Generator[file-like class]: file like object for the file
     """
     if encrypted:
-        has_crypt = sp.call(["which", "mcrypt"])
-        if has_crypt != 0:
+        if not _has_mcrypt():
             if logger:
                 logger.error("Need to install mcrypt to decrypt files from dbgap")
             # TODO (rudyardrichter, 2019-01-08): raise error and move exit out to script
             exit(1)
-        p = sp.Popen(
-            [
-                "mcrypt",
-                "-a",
-                "enigma",
-                "-o",
-                "scrypt",
-                "-m",
-                "stream",
-                "--bare",
-                "--key",
-                key,
-                "--force",
-            ],
-            stdin=open(filepath, "r"),
-            stdout=sp.PIPE,
-            stderr=open(os.devnull, "w"),
-            universal_newlines=True,
-        )
-        try:
-            yield StringIO(p.communicate()[0])
-        except UnicodeDecodeError:
-            logger.error("Could not decode file. Check the decryption key.")
+        with open(filepath, "r") as encrypted_file, open(os.devnull, "w") as devnull:
+            p = sp.Popen(
+                [
+                    "mcrypt",
+                    "-a",
+                    "enigma",
+                    "-o",
+                    "scrypt",
+                    "-m",
+                    "stream",
+                    "--bare",
+                    "--key",
+                    key,
+                    "--force",
+                ],
+                stdin=encrypted_file,
+                stdout=sp.PIPE,
+                stderr=devnull,
+                universal_newlines=True,
+            )
+            try:
+                yield p.stdout
+            except UnicodeDecodeError:
+                if logger:
+                    logger.error("Could not decode file. Check the decryption key.")
+                raise
+            finally:
+                p.stdout.close()
+                returncode = p.wait()
+        if returncode != 0:
+            if logger:
+                logger.error(
+                    "Could not decrypt file {}: mcrypt exited with status {}".format(
+                        filepath, returncode
+                    )
+                )
+            raise sp.CalledProcessError(returncode, "mcrypt")
     else:
         f = open(filepath, "r")
         yield f
         f.close()
 
 
+# columns of the dbGaP telemetry files used by usersync
+DBGAP_TELEMETRY_COLUMNS = [
+    "login",
+    "phsid",
+    "user name",
+    "email",
+    "phone",
+    "role",
+    "downloader for",
+    "downloader for names",
+]
+
+
+def read_dbgap_telemetry_file(filepath, encrypted=True, key=None):
+    """
+    Decrypt and parse a dbGaP telemetry file, one row at a time.
+
+    Args:
+        filepath (str): path to the file
+        encrypted (bool): whether the file is encrypted
+        key (str): decryption key
+
+    Return:
+        Generator[dict]: the rows of the file that have a `login`, with only
+            the `DBGAP_TELEMETRY_COLUMNS`
+    """
+    logger = get_logger(
+        "user_syncer", log_level="debug" if config["DEBUG"] is True else "info"
+    )
+    with _read_file(filepath, encrypted=encrypted, key=key, logger=logger) as f:
+        reader = DictReader(f, quotechar='"', skipinitialspace=True)
+        columns = [
+            column
+            for column in DBGAP_TELEMETRY_COLUMNS
+            if column in (reader.fieldnames or [])
+        ]
+        for row in reader:
+            if row.get("login"):
+                yield {column: row[column] for column in columns}
+
+
+def read_dbgap_telemetry_file_values(filepath, encrypted=True, key=None):
+    """
+    Decrypt and parse a dbGaP telemetry file in a parallel process. This
+    function has no side effect, and the rows are returned as tuples so they
+    are cheaper to keep and to send back than dicts.
+
+    Args:
+        filepath (str): path to the file
+        encrypted (bool): whether the file is encrypted
+        key (str): decryption key
+
+    Return:
+        Tuple[List[str], List[tuple]]: the columns of the file that are in
+            `DBGAP_TELEMETRY_COLUMNS`, and the values of the rows that have a
+            `login`
+    """
+    columns = []
+    values = []
+    for row in read_dbgap_telemetry_file(filepath, encrypted, key):
+        columns = list(row)
+        values.append(tuple(row.values()))
+    return columns, values
+
+
 class UserYAML(object):
     """
     Representation of the information in a YAML file describing user, project, and ABAC
@@ -293,6 +497,7 @@ class UserSyncer(object):
         folder=None,
         sync_from_visas=False,
         fallback_to_dbgap_sftp=False,
+        full_rebuild=False,
     ):
         """
         Syncs ACL files from dbGap to auth database and storage backends
@@ -309,6 +514,8 @@ class UserSyncer(object):
             folder: a local folder where dbgap telemetry files will sync to
             sync_from_visas: use visa for sync instead of dbgap
             fallback_to_dbgap_sftp: fallback to telemetry files when visa sync fails
+            full_rebuild: sync the access of all the users even if
+                `USERSYNC.incremental_sync` is enabled
         """
         self.sync_from_local_csv_dir = sync_from_local_csv_dir
         self.sync_from_local_yaml_file = sync_from_local_yaml_file
@@ -325,13 +532,18 @@ class UserSyncer(object):
         self.logger = get_logger(
             "user_syncer", log_level="debug" if config["DEBUG"] is True else "info"
         )
+        self.profiler = SyncProfiler(self.logger)
         self.arborist_client = arborist
         self.folder = folder
         self.sync_from_visas = sync_from_visas
         self.fallback_to_dbgap_sftp = fallback_to_dbgap_sftp
+        self.full_rebuild = full_rebuild
 
         self.auth_source = defaultdict(set)
         # auth_source used for logging. username : [source1, source2]
+        # errors that left the access of some users out of date; the snapshot
+        # of an incremental sync is not saved if there are any
+        self.sync_errors = []
         self.visa_types = config.get("USERSYNC", {}).get("visa_types", {})
 
         if storage_credentials:
@@ -401,7 +613,15 @@ class UserSyncer(object):
             )
             client.connect(**parameters)
             with client.open_sftp() as sftp:
-                download_dir(sftp, "./", path)
+                download_dir(
+                    sftp,
+                    "./",
+                    path,
+                    max_workers=config.get("USERSYNC", {}).get(
+                        "sftp_download_workers", 4
+                    ),
+                    logger=self.logger,
+                )
 
         if proxy:
             proxy.close()
@@ -483,8 +703,8 @@ class UserSyncer(object):
             self.logger.info(
                 f"using study to common exchange area mapping: {study_common_exchange_areas}"
             )
+        files_to_read = []
         for filepath, privileges in file_dict.items():
-            self.logger.info("Reading file {}".format(filepath))
             if os.stat(filepath).st_size == 0:
                 self.logger.warning("Empty file {}".format(filepath))
                 continue
@@ -498,15 +718,20 @@ class UserSyncer(object):
                     )
                 )
                 continue
-
-            with _read_file(
-                filepath, encrypted=encrypted, key=dbgap_key, logger=self.logger
-            ) as f:
-                csv = DictReader(f, quotechar='"', skipinitialspace=True)
-                for row in csv:
-                    username = row.get("login", "")
-                    if username == "":
-                        continue
+            files_to_read.append(filepath)
+
+        with self.profiler.phase("parse") as stats:
+            stats["rows"] = 0
+            for filepath, rows in zip(
+                files_to_read,
+                self._read_dbgap_telemetry_files(files_to_read, encrypted, dbgap_key),
+            ):
+                privileges = file_dict[filepath]
+                start = time.time()
+                row_count = 0
+                for row in rows:
+                    row_count += 1
+                    username = row["login"]
 
                     phsid_privileges = {}
                     phsid = row.get("phsid", "").split(".")
@@ -575,8 +800,47 @@ class UserSyncer(object):
                         dbgap_config,
                     )
 
+                duration = time.time() - start
+                stats["rows"] += row_count
+                self.logger.info(
+                    "Read {} rows from file {} in {:.2f}s ({:.0f} rows/s)".format(
+                        row_count,
+                        filepath,
+                        duration,
+                        row_count / duration if duration else float(row_count),
+                    )
+                )
+
         return user_projects, user_info
 
+    def _read_dbgap_telemetry_files(self, filepaths, encrypted, key):
+        """
+        Decrypt and parse the files, in parallel in up to
+        `USERSYNC.dbgap_parse_workers` processes. With a single worker, the
+        rows are streamed from the files as they are consumed.
+
+        Return:
+            Iterator[Iterable[dict]]: the rows of each file, in order, as
+                returned by `read_dbgap_telemetry_file`
+        """
+        workers = min(
+            config.get("USERSYNC", {}).get("dbgap_parse_workers", 1), len(filepaths)
+        )
+        for filepath in filepaths:
+            self.logger.info("Reading file {}".format(filepath))
+        if workers <= 1:
+            for filepath in filepaths:
+                yield read_dbgap_telemetry_file(filepath, encrypted, key)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for columns, values in executor.map(
+                read_dbgap_telemetry_file_values,
+                filepaths,
+                [encrypted] * len(filepaths),
+                [key] * len(filepaths),
+            ):
+                yield (dict(zip(columns, row)) for row in values)
+
     def _add_dbgap_project_for_user(
         self, dbgap_project, privileges, username, sess, user_projects, dbgap_config
     ):
@@ -688,7 +952,13 @@ class UserSyncer(object):
                 self.auth_source[user].add(source2)
 
     def sync_to_db_and_storage_backend(
-        self, user_project, user_info, sess, single_visa_sync=False
+        self,
+        user_project,
+        user_info,
+        sess,
+        single_visa_sync=False,
+        usernames=None,
+        arborist_users=None,
     ):
         """
         sync user access control to database and storage backend
@@ -705,6 +975,13 @@ class UserSyncer(object):
 
             user_info (dict): a dictionary of {username: user_info{}}
             sess: a sqlalchemy session
+            usernames (set): if provided, only the access of these lowercase
+                usernames is synced, and the access of the other users is left
+                as is. The users in `usernames` but not in `user_project` lose
+                all their access
+            arborist_users (List[dict]): the users in arborist, as returned by
+                `_get_arborist_users`. If not provided, they are loaded again
+                when needed
 
         Return:
             None
@@ -712,18 +989,36 @@ class UserSyncer(object):
         google_bulk_mapping = None
         if config["GOOGLE_BULK_UPDATES"]:
             google_bulk_mapping = {}
+        bulk_db_sync = config.get("USERSYNC", {}).get("bulk_db_sync", False)
 
-        self._init_projects(user_project, sess)
+        with self.profiler.phase("project initialization"):
+            self._init_projects(user_project, sess)
 
         auth_provider_list = [
             self._get_or_create(sess, AuthorizationProvider, name="dbGaP"),
             self._get_or_create(sess, AuthorizationProvider, name="fence"),
         ]
 
-        cur_db_user_project_list = {
-            (ua.user.username.lower(), ua.project.auth_id)
-            for ua in sess.query(AccessPrivilege).all()
-        }
+        with self.profiler.phase("loading of the current access") as stats:
+            if bulk_db_sync:
+                cur_db_access = self._get_user_access_privileges(sess)
+                cur_db_user_project_list = set(cur_db_access)
+            else:
+                query = sess.query(AccessPrivilege)
+                if usernames is not None:
+                    query = query.join(User, AccessPrivilege.user_id == User.id).filter(
+                        func.lower(User.username).in_(usernames)
+                    )
+                cur_db_user_project_list = {
+                    (ua.user.username.lower(), ua.project.auth_id) for ua in query.all()
+                }
+            if usernames is not None:
+                cur_db_user_project_list = {
+                    (username, project)
+                    for (username, project) in cur_db_user_project_list
+                    if username in usernames
+                }
+            stats["rows"] = len(cur_db_user_project_list)
 
         # we need to compare db -> whitelist case-insensitively for username.
         # db stores case-sensitively, but we need to query case-insensitively
@@ -746,47 +1041,242 @@ class UserSyncer(object):
 
         # when updating users we want to maintain case sesitivity in the username so
         # pass the original, non-lowered user_info dict
-        self._upsert_userinfo(sess, user_info)
+        with self.profiler.phase("user info upsert") as stats:
+            stats["rows"] = len(user_info)
+            if bulk_db_sync:
+                self._bulk_upsert_userinfo(
+                    sess, user_info, arborist_users=arborist_users
+                )
+            else:
+                self._upsert_userinfo(sess, user_info)
 
         if not single_visa_sync:
-            self._revoke_from_storage(
-                to_delete, sess, google_bulk_mapping=google_bulk_mapping
-            )
-            self._revoke_from_db(sess, to_delete)
+            with self.profiler.phase("storage revoke") as stats:
+                stats["rows"] = len(to_delete)
+                self._revoke_from_storage(
+                    to_delete, sess, google_bulk_mapping=google_bulk_mapping
+                )
+            with self.profiler.phase("db revoke") as stats:
+                stats["rows"] = len(to_delete)
+                if bulk_db_sync:
+                    self._bulk_revoke_from_db(sess, to_delete, cur_db_access)
+                else:
+                    self._revoke_from_db(sess, to_delete)
 
-        self._grant_from_storage(
-            to_add,
-            user_project_lowercase,
-            sess,
-            google_bulk_mapping=google_bulk_mapping,
-        )
+        with self.profiler.phase("storage grant") as stats:
+            stats["rows"] = len(to_add)
+            self._grant_from_storage(
+                to_add,
+                user_project_lowercase,
+                sess,
+                google_bulk_mapping=google_bulk_mapping,
+            )
 
-        self._grant_from_db(
-            sess,
-            to_add,
-            user_info_lowercase,
-            user_project_lowercase,
-            auth_provider_list,
-        )
+        with self.profiler.phase("db grant") as stats:
+            stats["rows"] = len(to_add)
+            if bulk_db_sync:
+                self._bulk_grant_from_db(
+                    sess,
+                    to_add,
+                    user_info_lowercase,
+                    user_project_lowercase,
+                    auth_provider_list,
+                )
+            else:
+                self._grant_from_db(
+                    sess,
+                    to_add,
+                    user_info_lowercase,
+                    user_project_lowercase,
+                    auth_provider_list,
+                )
 
         # re-grant
-        self._grant_from_storage(
-            to_update,
-            user_project_lowercase,
-            sess,
-            google_bulk_mapping=google_bulk_mapping,
-        )
-        self._update_from_db(sess, to_update, user_project_lowercase)
+        with self.profiler.phase("storage re-grant") as stats:
+            stats["rows"] = len(to_update)
+            self._grant_from_storage(
+                to_update,
+                user_project_lowercase,
+                sess,
+                google_bulk_mapping=google_bulk_mapping,
+            )
+        with self.profiler.phase("db update") as stats:
+            stats["rows"] = len(to_update)
+            if bulk_db_sync:
+                self._bulk_update_from_db(
+                    sess, to_update, user_project_lowercase, cur_db_access
+                )
+            else:
+                self._update_from_db(sess, to_update, user_project_lowercase)
 
         if not single_visa_sync:
-            self._validate_and_update_user_admin(sess, user_info_lowercase)
+            self._validate_and_update_user_admin(
+                sess, user_info_lowercase, usernames=usernames
+            )
 
         if config["GOOGLE_BULK_UPDATES"]:
             self.logger.info("Doing bulk Google update...")
-            bulk_update_google_groups(google_bulk_mapping)
+            with self.profiler.phase("bulk Google update"):
+                bulk_update_google_groups(google_bulk_mapping)
             self.logger.info("Bulk Google update done!")
 
-        sess.commit()
+        with self.profiler.phase("db commit"):
+            sess.commit()
+
+    @staticmethod
+    def _chunks(items, chunk_size=None):
+        """
+        Split a list into lists of at most `USERSYNC.db_chunk_size` items.
+        """
+        if chunk_size is None:
+            chunk_size = config.get("USERSYNC", {}).get("db_chunk_size", 1000)
+        chunk_size = max(1, chunk_size)
+        for i in range(0, len(items), chunk_size):
+            yield items[i : i + chunk_size]
+
+    def _get_user_access_privileges(self, sess):
+        """
+        Load the access privileges of all the users with a single query.
+
+        Args:
+            sess: sqlalchemy session
+
+        Return:
+            dict: {(username.lower(), project.auth_id): [(access_privilege.id, privilege)]}
+                (several users can have the same lowercase username)
+        """
+        access = defaultdict(list)
+        rows = (
+            sess.query(
+                AccessPrivilege.id,
+                func.lower(User.username),
+                Project.auth_id,
+                AccessPrivilege.privilege,
+            )
+            .join(User, AccessPrivilege.user_id == User.id)
+            .join(Project, AccessPrivilege.project_id == Project.id)
+        )
+        for access_id, username, project_auth_id, privilege in rows:
+            access[(username, project_auth_id)].append((access_id, privilege))
+        self.logger.info(
+            "loaded {} access privileges for {} (user, project) pairs".format(
+                sum(len(privileges) for privileges in access.values()), len(access)
+            )
+        )
+        return access
+
+    def _bulk_revoke_from_db(self, sess, to_delete, cur_db_access):
+        """
+        Same as `_revoke_from_db`, with DELETE statements for chunks of
+        access privileges instead of a query per (username, project).
+
+        Args:
+            sess: sqlalchemy session
+            to_delete: a set of (username, project.auth_id) to be revoked from db
+            cur_db_access: the current access, see `_get_user_access_privileges`
+        Return:
+            None
+        """
+        access_ids = []
+        for (username, project_auth_id) in sorted(to_delete):
+            self.logger.info(
+                "revoke {} access to {} in db".format(username, project_auth_id)
+            )
+            access_ids.extend(
+                access_id
+                for access_id, _ in cur_db_access.get((username, project_auth_id), [])
+            )
+        for chunk in self._chunks(access_ids):
+            sess.query(AccessPrivilege).filter(AccessPrivilege.id.in_(chunk)).delete(
+                synchronize_session=False
+            )
+        self.logger.info("revoked {} access privileges in db".format(len(access_ids)))
+
+    def _bulk_update_from_db(self, sess, to_update, user_project, cur_db_access):
+        """
+        Same as `_update_from_db`, with UPDATE statements for chunks of access
+        privileges instead of a query per (username, project). Access
+        privileges that did not change are not updated.
+
+        Args:
+            sess: sqlalchemy session
+            to_update:
+                a set of (username, project.auth_id) to be updated from db
+            user_project:
+                a dictionary of {username: {project: {'read','write'}}
+            cur_db_access: the current access, see `_get_user_access_privileges`
+        Return:
+            None
+        """
+        updates = []
+        for (username, project_auth_id) in sorted(to_update):
+            privilege = user_project[username][project_auth_id]
+            for access_id, current_privilege in cur_db_access.get(
+                (username, project_auth_id), []
+            ):
+                if set(current_privilege or []) == set(privilege):
+                    continue
+                self.logger.info(
+                    "update {} with {} access to {} in db".format(
+                        username, privilege, project_auth_id
+                    )
+                )
+                updates.append({"id": access_id, "privilege": list(privilege)})
+        for chunk in self._chunks(updates):
+            sess.bulk_update_mappings(AccessPrivilege, chunk)
+        self.logger.info(
+            "updated {} access privileges in db ({} unchanged)".format(
+                len(updates),
+                sum(len(cur_db_access.get(key, [])) for key in to_update)
+                - len(updates),
+            )
+        )
+
+    def _bulk_grant_from_db(
+        self, sess, to_add, user_info, user_project, auth_provider_list
+    ):
+        """
+        Same as `_grant_from_db`, with INSERT statements for chunks of access
+        privileges instead of a query per (username, project).
+
+        Args:
+            sess: sqlalchemy session
+            to_add: a set of (username, project.auth_id) to be granted
+            user_info: a dict of {username: user_info{}}
+            user_project:
+                a dictionary of {username: {project: {'read','write'}}
+            auth_provider_list: the dbGaP and fence authorization providers
+        Return:
+            None
+        """
+        # make sure the new users, projects and providers have an ID
+        sess.flush()
+        user_ids = {}
+        for username, user_id in sess.query(func.lower(User.username), User.id):
+            user_ids.setdefault(username, user_id)
+
+        inserts = []
+        for (username, project_auth_id) in sorted(to_add):
+            auth_provider = auth_provider_list[0]
+            if "dbgap_role" not in user_info[username]["tags"]:
+                auth_provider = auth_provider_list[1]
+            privilege = list(user_project[username][project_auth_id])
+            self.logger.info(
+                "grant user {} to {} with access {}".format(
+                    username, project_auth_id, privilege
+                )
+            )
+            inserts.append(
+                {
+                    "user_id": user_ids[username],
+                    "project_id": self._projects[project_auth_id].id,
+                    "privilege": privilege,
+                    "provider_id": auth_provider.id,
+                }
+            )
+        for chunk in self._chunks(inserts):
+            sess.bulk_insert_mappings(AccessPrivilege, chunk)
+        self.logger.info("granted {} access privileges in db".format(len(inserts)))
 
     def _revoke_from_db(self, sess, to_delete):
         """
@@ -812,7 +1302,7 @@ class UserSyncer(object):
                 )
                 sess.delete(access)
 
-    def _validate_and_update_user_admin(self, sess, user_info):
+    def _validate_and_update_user_admin(self, sess, user_info, usernames=None):
         """
         Make sure there is no admin user that is not in yaml/csv files
 
@@ -828,10 +1318,14 @@ class UserSyncer(object):
                     'admin': is_admin
                 }
             }
+            usernames: if provided, only check the admin users in this set of
+                lowercase usernames
         Returns:
             None
         """
         for admin_user in sess.query(User).filter_by(is_admin=True).all():
+            if usernames is not None and admin_user.username.lower() not in usernames:
+                continue
             if admin_user.username.lower() not in user_info:
                 admin_user.is_admin = False
                 sess.add(admin_user)
@@ -950,6 +1444,130 @@ class UserSyncer(object):
                     tag = Tag(key=k, value=v)
                     u.tags.append(tag)
 
+    def _bulk_upsert_userinfo(self, sess, user_info, arborist_users=None):
+        """
+        Same as `_upsert_userinfo`, but load all the users and their tags with
+        a single query, and only create the users that do not exist yet in
+        arborist.
+
+        Args:
+            sess: sqlalchemy session
+            user_info:
+                a dict of {username: {display_name, phone_number, tags, admin}
+
+        Return:
+            None
+        """
+        users = {}
+        for user in sess.query(User).options(joinedload(User.tags)):
+            users.setdefault(user.username.lower(), user)
+        self.logger.info("loaded {} users from the database".format(len(users)))
+
+        for username, info in user_info.items():
+            u = users.get(username.lower())
+            if u is None:
+                self.logger.info("create user {}".format(username))
+                u = User(username=username)
+                sess.add(u)
+                users[username.lower()] = u
+
+            u.email = info.get("email", "")
+            u.display_name = info.get("display_name", "")
+            u.phone_number = info.get("phone_number", "")
+            u.is_admin = info.get("admin", False)
+
+            # do not update if there is no tag
+            if not info.get("tags"):
+                continue
+
+            tags = {tag.key: tag for tag in u.tags}
+            # remove user db tags if they are not shown in new tags
+            for key, tag in tags.items():
+                if key not in info["tags"]:
+                    u.tags.remove(tag)
+            for key, value in info["tags"].items():
+                if key in tags:
+                    if tags[key].value != value:
+                        tags[key].value = value
+                else:
+                    u.tags.append(Tag(key=key, value=value))
+
+        if self.arborist_client:
+            self._create_missing_arborist_users(list(user_info), arborist_users)
+
+    def _get_arborist_users(self):
+        """
+        Return:
+            List[dict]: the users in arborist, with their policies
+        """
+        return self.arborist_client.get_users().json["users"]
+
+    def _load_arborist_users(self):
+        """
+        Load the users in arborist once for a sync, so that creating the
+        missing users and updating the user policies share the same list.
+
+        Return:
+            List[dict]: the users in arborist, or None if they cannot be
+                loaded, in which case they are loaded again when needed
+        """
+        try:
+            return self._get_arborist_users()
+        except (ArboristError, KeyError, AttributeError, TypeError) as e:
+            self.logger.warning("Could not get list of users in Arborist: {}".format(e))
+            return None
+
+    def _create_missing_arborist_users(self, usernames, arborist_users=None):
+        """
+        Create the users that do not exist yet in arborist, with up to
+        `USERSYNC.arborist_concurrency` threads. If the list of arborist
+        users is not provided and cannot be loaded, all the users are created.
+        """
+        try:
+            if arborist_users is None:
+                arborist_users = self._get_arborist_users()
+            existing = {user["name"].lower() for user in arborist_users}
+        except (ArboristError, KeyError, AttributeError, TypeError) as e:
+            self.logger.warning(
+                "Could not get list of users in Arborist, creating all the users: {}".format(
+                    e
+                )
+            )
+            existing = set()
+        missing = [
+            username for username in usernames if username.lower() not in existing
+        ]
+        if not missing:
+            return
+
+        start = time.time()
+        concurrency = config.get("USERSYNC", {}).get("arborist_concurrency", 10)
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {
+                executor.submit(
+                    self._call_arborist_with_retries,
+                    "create user",
+                    self.arborist_client.create_user_if_not_exist,
+                    username,
+                    none_is_error=False,
+                ): username
+                for username in missing
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(
+                        "Could not create user `{}` in arborist: {}".format(
+                            futures[future], e
+                        )
+                    )
+        self.logger.info(
+            "created {} users in arborist in {:.2f}s".format(
+                len(missing), time.time() - start
+            )
+        )
+
     def _revoke_from_storage(self, to_delete, sess, google_bulk_mapping=None):
         """
         If a project have storage backend, revoke user's access to buckets in
@@ -1081,9 +1699,7 @@ class UserSyncer(object):
             user_info (dict)
         """
         dbgap_file_list = []
-        hostname = dbgap_config["info"]["host"]
-        username = dbgap_config["info"]["username"]
-        folderdir = os.path.join(str(self.folder), str(hostname), str(username))
+        folderdir = self._get_dbgap_folder(dbgap_config)
 
         try:
             if os.path.exists(folderdir):
@@ -1140,6 +1756,14 @@ class UserSyncer(object):
         """
         merged_user_projects = {}
         merged_user_info = {}
+        # download the files of all the servers at once, then process them
+        self._download_from_servers(
+            [
+                dbgap
+                for dbgap in dbgap_servers
+                if not os.path.exists(self._get_dbgap_folder(dbgap))
+            ]
+        )
         for dbgap in dbgap_servers:
             user_projects, user_info = self._process_dbgap_files(dbgap, sess)
             # merge into merged_user_info
@@ -1251,14 +1875,62 @@ class UserSyncer(object):
 
     def sync(self):
         if self.session:
-            self._sync(self.session)
+            with self._profile(self.session):
+                self._sync(self.session)
         else:
-            with self.driver.session as s:
+            with self.driver.session as s, self._profile(s):
                 self._sync(s)
 
+    def _profile(self, sess):
+        """
+        Record the DB queries and outbound HTTP calls of the sync phases if
+        `USERSYNC.profiling` is enabled.
+        """
+        usersync_config = config.get("USERSYNC", {})
+        return self.profiler.profile(
+            sess,
+            enabled=usersync_config.get("profiling", False),
+            pushgateway=usersync_config.get("profiling_pushgateway"),
+        )
+
     def download(self):
-        for dbgap_server in self.dbGaP:
-            self._download(dbgap_server)
+        self._download_from_servers(self.dbGaP)
+
+    def _get_dbgap_folder(self, dbgap_config):
+        """
+        Return the local folder the files of a dbgap server are downloaded to.
+        """
+        hostname = dbgap_config["info"]["host"]
+        username = dbgap_config["info"]["username"]
+        return os.path.join(str(self.folder), str(hostname), str(username))
+
+    def _download_from_servers(self, dbgap_configs):
+        """
+        Download files from several dbgap servers in parallel.
+        """
+        # servers sharing a folder are only downloaded from once, like when
+        # they are downloaded one after another
+        dbgap_configs_by_folder = {}
+        for dbgap_config in dbgap_configs:
+            dbgap_configs_by_folder.setdefault(
+                self._get_dbgap_folder(dbgap_config), dbgap_config
+            )
+        if not dbgap_configs_by_folder:
+            return
+        with self.profiler.phase("download") as stats:
+            stats["rows"] = 0
+            with ThreadPoolExecutor(
+                max_workers=len(dbgap_configs_by_folder)
+            ) as executor:
+                for dbgap_files in executor.map(
+                    self._download, dbgap_configs_by_folder.values()
+                ):
+                    stats["rows"] += len(dbgap_files)
+            self.logger.info(
+                "Downloaded {} files from {} dbgap servers".format(
+                    stats["rows"], len(dbgap_configs_by_folder)
+                )
+            )
 
     def _download(self, dbgap_config):
         """
@@ -1266,9 +1938,7 @@ class UserSyncer(object):
         """
         server = dbgap_config["info"]
         protocol = dbgap_config["protocol"]
-        hostname = server["host"]
-        username = server["username"]
-        folderdir = os.path.join(str(self.folder), str(hostname), str(username))
+        folderdir = self._get_dbgap_folder(dbgap_config)
 
         if not os.path.exists(folderdir):
             os.makedirs(folderdir)
@@ -1290,6 +1960,28 @@ class UserSyncer(object):
         Collect files from dbgap server(s), sync csv and yaml files to storage
         backend and fence DB
         """
+        self.sync_errors = []
+        # with `USERSYNC.incremental_sync`, the sync is skipped if the input
+        # files did not change, and otherwise only the users whose access
+        # changed since the last sync are synced
+        fingerprint = None
+        previous_snapshot = None
+        if config.get("USERSYNC", {}).get("incremental_sync", False):
+            fingerprint = self._get_sync_fingerprint()
+            if not self.full_rebuild:
+                previous_snapshot = (
+                    sess.query(UserSyncSnapshot)
+                    .filter_by(name=USERSYNC_SNAPSHOT_NAME)
+                    .first()
+                )
+            if previous_snapshot and previous_snapshot.fingerprint == fingerprint:
+                self.logger.info(
+                    "The input files did not change since the last sync (at {}); "
+                    "skipping sync. Run a full rebuild to sync anyway".format(
+                        previous_snapshot.updated_at
+                    )
+                )
+                return
 
         # get all dbgap files
         user_projects = {}
@@ -1326,40 +2018,81 @@ class UserSyncer(object):
             self.logger.error("aborting early")
             return
 
-        # parse all projects
-        user_projects_csv = self.parse_projects(user_projects_csv)
-        user_projects = self.parse_projects(user_projects)
-        user_yaml.projects = self.parse_projects(user_yaml.projects)
+        with self.profiler.phase("merge") as stats:
+            # parse all projects
+            user_projects_csv = self.parse_projects(user_projects_csv)
+            user_projects = self.parse_projects(user_projects)
+            user_yaml.projects = self.parse_projects(user_yaml.projects)
 
-        # merge all user info dicts into "user_info".
-        # the user info (such as email) in the user.yaml files
-        # overrides the user info from the CSV files.
-        self.sync_two_user_info_dict(user_info_csv, user_info)
-        self.sync_two_user_info_dict(user_yaml.user_info, user_info)
+            # merge all user info dicts into "user_info".
+            # the user info (such as email) in the user.yaml files
+            # overrides the user info from the CSV files.
+            self.sync_two_user_info_dict(user_info_csv, user_info)
+            self.sync_two_user_info_dict(user_yaml.user_info, user_info)
 
-        # merge all access info dicts into "user_projects".
-        # the access info is combined - if the user.yaml access is
-        # ["read"] and the CSV file access is ["read-storage"], the
-        # resulting access is ["read", "read-storage"].
-        self.sync_two_phsids_dict(
-            user_projects_csv, user_projects, source1="local_csv", source2="dbgap"
-        )
-        self.sync_two_phsids_dict(
-            user_yaml.projects, user_projects, source1="user_yaml", source2="dbgap"
-        )
+            # merge all access info dicts into "user_projects".
+            # the access info is combined - if the user.yaml access is
+            # ["read"] and the CSV file access is ["read-storage"], the
+            # resulting access is ["read", "read-storage"].
+            self.sync_two_phsids_dict(
+                user_projects_csv, user_projects, source1="local_csv", source2="dbgap"
+            )
+            self.sync_two_phsids_dict(
+                user_yaml.projects, user_projects, source1="user_yaml", source2="dbgap"
+            )
 
-        # Note: if there are multiple dbgap sftp servers configured
-        # this parameter is always from the config for the first dbgap sftp server
-        # not any additional ones
-        if self.parse_consent_code:
-            self._grant_all_consents_to_c999_users(
-                user_projects, user_yaml.project_to_resource
+            # Note: if there are multiple dbgap sftp servers configured
+            # this parameter is always from the config for the first dbgap sftp server
+            # not any additional ones
+            if self.parse_consent_code:
+                self._grant_all_consents_to_c999_users(
+                    user_projects, user_yaml.project_to_resource
+                )
+            stats["rows"] = len(user_projects)
+
+        usernames = None
+        if fingerprint:
+            users_snapshot = self._get_users_snapshot(
+                user_projects, user_info, user_yaml
             )
+            if previous_snapshot and previous_snapshot.users is not None:
+                usernames = {
+                    username
+                    for username in set(users_snapshot) | set(previous_snapshot.users)
+                    if users_snapshot.get(username)
+                    != previous_snapshot.users.get(username)
+                }
+                self.logger.info(
+                    "{} users changed since the last sync (at {}); only syncing "
+                    "them".format(len(usernames), previous_snapshot.updated_at)
+                )
+                user_projects = {
+                    username: projects
+                    for username, projects in user_projects.items()
+                    if username.lower() in usernames
+                }
+                user_info = {
+                    username: info
+                    for username, info in user_info.items()
+                    if username.lower() in usernames
+                }
+
+        arborist_users = None
+        if self.arborist_client:
+            arborist_users = self._load_arborist_users()
 
         # update the Fence DB
-        if user_projects:
+        if user_projects or usernames:
             self.logger.info("Sync to db and storage backend")
-            self.sync_to_db_and_storage_backend(user_projects, user_info, sess)
+            with self.profiler.phase("sync to db and storage backend") as stats:
+                stats["rows"] = len(user_projects)
+                self.sync_to_db_and_storage_backend(
+                    user_projects,
+                    user_info,
+                    sess,
+                    usernames=usernames,
+                    arborist_users=arborist_users,
+                )
             self.logger.info("Finish syncing to db and storage backend")
         else:
             self.logger.info("No users for syncing")
@@ -1372,7 +2105,8 @@ class UserSyncer(object):
                     " arborist client--did you run sync with --arborist <arborist client> arg?"
                 )
             self.logger.info("Synchronizing arborist...")
-            success = self._update_arborist(sess, user_yaml)
+            with self.profiler.phase("arborist resources"):
+                success = self._update_arborist(sess, user_yaml)
             if success:
                 self.logger.info("Finished synchronizing arborist")
             else:
@@ -1384,7 +2118,15 @@ class UserSyncer(object):
         # update the Arborist DB (user access)
         if self.arborist_client:
             self.logger.info("Synchronizing arborist with authorization info...")
-            success = self._update_authz_in_arborist(sess, user_projects, user_yaml)
+            with self.profiler.phase("arborist user policies") as stats:
+                stats["rows"] = len(user_projects)
+                success = self._update_authz_in_arborist(
+                    sess,
+                    user_projects,
+                    user_yaml,
+                    usernames=usernames,
+                    arborist_users=arborist_users,
+                )
             if success:
                 self.logger.info(
                     "Finished synchronizing authorization info to arborist"
@@ -1401,6 +2143,97 @@ class UserSyncer(object):
         for u, s in self.auth_source.items():
             self.logger.info("Access for user {} from {}".format(u, s))
 
+        if fingerprint and self.sync_errors:
+            # the next sync is not skipped, and syncs again the users that
+            # changed since the last successful sync
+            self.logger.warning(
+                "Not saving the snapshot of the synced users: {}".format(
+                    "; ".join(self.sync_errors)
+                )
+            )
+        elif fingerprint:
+            sess.merge(
+                UserSyncSnapshot(
+                    name=USERSYNC_SNAPSHOT_NAME,
+                    fingerprint=fingerprint,
+                    users=users_snapshot,
+                )
+            )
+            sess.commit()
+
+    def _get_sync_fingerprint(self):
+        """
+        Return a hash of the usersync input: the dbGaP telemetry files, the
+        local CSV files, the user.yaml file and the dbGaP configuration.
+        """
+        file_list = []
+        if self.is_sync_from_dbgap_server:
+            # download the files first, so that the new files are hashed
+            self._download_from_servers(
+                [
+                    dbgap
+                    for dbgap in self.dbGaP
+                    if not os.path.exists(self._get_dbgap_folder(dbgap))
+                ]
+            )
+            for dbgap in self.dbGaP:
+                file_list.extend(
+                    glob.glob(os.path.join(self._get_dbgap_folder(dbgap), "*"))
+                )
+        if self.sync_from_local_csv_dir:
+            file_list.extend(glob.glob(os.path.join(self.sync_from_local_csv_dir, "*")))
+        if self.sync_from_local_yaml_file:
+            file_list.append(self.sync_from_local_yaml_file)
+
+        fingerprint = hashlib.sha256()
+        fingerprint.update(
+            json.dumps(
+                [self.dbGaP, self.project_mapping, bool(self.arborist_client)],
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        )
+        # the folders can change from one sync to the next, so only the file
+        # names are hashed
+        for filepath in sorted(file_list, key=os.path.basename):
+            if not os.path.isfile(filepath):
+                continue
+            fingerprint.update(os.path.basename(filepath).encode("utf-8"))
+            with open(filepath, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    fingerprint.update(block)
+        return fingerprint.hexdigest()
+
+    @staticmethod
+    def _get_users_snapshot(user_projects, user_info, user_yaml):
+        """
+        Return the access of each user, in a format that can be stored as
+        JSON and compared with the access computed by the next sync.
+
+        Return:
+            dict: {username.lower(): {"projects": {}, "info": {}, "abac": {}, "policies": []}}
+        """
+
+        def to_json(value):
+            if isinstance(value, dict):
+                return {str(key): to_json(item) for key, item in value.items()}
+            if isinstance(value, (set, frozenset)):
+                return sorted(to_json(item) for item in value)
+            if isinstance(value, (list, tuple)):
+                return [to_json(item) for item in value]
+            return value
+
+        users = defaultdict(dict)
+        for username, projects in user_projects.items():
+            users[username.lower()]["projects"] = to_json(projects)
+        for username, info in user_info.items():
+            users[username.lower()]["info"] = to_json(info)
+        for username, abac in user_yaml.user_abac.items():
+            users[username.lower()]["abac"] = to_json(abac)
+        for username, policies in user_yaml.policies.items():
+            users[username.lower()]["policies"] = sorted(policies)
+        return dict(users)
+
     def _grant_all_consents_to_c999_users(
         self, user_projects, user_yaml_project_to_resources
     ):
@@ -1589,7 +2422,13 @@ class UserSyncer(object):
         return True
 
     def _update_authz_in_arborist(
-        self, session, user_projects, user_yaml=None, single_user_sync=False
+        self,
+        session,
+        user_projects,
+        user_yaml=None,
+        single_user_sync=False,
+        usernames=None,
+        arborist_users=None,
     ):
         """
         Assign users policies in arborist from the information in
@@ -1602,6 +2441,10 @@ class UserSyncer(object):
         Args:
             user_projects (dict)
             user_yaml (UserYAML) optional, if there are policies for users in a user.yaml
+            usernames (set) optional, if provided only the policies of these
+                lowercase usernames are updated
+            arborist_users (List[dict]) optional, the users in arborist as
+                returned by `_get_arborist_users`, if already loaded
 
         Return:
             bool: success
@@ -1627,9 +2470,13 @@ class UserSyncer(object):
         # get list of users from arborist to make sure users that are completely removed
         # from authorization sources get policies revoked
         arborist_user_projects = {}
+        # {username.lower(): [{"policy": policy_id, "expires_at": ...}]}, only
+        # used by the diff-based sync
+        arborist_user_policies = None
         if not single_user_sync:
             try:
-                arborist_users = self.arborist_client.get_users().json["users"]
+                if arborist_users is None:
+                    arborist_users = self._get_arborist_users()
 
                 # construct user information, NOTE the lowering of the username. when adding/
                 # removing access, the case in the Fence db is used. For combining access, it is
@@ -1637,6 +2484,12 @@ class UserSyncer(object):
                 arborist_user_projects = {
                     user["name"].lower(): {} for user in arborist_users
                 }
+                if config.get("USERSYNC", {}).get("arborist_diff_sync", False):
+                    arborist_user_policies = {}
+                    for user in arborist_users:
+                        arborist_user_policies.setdefault(
+                            user["name"].lower(), []
+                        ).extend(user.get("policies") or [])
             except (ArboristError, KeyError, AttributeError) as error:
                 # TODO usersync should probably exit with non-zero exit code at the end,
                 #      but sync should continue from this point so there are no partial
@@ -1646,12 +2499,27 @@ class UserSyncer(object):
                     "WARNING: this sync will NOT remove access for users no longer in "
                     f"authorization sources. Error: {error}"
                 )
+                self.sync_errors.append("could not get the list of users in arborist")
 
             # update the project info with users from arborist
             self.sync_two_phsids_dict(arborist_user_projects, user_projects)
 
+        if usernames is not None:
+            user_projects = {
+                username: projects
+                for username, projects in user_projects.items()
+                if username.lower() in usernames
+            }
+            self.logger.info(
+                "only updating the policies of {} users".format(len(user_projects))
+            )
+
         policy_id_list = []
         policies = []
+        # when syncing all the users, the policies are created and granted in
+        # bulk after this loop (see `_push_user_policies_to_arborist`)
+        new_policies = []
+        user_policy_ids = {}
 
         for username, user_project_info in user_projects.items():
             self.logger.info("processing user `{}`".format(username))
@@ -1659,8 +2527,11 @@ class UserSyncer(object):
             if user:
                 username = user.username
 
-            self.arborist_client.create_user_if_not_exist(username)
-            self.arborist_client.revoke_all_policies_for_user(username)
+            if single_user_sync:
+                self.arborist_client.create_user_if_not_exist(username)
+                self.arborist_client.revoke_all_policies_for_user(username)
+            else:
+                user_policy_ids.setdefault(username, [])
             for project, permissions in user_project_info.items():
 
                 # check if this is a dbgap project, if it is, we need to get the right
@@ -1704,24 +2575,16 @@ class UserSyncer(object):
 
                         if not single_user_sync:
                             if policy_id not in self._created_policies:
-                                try:
-                                    self.arborist_client.update_policy(
-                                        policy_id,
-                                        {
-                                            "description": "policy created by fence sync",
-                                            "role_ids": [permission],
-                                            "resource_paths": [path],
-                                        },
-                                        create_if_not_exist=True,
-                                    )
-                                except ArboristError as e:
-                                    self.logger.info(
-                                        "not creating policy in arborist; {}".format(
-                                            str(e)
-                                        )
-                                    )
+                                new_policies.append(
+                                    {
+                                        "id": policy_id,
+                                        "description": "policy created by fence sync",
+                                        "role_ids": [permission],
+                                        "resource_paths": [path],
+                                    }
+                                )
                                 self._created_policies.add(policy_id)
-                            self.arborist_client.grant_user_policy(username, policy_id)
+                            user_policy_ids[username].append(policy_id)
 
                         if single_user_sync:
                             policy_id_list.append(policy_id)
@@ -1748,7 +2611,15 @@ class UserSyncer(object):
 
             if user_yaml:
                 for policy in user_yaml.policies.get(username, []):
-                    self.arborist_client.grant_user_policy(username, policy)
+                    if single_user_sync:
+                        self.arborist_client.grant_user_policy(username, policy)
+                    else:
+                        user_policy_ids[username].append(policy)
+
+        if not single_user_sync:
+            self._push_user_policies_to_arborist(
+                new_policies, user_policy_ids, arborist_user_policies
+            )
 
         if user_yaml:
             for client_name, client_details in user_yaml.clients.items():
@@ -1775,6 +2646,247 @@ class UserSyncer(object):
 
         return True
 
+    def _push_user_policies_to_arborist(
+        self, new_policies, user_policy_ids, arborist_user_policies=None
+    ):
+        """
+        Create the new policies in bulk, then update the policies of each
+        user. The users are updated in parallel by up to
+        `USERSYNC.arborist_concurrency` threads, and the calls that fail are
+        retried `USERSYNC.arborist_retries` times with an exponential backoff.
+
+        Args:
+            new_policies (List[dict]): policies to create or update
+            user_policy_ids (dict): {username: [policy IDs to grant]}
+            arborist_user_policies (dict): the current policies of the users
+                in arborist, {username.lower(): [{"policy": policy_id}]}. If
+                provided, only the policies that changed are granted and
+                revoked. Otherwise all the policies of each user are revoked
+                and granted again.
+        """
+        start = time.time()
+        for chunk in self._chunks(new_policies, ARBORIST_BULK_POLICY_CHUNK_SIZE):
+            try:
+                response = self._call_arborist_with_retries(
+                    "update bulk policy", self.arborist_client.update_bulk_policy, chunk
+                )
+                if not response.successful:
+                    raise ArboristError(response.error_msg, response.code)
+            except ArboristError as e:
+                self.logger.info(
+                    "Couldn't update bulk policy, updating the policies one by one: {}".format(
+                        e
+                    )
+                )
+                for policy in chunk:
+                    policy = dict(policy)
+                    try:
+                        self.arborist_client.update_policy(
+                            policy.pop("id"), policy, create_if_not_exist=True
+                        )
+                    except ArboristError as e:
+                        self.logger.info(
+                            "not creating policy in arborist; {}".format(str(e))
+                        )
+        self.logger.info(
+            "updated {} policies in arborist in {:.2f}s".format(
+                len(new_policies), time.time() - start
+            )
+        )
+
+        start = time.time()
+        total = len(user_policy_ids)
+        done = 0
+        failed = []
+        # number of users, and of policies, granted and revoked
+        summary = {
+            "unchanged_users": 0,
+            "added_users": 0,
+            "revoked_users": 0,
+            "granted_policies": 0,
+            "revoked_policies": 0,
+        }
+        report_every = max(1, total // 10)
+        concurrency = config.get("USERSYNC", {}).get("arborist_concurrency", 10)
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {}
+            for username, policy_ids in user_policy_ids.items():
+                current_policies = None
+                if arborist_user_policies is not None:
+                    current_policies = arborist_user_policies.get(username.lower(), [])
+                future = executor.submit(
+                    self._push_user_policy_ids_to_arborist,
+                    username,
+                    policy_ids,
+                    current_policies,
+                )
+                futures[future] = username
+            for future in as_completed(futures):
+                done += 1
+                try:
+                    granted, revoked = future.result()
+                except Exception as e:
+                    self.logger.error(
+                        "Could not update the policies of user `{}` in arborist: {}".format(
+                            futures[future], e
+                        )
+                    )
+                    failed.append(futures[future])
+                else:
+                    summary["granted_policies"] += granted
+                    summary["revoked_policies"] += revoked
+                    if granted:
+                        summary["added_users"] += 1
+                    if revoked:
+                        summary["revoked_users"] += 1
+                    if not granted and not revoked:
+                        summary["unchanged_users"] += 1
+                if done % report_every == 0 or done == total:
+                    elapsed = time.time() - start
+                    self.logger.info(
+                        "updated {}/{} users in arborist ({} failed) in {:.2f}s: {:.1f} users/s".format(
+                            done,
+                            total,
+                            len(failed),
+                            elapsed,
+                            done / elapsed if elapsed else float(done),
+                        )
+                    )
+        if failed:
+            self.logger.error(
+                "Could not update the policies of {} users in arborist: {}".format(
+                    len(failed), failed
+                )
+            )
+            self.sync_errors.append(
+                "could not update the policies of {} users in arborist".format(
+                    len(failed)
+                )
+            )
+        self.logger.info(
+            "arborist user policies: {} users unchanged, {} users with added "
+            "policies ({} policies), {} users with revoked policies ({} policies)".format(
+                summary["unchanged_users"],
+                summary["added_users"],
+                summary["granted_policies"],
+                summary["revoked_users"],
+                summary["revoked_policies"],
+            )
+        )
+        return summary
+
+    def _push_user_policy_ids_to_arborist(
+        self, username, policy_ids, current_policies=None
+    ):
+        """
+        Make sure the user exists in arborist and update its policies.
+
+        Args:
+            username (str)
+            policy_ids (List[str]): the policies the user should have
+            current_policies (List[dict]): the current policies of the user
+                in arborist. If None, all the policies of the user are
+                revoked and granted again.
+
+        Return:
+            Tuple[int, int]: the numbers of granted and revoked policies
+        """
+        if current_policies is None:
+            self._call_arborist_with_retries(
+                "create user",
+                self.arborist_client.create_user_if_not_exist,
+                username,
+                none_is_error=False,
+            )
+            self._call_arborist_with_retries(
+                "revoke all policies for user",
+                self.arborist_client.revoke_all_policies_for_user,
+                username,
+            )
+            to_grant = list(policy_ids)
+            revoked = 0
+        else:
+            if not current_policies:
+                # the user may not exist in arborist yet
+                self._call_arborist_with_retries(
+                    "create user",
+                    self.arborist_client.create_user_if_not_exist,
+                    username,
+                    none_is_error=False,
+                )
+            desired = set(policy_ids)
+            # policies granted with an expiration (for example from visas)
+            # are granted again without expiration, like in a full sync
+            current_without_expiration = {
+                policy["policy"]
+                for policy in current_policies
+                if not policy.get("expires_at")
+            }
+            to_revoke = sorted(
+                {policy["policy"] for policy in current_policies} - desired
+            )
+            to_grant = sorted(desired - current_without_expiration)
+            for policy_id in to_revoke:
+                self._call_arborist_with_retries(
+                    "revoke user policy",
+                    self.arborist_client.revoke_user_policy,
+                    username,
+                    policy_id,
+                )
+            revoked = len(to_revoke)
+
+        if not to_grant:
+            return 0, revoked
+        try:
+            self._call_arborist_with_retries(
+                "grant bulk user policy",
+                self.arborist_client.grant_bulk_user_policy,
+                username,
+                to_grant,
+            )
+        except ArboristError as e:
+            # a policy that does not exist makes the whole bulk grant fail
+            self.logger.info(
+                "Couldn't grant bulk policy to user {}, granting the policies one by one: {}".format(
+                    username, e
+                )
+            )
+            for policy_id in to_grant:
+                self.arborist_client.grant_user_policy(username, policy_id)
+        return len(to_grant), revoked
+
+    def _call_arborist_with_retries(
+        self, description, arborist_method, *args, none_is_error=True
+    ):
+        """
+        Call an arborist client method, and retry with an exponential backoff
+        if arborist cannot be reached or returns a server error.
+
+        Most of the client methods log the error and return None instead of
+        raising an exception. None and client errors (4xx) are not retried:
+        they are returned for requests that would fail again, such as granting
+        a policy that does not exist, so the caller can fall back right away.
+        """
+        usersync_config = config.get("USERSYNC", {})
+        retries = max(0, usersync_config.get("arborist_retries", 3))
+        backoff = usersync_config.get("arborist_retry_backoff", 1)
+        for attempt in range(retries + 1):
+            try:
+                result = arborist_method(*args)
+            except (ArboristError, httpx.HTTPError) as e:
+                code = getattr(e, "code", None)
+                if attempt == retries or (code is not None and code < 500):
+                    raise
+                delay = backoff * 2 ** attempt
+                self.logger.warning(
+                    "{} failed, retrying in {}s: {}".format(description, delay, e)
+                )
+                time.sleep(delay)
+                continue
+            if result is None and none_is_error:
+                raise ArboristError("{} failed".format(description), None)
+            return result
+
     def _add_dbgap_study_to_arborist(self, dbgap_study, dbgap_config):
         """
         Return the arborist resource path after adding the specified dbgap study
@@ -1937,7 +3049,9 @@ class UserSyncer(object):
         self.ras_sync_client = RASVisa(logger=self.logger)
 
         dbgap_config = self.dbGaP[0]
-        user_projects, user_info = self.parse_user_visas(sess)
+        with self.profiler.phase("visa parsing") as stats:
+            user_projects, user_info = self.parse_user_visas(sess)
+            stats["rows"] = len(user_projects)
         enable_common_exchange_area_access = dbgap_config.get(
             "enable_common_exchange_area_access", False
         )
@@ -2050,10 +3164,18 @@ class UserSyncer(object):
             self._grant_all_consents_to_c999_users(
                 user_projects, user_yaml.project_to_resource
             )
+        arborist_users = None
+        if self.arborist_client:
+            arborist_users = self._load_arborist_users()
+
         # update fence db
         if user_projects:
             self.logger.info("Sync to db and storage backend")
-            self.sync_to_db_and_storage_backend(user_projects, user_info, sess)
+            with self.profiler.phase("sync to db and storage backend") as stats:
+                stats["rows"] = len(user_projects)
+                self.sync_to_db_and_storage_backend(
+                    user_projects, user_info, sess, arborist_users=arborist_users
+                )
         else:
             self.logger.info("No users for syncing")
 
@@ -2065,7 +3187,8 @@ class UserSyncer(object):
                     " arborist client--did you run sync with --arborist <arborist client> arg?"
                 )
             self.logger.info("Synchronizing arborist...")
-            success = self._update_arborist(sess, user_yaml)
+            with self.profiler.phase("arborist resources"):
+                success = self._update_arborist(sess, user_yaml)
             if success:
                 self.logger.info("Finished synchronizing arborist")
             else:
@@ -2077,7 +3200,11 @@ class UserSyncer(object):
         # update arborist db (user access)
         if self.arborist_client:
             self.logger.info("Synchronizing arborist with authorization info...")
-            success = self._update_authz_in_arborist(sess, user_projects, user_yaml)
+            with self.profiler.phase("arborist user policies") as stats:
+                stats["rows"] = len(user_projects)
+                success = self._update_authz_in_arborist(
+                    sess, user_projects, user_yaml, arborist_users=arborist_users
+                )
             if success:
                 self.logger.info(
                     "Finished synchronizing authorization info to arborist"
@@ -2096,9 +3223,10 @@ class UserSyncer(object):
 
     def sync_visas(self):
         if self.session:
-            self._sync_visas(self.session)
+            with self._profile(self.session):
+                self._sync_visas(self.session)
         else:
-            with self.driver.session as s:
+            with self.driver.session as s, self._profile(s):
                 self._sync_visas(s)
         # if returns with some failure use telemetry file
 
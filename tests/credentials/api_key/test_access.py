@@ -4,6 +4,10 @@ Test using an API key to generate an access token.
 
 import json
 
+import pytest
+
+import fence.resources.storage.cdis_jwt
+from fence.config import config
 from tests.utils.api_key import get_api_key
 
 
@@ -39,3 +43,47 @@ def test_cdis_get_access_token_with_formdata(client, oauth_client, encoded_creds
         headers={"Authorization": "Bearer " + str(encoded_credentials_jwt)},
     )
     assert "access_token" in response.json
+
+
+@pytest.fixture
+def api_key_access_token_cache(monkeypatch):
+    monkeypatch.setitem(
+        config,
+        "API_KEY_ACCESS_TOKEN_CACHE",
+        {"enabled": True, "max_size": 10, "max_age": 300},
+    )
+    monkeypatch.setattr(
+        fence.resources.storage.cdis_jwt, "_api_key_access_tokens", None
+    )
+
+
+def test_cdis_get_access_token_cached(
+    client, oauth_client, encoded_creds_jwt, api_key_access_token_cache
+):
+    """
+    Exchanging the same API key again should return the same access token,
+    until the API key is deleted.
+    """
+    encoded_credentials_jwt = encoded_creds_jwt["jwt"]
+    response = get_api_key(client, encoded_credentials_jwt)
+    api_key = response.json["api_key"]
+    key_id = response.json["key_id"]
+    path = "/credentials/cdis/access_token"
+    data = {"api_key": api_key}
+
+    access_tokens = [
+        client.post(path, data=data).json["access_token"] for _ in range(3)
+    ]
+    assert len(set(access_tokens)) == 1
+
+    # a token with a different lifetime is not reused
+    response = client.post(path + "?expires_in=600", data=data)
+    assert response.json["access_token"] != access_tokens[0]
+
+    response = client.delete(
+        "/credentials/cdis/" + key_id,
+        headers={"Authorization": "Bearer " + str(encoded_credentials_jwt)},
+    )
+    assert response.status_code == 204
+    response = client.post(path, data=data)
+    assert response.status_code == 401
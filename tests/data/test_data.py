@@ -1,4 +1,5 @@
 import json
+import threading
 import time
 
 from datetime import datetime, timedelta
@@ -12,6 +13,8 @@ import pytest
 import requests
 
 import fence.blueprints.data.indexd
+import fence.cache
+import fence.jwt.validate
 from fence.config import config
 
 from tests import utils
@@ -92,6 +95,107 @@ def test_indexd_download_file(
     assert urllib.parse.urlparse(response.json["url"]).query != ""
 
 
+@pytest.mark.parametrize("indexd_client", ["gs", "s3"], indirect=True)
+def test_indexd_download_file_verifies_token_once(
+    client,
+    oauth_client,
+    user_client,
+    indexd_client,
+    kid,
+    rsa_private_key,
+    google_proxy_group,
+    primary_google_service_account,
+    cloud_manager,
+    google_signed_url,
+):
+    """
+    Test that ``GET /data/download/1`` validates the bearer token several
+    times, but only verifies its RSA signature once.
+    """
+    token = jwt.encode(
+        utils.authorized_download_context_claims(
+            user_client.username, user_client.user_id
+        ),
+        key=rsa_private_key,
+        headers={"kid": kid},
+        algorithm="RS256",
+    ).decode("utf-8")
+    signing_input = token.rsplit(".", 1)[0].encode("utf-8")
+
+    verify_signature = jwt.api_jws.PyJWS._verify_signature
+    validate_jwt = fence.jwt.validate.authutils.token.core.validate_jwt
+    with patch(
+        "jwt.api_jws.PyJWS._verify_signature",
+        autospec=True,
+        side_effect=verify_signature,
+    ) as mocked_verify_signature, patch(
+        "fence.jwt.validate.authutils.token.core.validate_jwt",
+        side_effect=validate_jwt,
+    ) as mocked_validate_jwt:
+        response = client.get(
+            "/data/download/1",
+            headers={"Authorization": "Bearer " + token},
+            query_string={"protocol": indexd_client["indexed_file_location"]},
+        )
+    assert response.status_code == 200
+
+    validations = [
+        call for call in mocked_validate_jwt.call_args_list if call[0][0] == token
+    ]
+    verifications = [
+        call
+        for call in mocked_verify_signature.call_args_list
+        if call[0][2] == signing_input
+    ]
+    # without the per-request memoization, each validation verifies the
+    # signature again
+    assert len(validations) > 1
+    assert len(verifications) == 1
+
+
+@pytest.mark.parametrize("indexd_client", ["s3"], indirect=True)
+def test_indexd_download_file_bucket_region_cached(
+    app,
+    client,
+    oauth_client,
+    user_client,
+    indexd_client,
+    kid,
+    rsa_private_key,
+    google_proxy_group,
+    primary_google_service_account,
+    cloud_manager,
+    google_signed_url,
+):
+    """
+    Test that ``GET /data/download/1`` for a bucket without a configured
+    region uses the region fetched when the app started, instead of calling
+    GetBucketLocation.
+    """
+    assert not config["S3_BUCKETS"]["bucket1"].get("region")
+    assert app.s3_bucket_regions.get_region("bucket1", {}, None) == "us-east-1"
+
+    token = jwt.encode(
+        utils.authorized_download_context_claims(
+            user_client.username, user_client.user_id
+        ),
+        key=rsa_private_key,
+        headers={"kid": kid},
+        algorithm="RS256",
+    ).decode("utf-8")
+    with patch(
+        "fence.resources.aws.boto_manager.BotoManager.get_bucket_region"
+    ) as mocked_get_bucket_region:
+        for _ in range(2):
+            response = client.get(
+                "/data/download/1",
+                headers={"Authorization": "Bearer " + token},
+                query_string={"protocol": indexd_client["indexed_file_location"]},
+            )
+            assert response.status_code == 200
+    mocked_get_bucket_region.assert_not_called()
+
+
 @pytest.mark.parametrize("indexd_client", ["s3"], indirect=True)
 def test_indexd_prometheus_presigned_url_counter(
     app,
@@ -890,7 +994,7 @@ def test_blank_index_upload(app, client, auth_client, encoded_creds_jwt, user_cl
             return self.data
 
     data_requests_mocker = mock.patch(
-        "fence.blueprints.data.indexd.requests", new_callable=mock.Mock
+        "fence.http_client.indexd", new_callable=mock.Mock
     )
     arborist_requests_mocker = mock.patch(
         "gen3authz.client.arborist.client.httpx.Client.request", new_callable=mock.Mock
@@ -943,7 +1047,7 @@ def test_blank_index_upload_authz(
             return self.data
 
     data_requests_mocker = mock.patch(
-        "fence.blueprints.data.indexd.requests", new_callable=mock.Mock
+        "fence.http_client.indexd", new_callable=mock.Mock
     )
     arborist_requests_mocker = mock.patch(
         "gen3authz.client.arborist.client.httpx.Client.request", new_callable=mock.Mock
@@ -1095,7 +1199,9 @@ def test_assume_role_time_limit(
     Test ``GET /data/download/1`` accessing data from bucket by assuming role.
     """
 
-    fence.S3IndexedFileLocation._assume_role_cache.clear()
+    fence.S3IndexedFileLocation._get_assume_role_cache().clear()
+    # the mocked STS client should be built for each test
+    fence.app.boto.clients.clear()
 
     monkeypatch.setitem(
         config, "MAX_ROLE_SESSION_INCREASE", test_max_role_session_increase
@@ -1236,20 +1342,23 @@ def test_assume_role_cache(
     assert assume_role_called == 1
 
     # use database cache if in-memory cache is missing
-    fence.S3IndexedFileLocation._assume_role_cache.clear()
+    assume_role_cache = fence.S3IndexedFileLocation._get_assume_role_cache()
+    assume_role_cache.clear()
     response = client.get(path, headers=headers, query_string=query_string)
     assert response.status_code == 200
     assert assume_role_called == 1
 
     # use database cache if in-memory cache is expired
-    arn, vals = list(fence.S3IndexedFileLocation._assume_role_cache.items())[0]
-    fence.S3IndexedFileLocation._assume_role_cache[arn] = vals[0], time.time() - 10
+    arn = config["S3_BUCKETS"]["bucket5"]["role-arn"]
+    cached = assume_role_cache.get(arn)
+    cached["expires_at"] = time.time() - 10
+    assume_role_cache.set(arn, cached)
     response = client.get(path, headers=headers, query_string=query_string)
     assert response.status_code == 200
     assert assume_role_called == 1
 
     # in-memory cache is missing and database cache is expired
-    fence.S3IndexedFileLocation._assume_role_cache.clear()
+    assume_role_cache.clear()
     import flask
 
     with flask.current_app.db.session as session:
@@ -1260,10 +1369,207 @@ def test_assume_role_cache(
     assert response.status_code == 200
     assert assume_role_called == 2
 
+
+def mock_boto_assume_role(calls, delay=0):
+    """
+    Return a mock `BotoManager` whose `assume_role` appends the role ARN to
+    `calls` and returns new credentials, after `delay` seconds.
+    """
+
+    def assume_role(role_arn, duration_seconds, config=None):
+        time.sleep(delay)
+        calls.append(role_arn)
+        return {
+            "Credentials": {
+                "AccessKeyId": "key-{}".format(len(calls)),
+                "SecretAccessKey": "",
+                "SessionToken": "",
+                "Expiration": datetime.now() + timedelta(seconds=duration_seconds),
+            },
+            "AssumedRoleUser": {"AssumedRoleId": "", "Arn": role_arn},
+        }
+
+    return MagicMock(assume_role=assume_role)
+
+
+def test_assume_role_single_flight(app):
+    """
+    When many threads need credentials for the same role at once, only one of
+    them should call AWS STS.
+    """
+    bucket_cred = {"role-arn": "arn:aws:iam::123:role/{}".format(uuid.uuid4())}
+    calls = []
+    boto = mock_boto_assume_role(calls, delay=0.2)
+    results = []
+
+    def get_credentials():
+        with app.app_context():
+            results.append(
+                fence.S3IndexedFileLocation.assume_role(bucket_cred, 900, {}, boto)
+            )
+
+    threads = [threading.Thread(target=get_credentials) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert [r["aws_access_key_id"] for r in results] == ["key-1"] * 5
+
+
+def test_assume_role_refresh_before_expiry(app, monkeypatch):
+    """
+    Cached credentials that will soon be too old should be refreshed by a
+    single request, while the others keep using the cached credentials.
+    """
+    monkeypatch.setitem(
+        config,
+        "ASSUME_ROLE_SHARED_CACHE",
+        {"max_size": 10, "refresh_before_expiry": 300, "redis_url": None},
+    )
+    role_arn = "arn:aws:iam::123:role/{}".format(uuid.uuid4())
+    bucket_cred = {"role-arn": role_arn}
+    calls = []
+    boto = mock_boto_assume_role(calls)
+    cached_credentials = {
+        "aws_access_key_id": "cached",
+        "aws_secret_access_key": "",
+        "aws_session_token": "",
+    }
+    fence.S3IndexedFileLocation._get_assume_role_cache().set(
+        role_arn,
+        {
+            "credentials": cached_credentials,
+            # usable for 900 more seconds, but not for 900 + 300
+            "expires_at": time.time() + 900 + 100,
+        },
+    )
+
+    # another thread is already refreshing the credentials
+    lock = fence.S3IndexedFileLocation._get_assume_role_lock(role_arn)
+    with lock:
+        credentials = fence.S3IndexedFileLocation.assume_role(
+            bucket_cred, 900, {}, boto
+        )
+    assert credentials == cached_credentials
+    assert calls == []
+
+    credentials = fence.S3IndexedFileLocation.assume_role(bucket_cred, 900, {}, boto)
+    assert credentials["aws_access_key_id"] == "key-1"
+    assert calls == [role_arn]
+
     assume_role_patcher.stop()
     mock_index_document.stop()
 
 
+def mock_get_or_create_primary_service_account_key(calls, expires, delay=0):
+    """
+    Return a mock `get_or_create_primary_service_account_key` which appends
+    the proxy group ID to `calls` and returns a key expiring at `expires`,
+    after `delay` seconds.
+    """
+
+    def get_or_create_primary_service_account_key(user_id, username, proxy_group_id):
+        time.sleep(delay)
+        calls.append(proxy_group_id)
+        private_key = {"private_key_id": "key-{}".format(len(calls))}
+        return private_key, MagicMock(expires=expires)
+
+    return get_or_create_primary_service_account_key
+
+
+def test_google_signing_key_single_flight(app):
+    """
+    When many threads need the signing key of the same proxy group at once,
+    only one of them should read or create the service account key.
+    """
+    proxy_group_id = str(uuid.uuid4())
+    calls = []
+    results = []
+
+    def get_signing_key():
+        with app.app_context():
+            results.append(
+                fence.blueprints.data.indexd.GoogleStorageIndexedFileLocation.get_signing_key(
+                    proxy_group_id, 1, "user", int(time.time()) + 100
+                )
+            )
+
+    with patch(
+        "fence.blueprints.data.indexd.get_or_create_primary_service_account_key",
+        mock_get_or_create_primary_service_account_key(
+            calls, int(time.time()) + 3600, delay=0.2
+        ),
+    ):
+        threads = [threading.Thread(target=get_signing_key) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert calls == [proxy_group_id]
+    assert [r["private_key_id"] for r in results] == ["key-1"] * 5
+
+
+def test_google_signing_key_cache(app, monkeypatch):
+    """
+    The signing key should be reused from the in-memory cache, then from the
+    database cache, until it expires before the signed URL. The keys should
+    never be stored in Redis without encryption.
+    """
+    location = fence.blueprints.data.indexd.GoogleStorageIndexedFileLocation
+    proxy_group_id = str(uuid.uuid4())
+    calls = []
+    key_expires = int(time.time()) + 3600
+
+    with patch(
+        "fence.blueprints.data.indexd.get_or_create_primary_service_account_key",
+        mock_get_or_create_primary_service_account_key(calls, key_expires),
+    ), patch(
+        "fence.blueprints.data.indexd.create_primary_service_account_key",
+        return_value={"private_key_id": "new-key"},
+    ) as create_key:
+        key = location.get_signing_key(
+            proxy_group_id, 1, "user", int(time.time()) + 100
+        )
+        assert key == {"private_key_id": "key-1"}
+        cached = location._get_signing_key_cache().get(proxy_group_id)
+        assert cached["expires_at"] == key_expires
+
+        # in-memory cache
+        location.get_signing_key(proxy_group_id, 1, "user", int(time.time()) + 100)
+        assert len(calls) == 1
+
+        # use database cache if in-memory cache is missing
+        location._get_signing_key_cache().delete(proxy_group_id)
+        key = location.get_signing_key(
+            proxy_group_id, 1, "user", int(time.time()) + 100
+        )
+        assert key == {"private_key_id": "key-1"}
+        assert len(calls) == 1
+
+        # the key expires before the signed URL: a new key is created
+        key = location.get_signing_key(proxy_group_id, 1, "user", key_expires + 100)
+        assert key == {"private_key_id": "new-key"}
+        assert len(calls) == 2
+        assert create_key.call_count == 1
+
+    location._get_signing_key_cache().delete(proxy_group_id)
+
+    # a Redis cache cannot be used without an encryption key
+    monkeypatch.setitem(
+        config,
+        "ASSUME_ROLE_SHARED_CACHE",
+        dict(config["ASSUME_ROLE_SHARED_CACHE"], redis_url="redis://localhost:6379"),
+    )
+    monkeypatch.setitem(config, "ENCRYPTION_KEY", "")
+    monkeypatch.setattr(location, "_signing_key_cache", None)
+    monkeypatch.setattr(fence.cache, "redis", MagicMock())
+    with pytest.raises(Exception, match="encryption key is empty"):
+        location.get_signing_key(proxy_group_id, 1, "user", int(time.time()) + 100)
+
+
 def test_indexd_download_with_uploader_unauthorized(
     client,
     oauth_client,
@@ -1341,7 +1647,7 @@ def test_delete_file_no_auth(app, client, encoded_creds_jwt):
     )
     mock_index_document.start()
     headers = {"Authorization": "Bearer " + encoded_creds_jwt.jwt}
-    with mock.patch("fence.blueprints.data.indexd.requests.put"):
+    with mock.patch("fence.http_client.indexd.put"):
         response = client.delete("/data/{}".format(did), headers=headers)
         assert response.status_code == 403
     mock_index_document.stop()
@@ -1400,7 +1706,7 @@ def test_delete_file_locations(
     mock_delete_response.status_code = 200
     mock_delete = mock.MagicMock(requests.put, return_value=mock_delete_response)
     with mock.patch(
-        "fence.blueprints.data.indexd.requests.delete", mock_delete
+        "fence.http_client.indexd.delete", mock_delete
     ), arborist_requests_mocker as arborist_requests:
         arborist_requests.return_value = MockResponse({"auth": True})
         arborist_requests.return_value.status_code = 200
@@ -1481,7 +1787,7 @@ def test_delete_file_locations_by_uploader(
     mock_delete_response.status_code = 200
     mock_delete = mock.MagicMock(requests.put, return_value=mock_delete_response)
     with mock.patch(
-        "fence.blueprints.data.indexd.requests.delete", mock_delete
+        "fence.http_client.indexd.delete", mock_delete
     ), arborist_requests_mocker as arborist_requests, mock_gcm as mock_gcm_2:
         arborist_requests.return_value = MockResponse({"auth": True})
         arborist_requests.return_value.status_code = 200
@@ -1507,7 +1813,7 @@ def test_blank_index_upload_unauthorized(
             return self.data
 
     data_requests_mocker = mock.patch(
-        "fence.blueprints.data.indexd.requests", new_callable=mock.Mock
+        "fence.http_client.indexd", new_callable=mock.Mock
     )
     arborist_requests_mocker = mock.patch(
         "gen3authz.client.arborist.client.httpx.Client.request", new_callable=mock.Mock
@@ -1581,7 +1887,7 @@ def test_initialize_multipart_upload(
             return self.data
 
     data_requests_mocker = mock.patch(
-        "fence.blueprints.data.indexd.requests", new_callable=mock.Mock
+        "fence.http_client.indexd", new_callable=mock.Mock
     )
     arborist_requests_mocker = mock.patch(
         "gen3authz.client.arborist.client.httpx.Client.request", new_callable=mock.Mock
@@ -1635,7 +1941,7 @@ def test_multipart_upload_presigned_url(
             return self.data
 
     data_requests_mocker = mock.patch(
-        "fence.blueprints.data.indexd.requests", new_callable=mock.Mock
+        "fence.http_client.indexd", new_callable=mock.Mock
     )
     arborist_requests_mocker = mock.patch(
         "gen3authz.client.arborist.client.httpx.Client.request", new_callable=mock.Mock
@@ -1684,7 +1990,7 @@ def test_multipart_complete_upload(
             return self.data
 
     data_requests_mocker = mock.patch(
-        "fence.blueprints.data.indexd.requests", new_callable=mock.Mock
+        "fence.http_client.indexd", new_callable=mock.Mock
     )
     arborist_requests_mocker = mock.patch(
         "gen3authz.client.arborist.client.httpx.Client.request", new_callable=mock.Mock
@@ -1786,3 +2092,139 @@ def test_delete_files(app, client, auth_client, encoded_creds_jwt, user_client):
         assert status == 400
 
     fence.auth.config["MOCK_AUTH"] = False
+
+
+def test_bulk_download_files(
+    app,
+    client,
+    indexd_client_accepting_record,
+    mock_arborist_requests,
+    user_client,
+    rsa_private_key,
+    kid,
+):
+    """
+    Test ``POST /data/download``: the records are fetched from indexd in bulk,
+    records sharing an `authz` share an Arborist call and errors are reported
+    per file.
+    """
+    indexd_client_accepting_record(INDEXD_RECORD_WITH_PUBLIC_AUTHZ_POPULATED)
+    mock_arborist_requests({"arborist/auth/request": {"POST": ({"auth": True}, 200)}})
+    records = {}
+    for guid in ["1", "2"]:
+        records[guid] = dict(INDEXD_RECORD_WITH_PUBLIC_AUTHZ_POPULATED, did=guid)
+        records[guid]["authz"] = ["/programs/a"]
+    headers = {
+        "Authorization": "Bearer "
+        + jwt.encode(
+            utils.authorized_download_context_claims(
+                user_client.username, user_client.user_id
+            ),
+            key=rsa_private_key,
+            headers={"kid": kid},
+            algorithm="RS256",
+        ).decode("utf-8")
+    }
+    body = {"guids": ["1", {"guid": "2", "protocol": "gs"}], "protocol": "s3"}
+
+    with patch(
+        "fence.blueprints.data.indexd.get_index_documents", return_value=records
+    ) as mocked_bulk_lookup, patch.object(
+        app.arborist, "auth_request", return_value=True
+    ) as mocked_auth_request:
+        response = client.post("/data/download", headers=headers, json=body)
+
+    assert response.status_code == 200
+    mocked_bulk_lookup.assert_called_once()
+    assert mocked_auth_request.call_count == 1
+
+    results = response.json["results"]
+    assert [result["guid"] for result in results] == ["1", "2"]
+    assert urllib.parse.urlparse(results[0]["url"]).query != ""
+    # "2" has no `gs` location
+    assert "url" not in results[1]
+    assert results[1]["error"]["code"] == 404
+
+
+def test_bulk_download_files_unauthorized(
+    app,
+    client,
+    indexd_client_accepting_record,
+    mock_arborist_requests,
+    user_client,
+    rsa_private_key,
+    kid,
+):
+    """
+    Test that ``POST /data/download`` reports a per-file error for the files
+    the user doesn't have access to, and still signs the others.
+    """
+    indexd_client_accepting_record(INDEXD_RECORD_WITH_PUBLIC_AUTHZ_POPULATED)
+    mock_arborist_requests({"arborist/auth/request": {"POST": ({"auth": True}, 200)}})
+    records = {
+        "1": dict(INDEXD_RECORD_WITH_PUBLIC_AUTHZ_POPULATED, did="1", authz=["/a"]),
+        "2": dict(INDEXD_RECORD_WITH_PUBLIC_AUTHZ_POPULATED, did="2", authz=["/b"]),
+    }
+    headers = {
+        "Authorization": "Bearer "
+        + jwt.encode(
+            utils.authorized_download_context_claims(
+                user_client.username, user_client.user_id
+            ),
+            key=rsa_private_key,
+            headers={"kid": kid},
+            algorithm="RS256",
+        ).decode("utf-8")
+    }
+
+    def auth_request(jwt, service, methods, resources):
+        return resources == ["/a"]
+
+    with patch(
+        "fence.blueprints.data.indexd.get_index_documents", return_value=records
+    ), patch.object(app.arborist, "auth_request", side_effect=auth_request):
+        response = client.post(
+            "/data/download", headers=headers, json={"guids": ["1", "2"]}
+        )
+
+    assert response.status_code == 200
+    results = response.json["results"]
+    assert "url" in results[0]
+    assert results[1]["error"]["code"] == 401
+
+
+def test_bulk_download_files_too_many(client, monkeypatch):
+    """
+    Test that ``POST /data/download`` rejects requests over the configured size.
+    """
+    monkeypatch.setitem(config, "MAX_BULK_PRESIGNED_URL_REQUEST_SIZE", 2)
+    response = client.post("/data/download", json={"guids": ["1", "2", "3"]})
+    assert response.status_code == 400
+
+
+def test_indexd_record_cache(app, monkeypatch):
+    """
+    Test that with the indexd record cache enabled, repeated lookups of the same
+    GUID (including GUIDs indexd doesn't know about) only reach indexd once.
+    """
+    from fence.cache import TTLCache
+
+    monkeypatch.setattr(app, "indexd_record_cache", TTLCache(max_size=10, ttl=60))
+
+    found = MagicMock(status_code=200)
+    found.json.return_value = INDEXD_RECORD_WITH_PUBLIC_AUTHZ_POPULATED
+    not_found = MagicMock(status_code=404, text="not found")
+
+    def mocked_get(url, *args, **kwargs):
+        return found if url.endswith("/1") else not_found
+
+    with patch(
+        "fence.http_client.indexd.get", side_effect=mocked_get
+    ) as mocked_requests_get:
+        for _ in range(2):
+            record = fence.blueprints.data.indexd.IndexedFile("1").index_document
+            assert record == INDEXD_RECORD_WITH_PUBLIC_AUTHZ_POPULATED
+            with pytest.raises(fence.errors.NotFound):
+                fence.blueprints.data.indexd.IndexedFile("2").index_document
+
+    assert mocked_requests_get.call_count == 2
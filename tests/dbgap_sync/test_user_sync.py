@@ -1,13 +1,21 @@
 import os
 import pytest
+import subprocess
 import yaml
 
-from unittest.mock import MagicMock
+from stat import S_IFDIR, S_IFREG
+from unittest.mock import MagicMock, patch
+
+from gen3authz.client.arborist.errors import ArboristError
 
 from fence import models
-from fence.sync.sync_users import _format_policy_id
+from fence.sync.sync_users import (
+    _format_policy_id,
+    download_dir,
+    read_dbgap_telemetry_file,
+)
 from fence.config import config
-from tests.dbgap_sync.conftest import LOCAL_YAML_DIR
+from tests.dbgap_sync.conftest import LOCAL_CSV_DIR, LOCAL_YAML_DIR
 
 
 def equal_project_access(d1, d2):
@@ -321,6 +329,92 @@ def test_dbgap_consent_codes(
         assert resource_to_parent_paths["phs000179"] == ["/orgA/programs/"]
 
 
+@pytest.mark.parametrize("syncer", ["google"], indirect=True)
+def test_parse_csv_in_parallel(syncer, db_session, monkeypatch):
+    """
+    Parsing the dbGaP telemetry files in several processes should give the
+    same result as parsing them one by one.
+    """
+    file_list = sorted(
+        os.path.join(LOCAL_CSV_DIR, filename) for filename in os.listdir(LOCAL_CSV_DIR)
+    )
+    assert len(file_list) > 1
+
+    results = []
+    for dbgap_parse_workers in [1, 2]:
+        monkeypatch.setitem(
+            config, "USERSYNC", {"dbgap_parse_workers": dbgap_parse_workers}
+        )
+        results.append(
+            syncer._get_user_permissions_from_csv_list(
+                file_list,
+                encrypted=False,
+                session=db_session,
+                dbgap_config=syncer.dbGaP[0],
+            )
+        )
+    assert results[0] == results[1]
+    user_projects, user_info = results[0]
+    assert "USERC" in user_projects
+    assert user_info["USERC"]["tags"]["dbgap_role"]
+
+
+def test_read_dbgap_telemetry_file_decryption_failure():
+    """
+    If mcrypt fails after decrypting part of a file, reading the file should
+    raise an error instead of returning the rows read so far.
+    """
+    filepath = os.path.join(LOCAL_CSV_DIR, sorted(os.listdir(LOCAL_CSV_DIR))[0])
+    popen = subprocess.Popen
+
+    def failing_mcrypt(args, **kwargs):
+        # output the start of the file, then fail
+        return popen(["sh", "-c", "head -n 2; exit 1"], **kwargs)
+
+    with patch("fence.sync.sync_users._has_mcrypt", return_value=True), patch(
+        "fence.sync.sync_users.sp.Popen", side_effect=failing_mcrypt
+    ):
+        with pytest.raises(subprocess.CalledProcessError):
+            list(read_dbgap_telemetry_file(filepath, encrypted=True, key="key"))
+
+
+@pytest.mark.parametrize("syncer", ["google"], indirect=True)
+def test_sync_profiling(syncer, db_session, storage_client, monkeypatch):
+    monkeypatch.setitem(
+        config,
+        "USERSYNC",
+        {"profiling": True, "profiling_pushgateway": "pushgateway:9091"},
+    )
+    with patch.object(syncer.profiler, "push_to_gateway") as mocked_push:
+        syncer.sync()
+
+    summary = syncer.profiler.summary()
+    mocked_push.assert_called_once_with(summary, "pushgateway:9091", "usersync")
+    phases = summary["phases"]
+    for phase in [
+        "parse",
+        "merge",
+        "project initialization",
+        "sync to db and storage backend",
+        "db grant",
+        "arborist resources",
+        "arborist user policies",
+        "total",
+    ]:
+        assert phases[phase]["calls"] == 1
+    assert phases["parse"]["rows"] > 0
+    assert phases["merge"]["rows"] == phases["arborist user policies"]["rows"]
+    assert phases["sync to db and storage backend"]["db_queries"] > 0
+    assert phases["total"]["db_queries"] >= phases["parse"]["db_queries"]
+
+    # a second sync with the same syncer only reports its own phases
+    with patch.object(syncer.profiler, "push_to_gateway"):
+        syncer.sync()
+    phases = syncer.profiler.summary()["phases"]
+    assert phases["total"]["calls"] == 1
+    assert phases["arborist user policies"]["calls"] == 1
+
+
 @pytest.mark.parametrize("syncer", ["google", "cleversafe"], indirect=True)
 def test_sync_from_files(syncer, db_session, storage_client):
     sess = db_session
@@ -345,7 +439,11 @@ def test_sync_from_files(syncer, db_session, storage_client):
 
 
 @pytest.mark.parametrize("syncer", ["google", "cleversafe"], indirect=True)
-def test_sync_revoke(syncer, db_session, storage_client):
+@pytest.mark.parametrize("bulk_db_sync", [False, True])
+def test_sync_revoke(syncer, db_session, storage_client, bulk_db_sync, monkeypatch):
+    monkeypatch.setitem(
+        config, "USERSYNC", {"bulk_db_sync": bulk_db_sync, "db_chunk_size": 1}
+    )
     phsids = {
         "userA": {
             "phs000178": {"read", "read-storage"},
@@ -372,6 +470,172 @@ def test_sync_revoke(syncer, db_session, storage_client):
         raise AssertionError()
 
 
+@pytest.mark.parametrize("syncer", ["google", "cleversafe"], indirect=True)
+@pytest.mark.parametrize("bulk_db_sync", [False, True])
+def test_sync_update(syncer, db_session, storage_client, bulk_db_sync, monkeypatch):
+    monkeypatch.setitem(
+        config, "USERSYNC", {"bulk_db_sync": bulk_db_sync, "db_chunk_size": 1}
+    )
+    phsids = {
+        "userA": {
+            "phs000178": {"read", "read-storage"},
+            "phs000179": {"read", "read-storage", "write-storage"},
+        },
+        "userB": {"phs000179": {"read", "read-storage", "write-storage"}},
+    }
+    userinfo = {
+        "userA": {"email": "a@b", "tags": {}},
+        "userB": {"email": "a@b", "tags": {}},
+    }
+    phsids2 = {
+        "usera": {
+            "phs000178": {"read"},
+            "phs000179": {"read", "read-storage", "write-storage"},
+        },
+        "userB": {
+            "phs000178": {"read"},
+            "phs000179": {"read", "read-storage", "write-storage"},
+        },
+    }
+
+    syncer.sync_to_db_and_storage_backend(phsids, userinfo, db_session)
+    syncer.sync_to_db_and_storage_backend(phsids2, userinfo, db_session)
+
+    user_A = models.query_for_user(session=db_session, username="userA")
+    assert equal_project_access(
+        user_A.project_access,
+        {
+            "phs000178": ["read"],
+            "phs000179": ["read", "read-storage", "write-storage"],
+        },
+    )
+    user_B = models.query_for_user(session=db_session, username="userB")
+    assert equal_project_access(
+        user_B.project_access,
+        {
+            "phs000178": ["read"],
+            "phs000179": ["read", "read-storage", "write-storage"],
+        },
+    )
+
+
+@pytest.mark.parametrize("syncer", ["google"], indirect=True)
+@pytest.mark.parametrize("bulk_db_sync", [False, True])
+def test_sync_user_info(syncer, db_session, storage_client, bulk_db_sync, monkeypatch):
+    monkeypatch.setitem(config, "USERSYNC", {"bulk_db_sync": bulk_db_sync})
+    syncer.arborist_client.get_users.return_value.json = {
+        "users": [{"name": "TESTUSERB"}]
+    }
+    phsids = {"userA": {"phs000178": {"read"}}, "testuserb": {"phs000178": {"read"}}}
+    userinfo = {
+        "userA": {"email": "a@b", "tags": {"a": "1", "b": "2", "c": "3"}},
+        "testuserb": {"email": "b@b", "display_name": "B", "tags": {}},
+    }
+    syncer.sync_to_db_and_storage_backend(phsids, userinfo, db_session)
+
+    userinfo["userA"]["tags"] = {"b": "5", "d": "4"}
+    syncer.sync_to_db_and_storage_backend(phsids, userinfo, db_session)
+
+    user_A = models.query_for_user(session=db_session, username="userA")
+    assert {tag.key: tag.value for tag in user_A.tags} == {"b": "5", "d": "4"}
+    user_B = models.query_for_user(session=db_session, username="TESTUSERB")
+    assert user_B.username == "TESTUSERB"
+    assert user_B.email == "b@b"
+    assert user_B.display_name == "B"
+
+    if bulk_db_sync:
+        # only the users missing from arborist are created
+        assert syncer.arborist_client.create_user_if_not_exist.call_count == 2
+        for call in syncer.arborist_client.create_user_if_not_exist.call_args_list:
+            assert call[0] == ("userA",)
+
+
+@pytest.mark.parametrize("syncer", ["google", "cleversafe"], indirect=True)
+def test_sync_incremental(syncer, db_session, storage_client, monkeypatch):
+    """
+    With `USERSYNC.incremental_sync`, the sync should be skipped when the input
+    files did not change, and otherwise only the users whose access changed
+    since the last sync should be synced.
+    """
+    monkeypatch.setitem(config, "USERSYNC", {"incremental_sync": True})
+    syncer.sync()
+    snapshot = db_session.query(models.UserSyncSnapshot).one()
+    assert "userc" in snapshot.users
+    assert "userf" in snapshot.users
+
+    with patch.object(
+        syncer,
+        "sync_to_db_and_storage_backend",
+        wraps=syncer.sync_to_db_and_storage_backend,
+    ) as mocked_sync_to_db, patch.object(
+        syncer,
+        "_update_authz_in_arborist",
+        wraps=syncer._update_authz_in_arborist,
+    ) as mocked_update_arborist:
+        # nothing changed since the last sync
+        syncer.sync()
+        mocked_sync_to_db.assert_not_called()
+        mocked_update_arborist.assert_not_called()
+
+        # pretend USERC's access changed and that "removed_user" was removed
+        # from the input files since the last sync
+        users = dict(snapshot.users)
+        users["userc"] = {"projects": {}}
+        users["removed_user"] = {"projects": {"phs000178": ["read"]}}
+        snapshot.users = users
+        snapshot.fingerprint = "previous fingerprint"
+        db_session.commit()
+
+        syncer.sync()
+        mocked_sync_to_db.assert_called_once()
+        args, kwargs = mocked_sync_to_db.call_args
+        assert set(args[0]) == {"userc"}
+        assert kwargs["usernames"] == {"userc", "removed_user"}
+        args, kwargs = mocked_update_arborist.call_args
+        assert kwargs["usernames"] == {"userc", "removed_user"}
+
+        user = models.query_for_user(session=db_session, username="USERF")
+        assert user.project_access
+
+        # a full rebuild syncs all the users
+        mocked_sync_to_db.reset_mock()
+        syncer.full_rebuild = True
+        syncer.sync()
+        args, kwargs = mocked_sync_to_db.call_args
+        assert "userf" in args[0]
+        assert kwargs["usernames"] is None
+
+
+@pytest.mark.parametrize("syncer", ["google"], indirect=True)
+def test_sync_incremental_arborist_failure(
+    syncer, db_session, storage_client, monkeypatch
+):
+    """
+    With `USERSYNC.incremental_sync`, if the policies of a user cannot be
+    updated in arborist, the snapshot should not be saved so that the next
+    sync is not skipped and updates the user again.
+    """
+    monkeypatch.setitem(
+        config, "USERSYNC", {"incremental_sync": True, "arborist_retries": 0}
+    )
+    syncer.arborist_client.revoke_all_policies_for_user.side_effect = (
+        lambda username: None if username.lower() == "userc" else True
+    )
+    syncer.sync()
+    assert db_session.query(models.UserSyncSnapshot).count() == 0
+
+    syncer.arborist_client.revoke_all_policies_for_user.side_effect = None
+    syncer.arborist_client.revoke_all_policies_for_user.reset_mock()
+    syncer.sync()
+    revoked = {
+        args[0].lower()
+        for args, _ in syncer.arborist_client.revoke_all_policies_for_user.call_args_list
+    }
+    assert "userc" in revoked
+    snapshot = db_session.query(models.UserSyncSnapshot).one()
+    assert "userc" in snapshot.users
+
+
 @pytest.mark.parametrize("syncer", ["google", "cleversafe"], indirect=True)
 def test_sync_two_phsids_dict(syncer, db_session, storage_client):
 
@@ -576,6 +840,163 @@ def test_update_arborist(syncer, db_session):
         assert syncer.arborist_client.create_role.called_with(role)
 
 
+@pytest.mark.parametrize("syncer", ["google"], indirect=True)
+def test_update_arborist_bulk(syncer, db_session, monkeypatch):
+    """
+    Check that the policies of the users are created and granted with bulk
+    calls, and that failed calls are retried.
+    """
+    monkeypatch.setitem(
+        config,
+        "USERSYNC",
+        {"arborist_concurrency": 4, "arborist_retries": 2, "arborist_retry_backoff": 0},
+    )
+    user_projects = {
+        "userA": {"phs000001": {"read", "read-storage"}},
+        "userB": {"phs000001": {"read"}},
+        "userC": {},
+    }
+    # the first revoke fails with a server error and is retried
+    syncer.arborist_client.revoke_all_policies_for_user.side_effect = [
+        ArboristError("unavailable", 503),
+        True,
+        True,
+        True,
+    ]
+
+    assert syncer._update_authz_in_arborist(db_session, user_projects)
+
+    syncer.arborist_client.update_bulk_policy.assert_called_once()
+    (new_policies,), _ = syncer.arborist_client.update_bulk_policy.call_args
+    assert sorted(policy["id"] for policy in new_policies) == [
+        "phs000001-read",
+        "phs000001-read-storage",
+    ]
+    syncer.arborist_client.update_policy.assert_not_called()
+
+    assert syncer.arborist_client.create_user_if_not_exist.call_count == 3
+    assert syncer.arborist_client.revoke_all_policies_for_user.call_count == 4
+    grants = {
+        args[0]: sorted(args[1])
+        for args, _ in syncer.arborist_client.grant_bulk_user_policy.call_args_list
+    }
+    assert grants == {
+        "userA": ["phs000001-read", "phs000001-read-storage"],
+        "userB": ["phs000001-read"],
+    }
+    syncer.arborist_client.grant_user_policy.assert_not_called()
+
+
+@pytest.mark.parametrize("syncer", ["google"], indirect=True)
+def test_update_arborist_bulk_grant_fallback(syncer, db_session, monkeypatch):
+    """
+    When a bulk grant is rejected, for example because one of the policies
+    does not exist, the policies should be granted one by one right away
+    instead of retrying the bulk grant.
+    """
+    monkeypatch.setitem(
+        config, "USERSYNC", {"arborist_retries": 3, "arborist_retry_backoff": 1}
+    )
+    user_projects = {"userA": {"phs000001": {"read", "read-storage"}}}
+    syncer.arborist_client.grant_bulk_user_policy.return_value = None
+
+    with patch("fence.sync.sync_users.time.sleep") as mocked_sleep:
+        syncer._update_authz_in_arborist(db_session, user_projects)
+
+    mocked_sleep.assert_not_called()
+    syncer.arborist_client.grant_bulk_user_policy.assert_called_once()
+    grants = sorted(
+        args for args, _ in syncer.arborist_client.grant_user_policy.call_args_list
+    )
+    assert grants == [("userA", "phs000001-read"), ("userA", "phs000001-read-storage")]
+
+
+@pytest.mark.parametrize("syncer", ["google"], indirect=True)
+def test_update_arborist_diff(syncer, db_session, monkeypatch):
+    """
+    Check that only the user policies that changed are granted and revoked.
+    """
+    monkeypatch.setitem(config, "USERSYNC", {"arborist_diff_sync": True})
+    user_projects = {
+        "userA": {"phs000001": {"read", "read-storage"}},
+        "userB": {"phs000001": {"read"}},
+        "userC": {"phs000001": {"read"}},
+        "userD": {"phs000001": {"read"}},
+    }
+    syncer.arborist_client.get_users.return_value.json = {
+        "users": [
+            # unchanged
+            {
+                "name": "usera",
+                "policies": [
+                    {"policy": "phs000001-read"},
+                    {"policy": "phs000001-read-storage"},
+                ],
+            },
+            # one policy to revoke
+            {
+                "name": "userB",
+                "policies": [
+                    {"policy": "phs000001-read"},
+                    {"policy": "phs000001-read-storage"},
+                ],
+            },
+            # one policy to grant again without expiration
+            {
+                "name": "userC",
+                "policies": [{"policy": "phs000001-read", "expires_at": 1000}],
+            },
+            # not in the authorization sources anymore
+            {"name": "userE", "policies": [{"policy": "phs000001-read"}]},
+        ]
+    }
+
+    syncer._update_authz_in_arborist(db_session, user_projects)
+
+    syncer.arborist_client.revoke_all_policies_for_user.assert_not_called()
+    revokes = sorted(
+        args for args, _ in syncer.arborist_client.revoke_user_policy.call_args_list
+    )
+    assert revokes == [
+        ("userB", "phs000001-read-storage"),
+        # usernames from arborist only are lowercased
+        ("usere", "phs000001-read"),
+    ]
+    grants = {
+        args[0]: args[1]
+        for args, _ in syncer.arborist_client.grant_bulk_user_policy.call_args_list
+    }
+    assert grants == {"userC": ["phs000001-read"], "userD": ["phs000001-read"]}
+    # only the user that is not in arborist yet is created
+    syncer.arborist_client.create_user_if_not_exist.assert_called_once_with("userD")
+
+
+@pytest.mark.parametrize("syncer", ["google"], indirect=True)
+def test_sync_loads_arborist_users_once(
+    syncer, db_session, storage_client, monkeypatch
+):
+    """
+    The list of arborist users should be loaded once per sync, and used both
+    to create the missing users and to update the user policies.
+    """
+    monkeypatch.setitem(
+        config, "USERSYNC", {"bulk_db_sync": True, "arborist_diff_sync": True}
+    )
+    syncer.arborist_client.get_users.return_value.json = {
+        "users": [{"name": "USERB", "policies": [{"policy": "old-policy"}]}]
+    }
+
+    syncer.sync()
+
+    syncer.arborist_client.get_users.assert_called_once()
+    created = {
+        args[0].lower()
+        for args, _ in syncer.arborist_client.create_user_if_not_exist.call_args_list
+    }
+    assert created
+    assert "userb" not in created
+
+
 @pytest.mark.parametrize("syncer", ["google", "cleversafe"], indirect=True)
 def test_merge_dbgap_servers(syncer, monkeypatch, db_session):
     """
@@ -746,3 +1167,59 @@ def test_sync_in_login(
     user1 = models.query_for_user(session=db_session, username="USER_1")
     assert len(user1.project_access) == 0  # other users are not affected
     assert len(user.project_access) == 6
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_download_dir(tmpdir, max_workers):
+    """
+    Test that the files are downloaded, except the ones that did not change
+    since the last download.
+    """
+    remote_files = {
+        "./authentication_file_phs000001.txt.enc": (10, 1000),
+        "./authentication_file_phs000002.txt.enc": (20, 1000),
+        "./subdir/authentication_file_phs000003.txt.enc": (30, 1000),
+    }
+
+    def listdir_attr(remote_dir):
+        items = [
+            MagicMock(
+                filename=os.path.basename(remote_path),
+                st_mode=S_IFREG,
+                st_size=size,
+                st_mtime=mtime,
+            )
+            for remote_path, (size, mtime) in remote_files.items()
+            if os.path.dirname(remote_path) == remote_dir
+        ]
+        if remote_dir == ".":
+            items.append(MagicMock(filename="subdir", st_mode=S_IFDIR))
+        return items
+
+    def get(remote_path, local_path):
+        with open(local_path, "w") as f:
+            f.write("x" * remote_files[remote_path][0])
+
+    sftp = MagicMock()
+    sftp.listdir_attr.side_effect = listdir_attr
+    sftp.get.side_effect = get
+    local_dir = str(tmpdir)
+
+    with patch("paramiko.SFTPClient.from_transport", return_value=sftp):
+        download_dir(sftp, ".", local_dir, max_workers=max_workers)
+        assert sftp.get.call_count == 3
+        assert sorted(os.listdir(local_dir)) == [
+            ".download_manifest.json",
+            "authentication_file_phs000001.txt.enc",
+            "authentication_file_phs000002.txt.enc",
+            "subdir",
+        ]
+        assert os.listdir(os.path.join(local_dir, "subdir")) == [
+            "authentication_file_phs000003.txt.enc"
+        ]
+
+        # only the file that changed is downloaded again
+        remote_files["./authentication_file_phs000002.txt.enc"] = (20, 2000)
+        download_dir(sftp, ".", local_dir, max_workers=max_workers)
+        assert sftp.get.call_count == 4
+        assert sftp.get.call_args[0][0] == "./authentication_file_phs000002.txt.enc"
@@ -1,6 +1,9 @@
+import httplib2
 import pytest
+import threading
 import time
 
+from googleapiclient.errors import HttpError
 from unittest.mock import MagicMock, patch
 from sqlalchemy import or_
 
@@ -16,7 +19,10 @@ from fence.models import (
     ServiceAccountAccessPrivilege,
     ServiceAccountToGoogleBucketAccessGroup,
 )
+from fence.config import config
 from fence.resources.google.access_utils import (
+    bulk_remove_expired_from_google,
+    bulk_update_google_groups,
     is_valid_service_account_type,
     service_account_has_external_access,
     get_google_project_valid_users_and_service_accounts,
@@ -29,6 +35,101 @@ from fence.resources.google.access_utils import (
 )
 
 
+class FakeGoogleCloudManager(object):
+    """
+    In-memory Google groups, shared by all the instances.
+    """
+
+    groups = {}
+    calls = []
+    failures = []
+    instances = []
+    lock = threading.Lock()
+
+    def __init__(self, project_id):
+        self.is_open = False
+        with self.lock:
+            self.instances.append(self)
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _call(self, *call):
+        assert self.is_open
+        with self.lock:
+            self.calls.append(call)
+            if self.failures:
+                raise self.failures.pop(0)
+
+    def get_group_members(self, group_id):
+        self._call("get_group_members", group_id)
+        return [{"email": email} for email in sorted(self.groups[group_id])]
+
+    def add_member_to_group(self, member_email, group_id):
+        self._call("add_member_to_group", member_email, group_id)
+        with self.lock:
+            self.groups[group_id].add(member_email)
+
+    def remove_member_from_group(self, member_email, group_id):
+        self._call("remove_member_from_group", member_email, group_id)
+        with self.lock:
+            self.groups[group_id].discard(member_email)
+
+
+def google_http_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"")
+
+
+class DirectoryAPIGoogleCloudManager(GoogleCloudManager):
+    """
+    cirrus' GoogleCloudManager, with its retrying group methods calling the
+    mock directory API `admin_service` instead of Google.
+    """
+
+    admin_service = None
+
+    def __init__(self, project_id=None):
+        self.project_id = project_id
+        self._authed_session = False
+        self._open_count = 0
+
+    def __enter__(self):
+        self._authed_session = True
+        self._admin_service = self.admin_service
+        return self
+
+    def __exit__(self, *args):
+        self._authed_session = False
+
+
+@pytest.fixture(scope="function")
+def fake_google_cloud_manager(monkeypatch):
+    monkeypatch.setattr(FakeGoogleCloudManager, "groups", {})
+    monkeypatch.setattr(FakeGoogleCloudManager, "calls", [])
+    monkeypatch.setattr(FakeGoogleCloudManager, "failures", [])
+    monkeypatch.setattr(FakeGoogleCloudManager, "instances", [])
+    monkeypatch.setitem(
+        config,
+        "GOOGLE_BULK_UPDATES_SETTINGS",
+        {"max_workers": 4, "batch_size": 2},
+    )
+    with patch(
+        "fence.resources.google.access_utils.GoogleCloudManager",
+        FakeGoogleCloudManager,
+    ):
+        yield FakeGoogleCloudManager
+
+
 class MockResponse:
     def __init__(self, json_data, status_code):
         self.json_data = json_data
@@ -542,3 +643,115 @@ def test_whitelisted_service_accounts(
     assert "test@123" not in service_account_ids
     assert "test@456" not in service_account_ids
     assert "test@789" in service_account_ids
+
+
+def test_bulk_update_google_groups(fake_google_cloud_manager):
+    fake_google_cloud_manager.groups.update(
+        {
+            "group1@example.com": {"a", "b", "c"},
+            "group2@example.com": set(),
+            "group3@example.com": {"a"},
+        }
+    )
+    expected = {
+        "group1@example.com": ["b", "d", "e", "f"],
+        "group2@example.com": ["a", "b", "c"],
+        "group3@example.com": ["a"],
+    }
+
+    changes = bulk_update_google_groups(expected)
+
+    assert changes == {
+        "group1@example.com": {"add": ["d", "e", "f"], "remove": ["a", "c"]},
+        "group2@example.com": {"add": ["a", "b", "c"], "remove": []},
+        "group3@example.com": {"add": [], "remove": []},
+    }
+    for group, members in expected.items():
+        assert fake_google_cloud_manager.groups[group] == set(members)
+    # one call to list each group, and one call per change
+    assert len(fake_google_cloud_manager.calls) == 3 + 8
+    # the managers are closed at the end
+    assert fake_google_cloud_manager.instances
+    for gcm in fake_google_cloud_manager.instances:
+        assert not gcm.is_open
+
+
+def test_bulk_update_google_groups_dry_run(fake_google_cloud_manager):
+    fake_google_cloud_manager.groups["group1@example.com"] = {"a", "b"}
+
+    changes = bulk_update_google_groups(
+        {"group1@example.com": ["b", "c"]}, dry_run=True
+    )
+
+    assert changes == {"group1@example.com": {"add": ["c"], "remove": ["a"]}}
+    assert fake_google_cloud_manager.groups["group1@example.com"] == {"a", "b"}
+    assert all(
+        call[0] == "get_group_members" for call in fake_google_cloud_manager.calls
+    )
+
+
+def test_bulk_update_google_groups_retries(monkeypatch):
+    """
+    Calls that Google fails (5xx) should only be retried by cirrus, and the
+    errors cirrus gives up on should not be retried.
+    """
+    monkeypatch.setitem(
+        config, "GOOGLE_BULK_UPDATES_SETTINGS", {"max_workers": 1, "batch_size": 2}
+    )
+    admin_service = MagicMock()
+    members = admin_service.members.return_value
+    members.list.return_value.execute.return_value = {"members": [{"email": "a"}]}
+    members.insert.return_value.execute.side_effect = [google_http_error(503), {}]
+    monkeypatch.setattr(DirectoryAPIGoogleCloudManager, "admin_service", admin_service)
+
+    with patch(
+        "fence.resources.google.access_utils.GoogleCloudManager",
+        DirectoryAPIGoogleCloudManager,
+    ), patch("time.sleep") as mocked_sleep:
+        bulk_update_google_groups({"group1@example.com": ["a", "b"]})
+        # the failed insert is retried once
+        assert members.insert.return_value.execute.call_count == 2
+        assert mocked_sleep.call_count == 1
+
+        members.list.return_value.execute.side_effect = google_http_error(403)
+        list_calls = members.list.return_value.execute.call_count
+        with pytest.raises(HttpError):
+            bulk_update_google_groups({"group1@example.com": ["c"]})
+        assert members.list.return_value.execute.call_count == list_calls + 1
+
+
+def test_bulk_remove_expired_from_google(fake_google_cloud_manager, monkeypatch):
+    """
+    The records removed from Google should be deleted by chunks, and the
+    records that Google fails to remove should be kept.
+    """
+    monkeypatch.setitem(
+        config,
+        "GOOGLE_BULK_UPDATES_SETTINGS",
+        {"max_workers": 4, "db_chunk_size": 2},
+    )
+    members = ["sa{}@example.com".format(i) for i in range(5)]
+    fake_google_cloud_manager.groups["group1@example.com"] = set(members)
+    fake_google_cloud_manager.failures.append(google_http_error(403))
+    session = MagicMock()
+    records = [
+        (MagicMock(email=member), (member, "group1@example.com")) for member in members
+    ]
+
+    def remove_from_google(gcm, member_email, group_id):
+        gcm.remove_member_from_group(member_email, group_id)
+        return True
+
+    summary = bulk_remove_expired_from_google(
+        session, records, remove_from_google, "test"
+    )
+
+    assert summary == {"processed": 5, "deleted": 4, "failed": 1}
+    assert len(fake_google_cloud_manager.groups["group1@example.com"]) == 1
+    (remaining,) = fake_google_cloud_manager.groups["group1@example.com"]
+    deleted = [call[0][0].email for call in session.delete.call_args_list]
+    assert sorted(deleted + [remaining]) == members
+    # 2 chunks of 2 deletions, then the final commit
+    assert session.commit.call_count == 3
+    for gcm in fake_google_cloud_manager.instances:
+        assert not gcm.is_open
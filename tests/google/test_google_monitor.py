@@ -1,9 +1,16 @@
+from collections import Counter
+import threading
 from unittest.mock import MagicMock, patch
 
+import pytest
+
 import fence
+from fence.config import config
+from fence.resources.google.validity import ValidityInfo
 from fence.scripting.google_monitor import _get_users_without_access, validation_check
 
 from fence.models import (
+    GoogleMonitorProgress,
     User,
     UserServiceAccount,
     ServiceAccountAccessPrivilege,
@@ -161,6 +168,191 @@ def test_validation_check_multiple_diff_projects(
     _assert_access("3@example.com", db_session)
 
 
+class FakeGoogleAPI(object):
+    """
+    Simulated Google API recording the calls made by the Google monitor. Each
+    call advances the simulated clock by `latency` seconds.
+    """
+
+    def __init__(self, latency=1, barrier=None):
+        self.latency = latency
+        self.barrier = barrier
+        self.now = 1000
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def call(self, key, response):
+        with self.lock:
+            self.calls[key] += 1
+            self.now += self.latency
+        if self.barrier and key[1] == "get_project_info":
+            # the first call of each project waits for the other projects, so
+            # that it only returns if the projects are validated concurrently
+            self.barrier.wait(timeout=10)
+        return response
+
+    def google_cloud_manager(self, project_id):
+        api = self
+        policy = MagicMock(status_code=200)
+        policy.json.return_value = {}
+
+        class FakeGoogleCloudManager(object):
+            def __init__(self):
+                self.project_id = project_id
+
+            def open(self):
+                pass
+
+            def close(self):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def get_project_info(self):
+                return api.call(
+                    (project_id, "get_project_info"), {"projectNumber": "123"}
+                )
+
+            def get_project_membership(self, *args):
+                return api.call((project_id, "get_project_membership"), [])
+
+            def get_project_organization(self):
+                return api.call((project_id, "get_project_organization"), None)
+
+            def get_service_account_policy(self, account):
+                return api.call(("get_service_account_policy", account), policy)
+
+            def get_service_account_keys_info(self, account):
+                return api.call(("get_service_account_keys_info", account), [])
+
+            def get_service_account_type(self, account):
+                return api.call(
+                    ("get_service_account_type", account), "iam.gserviceaccount.com"
+                )
+
+        return FakeGoogleCloudManager()
+
+
+@pytest.fixture(scope="function")
+def google_monitor_setup(db_session, monkeypatch):
+    """
+    Register 2 service accounts in each of the 4 Google projects, and patch
+    the Google monitor to use the simulated Google API.
+    """
+    service_accounts = [
+        MagicMock(
+            email="sa-{}@project-{}.iam.gserviceaccount.com".format(i, project),
+            google_project_id="project-{}".format(project),
+        )
+        for project in range(4)
+        for i in range(2)
+    ]
+
+    def validate_project(google_project_id, db=None, google_cloud_manager=None):
+        # like `GoogleProjectValidity`, re-validate the project's service
+        # accounts with the project's cloud manager
+        google_cloud_manager.get_project_info()
+        google_cloud_manager.get_project_membership(google_project_id)
+        google_cloud_manager.get_project_organization()
+        for sa in service_accounts:
+            if sa.google_project_id == google_project_id:
+                google_cloud_manager.get_service_account_policy(sa.email)
+                google_cloud_manager.get_service_account_type(sa.email)
+        return ValidityInfo()
+
+    monkeypatch.setitem(
+        config, "ALLOWED_USER_SERVICE_ACCOUNT_DOMAINS", ["iam.gserviceaccount.com"]
+    )
+    patches = [
+        patch(
+            "fence.scripting.google_monitor.get_all_registered_service_accounts",
+            return_value=service_accounts,
+        ),
+        patch("fence.scripting.google_monitor.get_db_session", return_value=db_session),
+        patch(
+            "fence.scripting.google_monitor._is_valid_google_project", validate_project
+        ),
+        patch(
+            "fence.scripting.google_monitor.force_remove_service_account_from_access"
+        ),
+    ]
+    for p in patches:
+        p.start()
+    yield service_accounts
+    for p in patches:
+        p.stop()
+
+
+def test_validation_check_benchmark(google_monitor_setup, db_session, monkeypatch):
+    """
+    The Google projects should be validated concurrently, and each Google API
+    call should only be made once per validation check.
+    """
+    monkeypatch.setitem(config, "GOOGLE_MONITOR", {"max_workers": 4})
+    google_api = FakeGoogleAPI(barrier=threading.Barrier(4))
+
+    with patch(
+        "fence.scripting.google_monitor.GoogleCloudManager",
+        google_api.google_cloud_manager,
+    ):
+        validation_check(db="postgresql://fence_test_tmp")
+
+    assert not google_api.barrier.broken
+    # 3 calls per project and 3 calls per service account
+    assert len(google_api.calls) == 4 * 3 + 8 * 3
+    assert set(google_api.calls.values()) == {1}
+    assert db_session.query(GoogleMonitorProgress).count() == 4
+
+
+def test_validation_check_time_budget(google_monitor_setup, db_session, monkeypatch):
+    """
+    The Google projects that are not started within the time budget should be
+    skipped, and validated first by the next validation check.
+    """
+    monkeypatch.setitem(config, "GOOGLE_MONITOR", {"max_workers": 1, "time_budget": 5})
+    # a project takes 9 seconds to validate
+    google_api = FakeGoogleAPI(latency=1)
+
+    def run_validation_check():
+        google_api.calls.clear()
+        with patch(
+            "fence.scripting.google_monitor.GoogleCloudManager",
+            google_api.google_cloud_manager,
+        ), patch(
+            "fence.scripting.google_monitor.time", MagicMock(time=google_api.time)
+        ):
+            validation_check(db="postgresql://fence_test_tmp")
+        google_api.now += 1
+        return {key[0] for key in google_api.calls if key[0].startswith("project-")}
+
+    validated = []
+    for _ in range(3):
+        run_validation_check()
+        validated.append(
+            sorted(
+                progress.google_project_id
+                for progress in db_session.query(GoogleMonitorProgress)
+            )
+        )
+    assert validated == [
+        ["project-0"],
+        ["project-0", "project-1"],
+        ["project-0", "project-1", "project-2"],
+    ]
+
+    # the projects that were never validated, then the ones that were
+    # validated the longest time ago, are validated first
+    assert run_validation_check() == {"project-3"}
+    assert run_validation_check() == {"project-0"}
+
+
 def test_get_users_without_access_no_access(test_user, test_project):
     """
     Test function _get_users_without_access when user does not have access to project
@@ -0,0 +1,198 @@
+import authutils.errors
+import flask
+import jwt
+import pytest
+from unittest.mock import patch
+
+from fence.config import config
+from fence.jwt.blacklist import blacklist_token
+from fence.jwt.errors import JWTError
+import fence.jwt.validate
+from fence.jwt.validate import validate_jwt
+
+from tests import utils
+
+
+@pytest.fixture(scope="function")
+def count_signature_verifications():
+    verify_signature = jwt.api_jws.PyJWS._verify_signature
+    with patch(
+        "jwt.api_jws.PyJWS._verify_signature",
+        autospec=True,
+        side_effect=verify_signature,
+    ) as mocked_verify_signature:
+        yield mocked_verify_signature
+
+
+def end_request():
+    """
+    The app context is kept for the whole test: clear the request caches to
+    simulate a new request.
+    """
+    flask.g.pop("_verified_jwt_signatures", None)
+    flask.g.pop("_unverified_jwt_claims", None)
+
+
+def test_validate_jwt_verifies_signature_once(
+    app, kid, rsa_private_key, count_signature_verifications
+):
+    """
+    Validating the same token many times during a request should only
+    verify its signature once.
+    """
+    token = jwt.encode(
+        utils.default_claims(),
+        key=rsa_private_key,
+        headers={"kid": kid},
+        algorithm="RS256",
+    ).decode("utf-8")
+
+    for _ in range(3):
+        claims = validate_jwt(token, scope={"user"}, purpose="access")
+        assert claims["sub"] == "1234"
+    assert count_signature_verifications.call_count == 1
+
+
+def test_validate_request_authorization_header(app, kid, rsa_private_key):
+    """
+    The token should be read from the Authorization header like
+    ``authutils.token.validate.validate_request`` does, whatever the scheme.
+    """
+    token = jwt.encode(
+        utils.default_claims(),
+        key=rsa_private_key,
+        headers={"kid": kid},
+        algorithm="RS256",
+    ).decode("utf-8")
+
+    for header in ["Bearer " + token, "bearer " + token, "JWT " + token]:
+        with app.test_request_context(headers={"Authorization": header}):
+            claims = fence.jwt.validate.validate_request(scope={"user"})
+            assert claims["sub"] == "1234"
+
+    with app.test_request_context(headers={"Authorization": token}):
+        with pytest.raises(
+            authutils.errors.JWTError, match="could not parse authorization header"
+        ):
+            fence.jwt.validate.validate_request(scope={"user"})
+    with app.test_request_context():
+        with pytest.raises(
+            authutils.errors.JWTError, match="no authorization header provided"
+        ):
+            fence.jwt.validate.validate_request(scope={"user"})
+
+
+def test_validate_jwt_checks_claims_of_verified_token(
+    app, kid, rsa_private_key, count_signature_verifications
+):
+    """
+    Skipping the signature verification of an already verified token should
+    not skip the other checks.
+    """
+    token = jwt.encode(
+        utils.default_claims(),
+        key=rsa_private_key,
+        headers={"kid": kid},
+        algorithm="RS256",
+    ).decode("utf-8")
+
+    validate_jwt(token, scope={"user"}, purpose="access")
+    with pytest.raises(JWTError):
+        validate_jwt(token, scope={"admin"}, purpose="access")
+    with pytest.raises(JWTError):
+        validate_jwt(token, scope={"user"}, purpose="refresh")
+    assert count_signature_verifications.call_count == 1
+
+
+def test_validate_jwt_invalid_signature(
+    app, kid, rsa_private_key, count_signature_verifications
+):
+    """
+    A token with an invalid signature should be rejected every time.
+    """
+    tokens = [
+        jwt.encode(
+            utils.default_claims(),
+            key=rsa_private_key,
+            headers={"kid": kid},
+            algorithm="RS256",
+        ).decode("utf-8")
+        for _ in range(2)
+    ]
+    # payload of the second token (different `jti`) with the signature of
+    # the first one
+    header, _, signature = tokens[0].split(".")
+    _, payload, _ = tokens[1].split(".")
+    token = ".".join([header, payload, signature])
+
+    for _ in range(2):
+        with pytest.raises(JWTError):
+            validate_jwt(token, scope={"user"}, purpose="access")
+    assert count_signature_verifications.call_count == 2
+
+
+def test_verified_token_cache_across_requests(
+    app, kid, rsa_private_key, count_signature_verifications
+):
+    """
+    Validating the same token in several requests should only verify its
+    signature once.
+    """
+    token = jwt.encode(
+        utils.default_claims(),
+        key=rsa_private_key,
+        headers={"kid": kid},
+        algorithm="RS256",
+    ).decode("utf-8")
+
+    for _ in range(3):
+        end_request()
+        validate_jwt(token, scope={"user"}, purpose="access")
+    assert count_signature_verifications.call_count == 1
+
+
+def test_verified_token_cache_disabled(
+    app, kid, rsa_private_key, count_signature_verifications, monkeypatch
+):
+    """
+    When the verified token cache is disabled, the signature should be
+    verified in every request.
+    """
+    monkeypatch.setitem(config, "VERIFIED_TOKEN_CACHE", {"enabled": False})
+    token = jwt.encode(
+        utils.default_claims(),
+        key=rsa_private_key,
+        headers={"kid": kid},
+        algorithm="RS256",
+    ).decode("utf-8")
+
+    for _ in range(3):
+        end_request()
+        validate_jwt(token, scope={"user"}, purpose="access")
+    assert count_signature_verifications.call_count == 3
+
+
+def test_verified_token_cache_blacklisted_refresh_token(app, kid, rsa_private_key):
+    """
+    A cached refresh token should be rejected and evicted from the cache as
+    soon as it is blacklisted.
+    """
+    claims_refresh = utils.default_claims()
+    claims_refresh["pur"] = "refresh"
+    token = jwt.encode(
+        claims_refresh,
+        key=rsa_private_key,
+        headers={"kid": kid},
+        algorithm="RS256",
+    ).decode("utf-8")
+    token_hash = fence.jwt.validate._hash_token(token)
+
+    validate_jwt(token, scope=None, purpose="refresh")
+    assert token_hash in fence.jwt.validate._get_verified_token_cache()
+
+    blacklist_token(claims_refresh["jti"], claims_refresh["exp"])
+    assert token_hash not in fence.jwt.validate._get_verified_token_cache()
+
+    end_request()
+    with pytest.raises(JWTError):
+        validate_jwt(token, scope=None, purpose="refresh")
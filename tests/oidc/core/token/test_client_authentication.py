@@ -3,6 +3,14 @@ For the token request, if the client is confidential, it must authenticate to
 the token endpoint using its authentication method.
 """
 
+from unittest.mock import patch
+
+import bcrypt
+
+import fence.models
+from fence.config import config
+import tests.utils.oauth2
+
 
 def test_confidential_client_valid(oauth_test_client):
     """
@@ -28,3 +36,37 @@ def test_confidential_client_invalid(oauth_test_client, monkeypatch):
     assert token_response.status_code == 401, token_response.json
     assert "error" in token_response.json, token_response.json
     assert token_response.json["error"] == "invalid_client"
+
+
+def test_confidential_client_secret_benchmark(oauth_test_client, monkeypatch):
+    """
+    Test that the bcrypt hash of the client secret is only computed once for
+    a series of token requests, and that a wrong secret is still rejected.
+    """
+    monkeypatch.setitem(
+        config,
+        "VERIFIED_CLIENT_SECRET_CACHE",
+        {"enabled": True, "max_size": 10, "ttl": 300},
+    )
+    monkeypatch.setattr(fence.models, "_verified_client_secrets", None)
+    oauth_test_client.authorize(data={"confirm": "yes"})
+
+    with patch("fence.models.bcrypt.hashpw", wraps=bcrypt.hashpw) as hashpw:
+        refresh_token = oauth_test_client.token().response.json["refresh_token"]
+        for _ in range(10):
+            oauth_test_client.refresh(refresh_token=refresh_token)
+        # 11 token requests, each authenticating the client at least once
+        assert hashpw.call_count == 1
+
+        monkeypatch.setattr(
+            oauth_test_client,
+            "_auth_header",
+            tests.utils.oauth2.create_basic_header(
+                oauth_test_client.client_id, "wrong-secret"
+            ),
+        )
+        response = oauth_test_client.refresh(
+            refresh_token=refresh_token, do_asserts=False
+        ).response
+        assert response.status_code == 401, response.json
+        assert hashpw.call_count == 2
@@ -484,7 +484,7 @@ def test_delete_expired_service_accounts_with_one_fail_first(
 
 
 def test_delete_expired_service_accounts_with_one_fail_second(
-    cloud_manager, app, db_session
+    cloud_manager, app, db_session, monkeypatch
 ):
     """
     Test the case that there is a failure of removing service account from google group
@@ -493,6 +493,8 @@ def test_delete_expired_service_accounts_with_one_fail_second(
     import fence
 
     fence.settings = MagicMock()
+    # remove the service accounts one at a time, so that the second one fails
+    monkeypatch.setitem(config, "GOOGLE_BULK_UPDATES_SETTINGS", {"max_workers": 1})
     cloud_manager.return_value.__enter__.return_value.remove_member_from_group.side_effect = [
         {},
         HttpError(mock.Mock(status=403), bytes("Permission denied", "utf-8")),
@@ -29,6 +29,7 @@ from unittest.mock import ANY, MagicMock, patch
 import fence
 from fence.config import config
 from fence.blueprints.login import IDP_URL_MAP
+from fence.resources.audit.shipper import AuditLogShipper
 from fence.resources.audit.utils import _clean_authorization_request_url
 from tests import utils
 
@@ -128,7 +129,7 @@ def test_presigned_url_log(
     """
     mock_arborist_requests({"arborist/auth/request": {"POST": ({"auth": True}, 200)}})
     audit_service_mocker = mock.patch(
-        "fence.resources.audit.client.requests", new_callable=mock.Mock
+        "fence.http_client.audit_service", new_callable=mock.Mock
     )
     monkeypatch.setitem(config, "ENABLE_AUDIT_LOGS", {"presigned_url": True})
 
@@ -200,7 +201,7 @@ def test_presigned_url_log_acl(
     """
     mock_arborist_requests({"arborist/auth/request": {"POST": ({"auth": True}, 200)}})
     audit_service_mocker = mock.patch(
-        "fence.resources.audit.client.requests", new_callable=mock.Mock
+        "fence.http_client.audit_service", new_callable=mock.Mock
     )
     monkeypatch.setitem(config, "ENABLE_AUDIT_LOGS", {"presigned_url": True})
 
@@ -250,7 +251,7 @@ def test_presigned_url_log_public(client, public_indexd_client, monkeypatch):
     public data.
     """
     audit_service_mocker = mock.patch(
-        "fence.resources.audit.client.requests", new_callable=mock.Mock
+        "fence.http_client.audit_service", new_callable=mock.Mock
     )
     monkeypatch.setitem(config, "ENABLE_AUDIT_LOGS", {"presigned_url": True})
 
@@ -299,7 +300,7 @@ def test_presigned_url_log_disabled(
     """
     mock_arborist_requests({"arborist/auth/request": {"POST": ({"auth": True}, 200)}})
     audit_service_mocker = mock.patch(
-        "fence.resources.audit.client.requests", new_callable=mock.Mock
+        "fence.http_client.audit_service", new_callable=mock.Mock
     )
     monkeypatch.setitem(
         config, "ENABLE_AUDIT_LOGS", {"presigned_url": False, "login": True}
@@ -344,7 +345,7 @@ def test_presigned_url_log_unauthorized(client, indexd_client, db_session, monke
     If Fence does not return a presigned URL, no audit log should be created.
     """
     audit_service_mocker = mock.patch(
-        "fence.resources.audit.client.requests", new_callable=mock.Mock
+        "fence.http_client.audit_service", new_callable=mock.Mock
     )
     monkeypatch.setitem(config, "ENABLE_AUDIT_LOGS", {"presigned_url": True})
 
@@ -396,7 +397,7 @@ def test_login_log_login_endpoint(
     """
     mock_arborist_requests()
     audit_service_mocker = mock.patch(
-        "fence.resources.audit.client.requests", new_callable=mock.Mock
+        "fence.http_client.audit_service", new_callable=mock.Mock
     )
     monkeypatch.setitem(config, "ENABLE_AUDIT_LOGS", {"login": True})
 
@@ -615,3 +616,110 @@ def test_login_log_push_to_sqs(
     mocked_sqs.send_message.assert_called_once()
 
     get_user_id_patch.stop()
+
+
+##############################
+# Ship audit logs in batches #
+##############################
+
+
+def test_audit_log_shipper_batches():
+    """
+    Queued logs should be sent in batches of at most `batch_size`, and the
+    logs left in the queue should be sent when the shipper is stopped.
+    """
+    batches = []
+    shipper = AuditLogShipper(
+        lambda batch: batches.append(batch), batch_size=10, flush_interval=60
+    )
+    for i in range(25):
+        assert shipper.put("presigned_url", {"guid": i})
+    shipper.start()
+    shipper.stop()
+
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert [data["guid"] for batch in batches for _, data in batch] == list(range(25))
+
+
+def test_audit_log_shipper_flush_interval():
+    """
+    A partial batch should be sent once `flush_interval` is over, without
+    waiting for the batch to be full or for the shipper to stop.
+    """
+    sent = []
+    shipper = AuditLogShipper(
+        lambda batch: sent.extend(batch), batch_size=10, flush_interval=0.1
+    )
+    shipper.start()
+    shipper.put("login", {"username": "test"})
+    for _ in range(50):
+        if sent:
+            break
+        time.sleep(0.05)
+    assert sent == [("login", {"username": "test"})]
+    shipper.stop()
+
+
+def test_audit_log_shipper_queue_full():
+    """
+    When the queue is full, new logs should be dropped and counted.
+    """
+    dropped = MagicMock()
+    shipper = AuditLogShipper(lambda batch: None, max_queue_size=2)
+    shipper.metrics = {"audit_log_dropped": dropped}
+    assert shipper.put("login", {})
+    assert shipper.put("login", {})
+    assert not shipper.put("login", {})
+    dropped.labels.assert_called_once_with("queue_full")
+    dropped.labels.return_value.inc.assert_called_once_with(1)
+
+
+@pytest.mark.parametrize("indexd_client", ["s3_and_gs"], indirect=True)
+def test_presigned_url_log_shipped_in_background(
+    app, client, indexd_client, db_session, monkeypatch
+):
+    """
+    With background shipping enabled, the audit log should be queued during
+    the request and pushed to SQS in a batch.
+    """
+    monkeypatch.setitem(config, "ENABLE_AUDIT_LOGS", {"presigned_url": True})
+    monkeypatch.setitem(
+        config,
+        "AUDIT_LOG_SHIPPING",
+        {
+            "enabled": True,
+            "max_queue_size": 100,
+            "batch_size": 10,
+            "flush_interval": 60,
+            "queue_full_policy": "drop",
+            "block_timeout": 1,
+        },
+    )
+    # restore the original audit-service client after the test
+    monkeypatch.setattr(app, "audit_service_client", app.audit_service_client)
+    mocked_sqs = mock_audit_service_sqs(app)
+    mocked_sqs.send_message_batch.return_value = {"Successful": [], "Failed": []}
+
+    guid = "dg.hello/abc"
+    path = f"/data/download/{guid}"
+    response = client.get(path)
+    assert response.status_code == 401
+
+    # nothing is sent before the flush
+    mocked_sqs.send_message.assert_not_called()
+    app.audit_service_client.shipper.stop()
+
+    mocked_sqs.send_message_batch.assert_called_once()
+    entries = mocked_sqs.send_message_batch.call_args[1]["Entries"]
+    assert len(entries) == 1
+    assert json.loads(entries[0]["MessageBody"]) == {
+        "request_url": path,
+        "status_code": 401,
+        "username": "anonymous",
+        "sub": None,
+        "guid": guid,
+        "resource_paths": [],
+        "action": "download",
+        "protocol": "s3",
+        "category": "presigned_url",
+    }
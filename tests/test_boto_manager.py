@@ -0,0 +1,120 @@
+"""
+Tests for the cache of the boto3 clients built by `BotoManager` for
+non-default credentials.
+"""
+
+import threading
+from unittest.mock import MagicMock, patch
+
+from fence.resources.aws.boto_manager import BotoClientCache, BotoManager
+
+
+CREDS = {"aws_access_key_id": "KEY1", "aws_secret_access_key": "SECRET1"}
+OTHER_CREDS = {"aws_access_key_id": "KEY2", "aws_secret_access_key": "SECRET2"}
+ROTATED_CREDS = dict(CREDS, aws_secret_access_key="NEW")  # pragma: allowlist secret
+
+
+def test_presigned_url_benchmark():
+    """
+    Signing URLs with non-default credentials should build one client per
+    credentials instead of one client per call, and should not replace the
+    default client.
+    """
+    with patch("fence.resources.aws.boto_manager.client") as mocked_client:
+        boto = BotoManager({}, logger=MagicMock())
+        default_s3_client = boto.s3_client
+        # building the default clients
+        assert mocked_client.call_count == 2
+
+        for _ in range(100):
+            boto.presigned_url("bucket1", "key", 60, CREDS)
+            boto.presigned_url("bucket2", "key", 60, OTHER_CREDS)
+            boto.get_bucket_region("bucket1", CREDS)
+            boto.assume_role("role", 900, CREDS)
+
+    # 400 calls, 3 clients: s3 for each credentials, and sts
+    assert mocked_client.call_count == 2 + 3
+    assert boto.s3_client is default_s3_client
+    assert len(boto.clients) == 3
+
+
+def test_default_client():
+    with patch("fence.resources.aws.boto_manager.client") as mocked_client:
+        boto = BotoManager({}, logger=MagicMock())
+        boto.presigned_url("bucket1", "key", 60, {"region_name": "us-east-1"})
+        boto.assume_role("role", 900)
+
+    assert mocked_client.call_count == 2
+    assert len(boto.clients) == 0
+    assert boto.s3_client.generate_presigned_url.call_count == 1
+    assert boto.sts_client.assume_role.call_count == 1
+
+
+def test_client_cache_keys():
+    """
+    Clients should be cached by service and by credentials, including the
+    region and endpoint.
+    """
+    clients = BotoClientCache()
+    with patch("fence.resources.aws.boto_manager.client") as mocked_client:
+        mocked_client.side_effect = lambda *args, **kwargs: MagicMock()
+
+        s3_client = clients.get("s3", CREDS)
+        assert clients.get("s3", dict(CREDS)) is s3_client
+        assert clients.get("sts", CREDS) is not s3_client
+        assert clients.get("s3", dict(CREDS, region_name="us-west-2")) is not s3_client
+        assert (
+            clients.get("s3", dict(CREDS, endpoint_url="https://example.com"))
+            is not s3_client
+        )
+        assert clients.get("s3", ROTATED_CREDS) is not s3_client
+
+    assert mocked_client.call_count == 5
+
+
+def test_client_cache_eviction():
+    now = 1000
+    clients = BotoClientCache(max_size=2, ttl=3600, session_ttl=900, timer=lambda: now)
+    temporary_creds = dict(OTHER_CREDS, aws_session_token="TOKEN")
+    with patch("fence.resources.aws.boto_manager.client") as mocked_client:
+        mocked_client.side_effect = lambda *args, **kwargs: MagicMock()
+
+        clients.get("s3", CREDS)
+        clients.get("s3", temporary_creds)
+        assert mocked_client.call_count == 2
+
+        # the client built with temporary credentials expires first
+        now += 901
+        clients.get("s3", CREDS)
+        clients.get("s3", temporary_creds)
+        assert mocked_client.call_count == 3
+
+        # the least recently used client is evicted
+        clients.get("s3", dict(CREDS, region_name="us-west-2"))
+        clients.get("s3", CREDS)
+        assert mocked_client.call_count == 5
+        assert len(clients) == 2
+
+
+def test_client_cache_threads():
+    """
+    Concurrent calls with the same credentials should share one client.
+    """
+    clients = BotoClientCache()
+    barrier = threading.Barrier(8)
+    results = []
+
+    def get_client():
+        barrier.wait()
+        results.append(clients.get("s3", CREDS))
+
+    with patch("fence.resources.aws.boto_manager.client") as mocked_client:
+        mocked_client.side_effect = lambda *args, **kwargs: MagicMock()
+        threads = [threading.Thread(target=get_client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert mocked_client.call_count == 1
+    assert len(set(map(id, results))) == 1
@@ -0,0 +1,121 @@
+"""
+Tests for the process-wide caches in `fence.cache`.
+"""
+
+import json
+
+from cryptography.fernet import Fernet
+import pytest
+
+from fence import cache as fence_cache
+from fence.cache import MISSING, TTLCache, make_cache
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expiration():
+    timer = FakeTimer()
+    cache = TTLCache(max_size=10, ttl=60, timer=timer)
+    cache.set("a", {"did": "a"})
+    cache.set("b", {"did": "b"}, ttl=120)
+
+    timer.now += 59
+    assert cache.get("a") == {"did": "a"}
+
+    timer.now += 1
+    assert cache.get("a") is MISSING
+    assert cache.get("a", None) is None
+    assert cache.get("b") == {"did": "b"}
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # "a" is now the most recently used entry
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+
+
+def test_ttl_cache_stores_none():
+    """
+    `None` is a valid value (used for negative caching) and is not a miss.
+    """
+    cache = TTLCache()
+    cache.set("not-found", None)
+    assert "not-found" in cache
+    assert cache.get("not-found") is None
+
+    cache.delete("not-found")
+    assert cache.get("not-found") is MISSING
+
+
+class FakeRedis(object):
+    """
+    In-memory stand-in for the `redis` module and client.
+    """
+
+    class RedisError(Exception):
+        pass
+
+    class Redis(object):
+        @classmethod
+        def from_url(cls, url):
+            return FakeRedis()
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+
+def test_redis_cache_encryption(monkeypatch):
+    """
+    With an encryption key, the values stored in Redis are not readable in
+    clear, and entries that cannot be decrypted are cache misses.
+    """
+    monkeypatch.setattr(fence_cache, "redis", FakeRedis)
+    cache_config = {"redis_url": "redis://localhost:6379/0", "ttl": 60}
+    cache = make_cache(
+        cache_config, prefix="test", encryption_key=Fernet.generate_key().decode()
+    )
+    credentials = {"aws_secret_access_key": "secret"}  # pragma: allowlist secret
+    cache.set("role", credentials)
+
+    stored = cache._redis.data["test:role"]
+    assert b"secret" not in stored
+    assert cache.get("role") == credentials
+
+    cache._redis.data["test:role"] = json.dumps(credentials).encode()
+    assert cache.get("role") is MISSING
+
+
+def test_redis_cache_empty_encryption_key(monkeypatch):
+    """
+    A Redis cache that should be encrypted cannot be created with an empty
+    key, instead of storing the values in clear. An in-memory cache does not
+    need a key.
+    """
+    monkeypatch.setattr(fence_cache, "redis", FakeRedis)
+    cache_config = {"redis_url": "redis://localhost:6379/0", "ttl": 60}
+    with pytest.raises(Exception, match="encryption key is empty"):
+        make_cache(cache_config, prefix="test", encryption_key="")
+
+    assert isinstance(
+        make_cache({"ttl": 60}, prefix="test", encryption_key=""), TTLCache
+    )
@@ -0,0 +1,58 @@
+"""
+Tests for the shared HTTP clients in `fence.http_client`.
+"""
+
+from unittest.mock import patch
+
+from gen3authz.client.arborist.client import ArboristClient
+import httpx
+
+from fence.config import config
+from fence.http_client import PooledHTTPClient, pool_arborist_connections
+
+
+def test_pooled_http_client_reuses_session(app):
+    """
+    Test that all the calls made by a client go through the same session, with
+    the configured timeouts unless the caller sets one.
+    """
+    client = PooledHTTPClient("test")
+    with patch("requests.Session.request") as mocked_request:
+        client.get("https://example.com/a")
+        session = client.session
+        client.post("https://example.com/b", json={}, timeout=1)
+        assert client.session is session
+
+    timeout = (
+        config["OUTBOUND_HTTP"]["connect_timeout"],
+        config["OUTBOUND_HTTP"]["read_timeout"],
+    )
+    mocked_request.assert_any_call("GET", "https://example.com/a", timeout=timeout)
+    mocked_request.assert_any_call("POST", "https://example.com/b", json={}, timeout=1)
+
+    adapter = session.get_adapter("https://example.com")
+    assert adapter._pool_maxsize == config["OUTBOUND_HTTP"]["pool_maxsize"]
+    client.close()
+
+
+def test_pooled_arborist_client_reuses_client():
+    """
+    Test that successive Arborist calls go through the same ``httpx`` client,
+    which is not opened again for each call.
+    """
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        return httpx.Response(200, json={"policy_ids": []})
+
+    arborist = pool_arborist_connections(
+        ArboristClient(arborist_base_url="http://arborist-service")
+    )
+    shared_client = arborist.client_cls()
+    shared_client._transport = httpx.MockTransport(handler)
+
+    assert arborist.list_policies() == {"policy_ids": []}
+    assert arborist.list_policies() == {"policy_ids": []}
+    assert arborist.client_cls() is shared_client
+    assert paths == ["/policy/", "/policy/"]
@@ -0,0 +1,184 @@
+"""
+Tests for the resolution of S3 bucket names to their `S3_BUCKETS`
+configuration, and for the cache of the bucket regions.
+"""
+
+import re
+from unittest.mock import MagicMock, patch
+
+from fence.resources.aws.bucket_regions import S3BucketRegions
+from fence.resources.aws.s3_buckets import (
+    S3BucketIndex,
+    UNCONFIGURED_BUCKET,
+    get_s3_bucket_index,
+)
+
+
+S3_BUCKETS = {
+    "bucket1": {"cred": "CRED1"},
+    "bucket2": {"cred": "CRED1", "endpoint_url": "https://cleversafe.example.com/"},
+    "bucket.with.dots": {"cred": "CRED1", "region": "us-east-1"},
+    "project-.*": {"cred": "CRED2", "region": "us-west-2"},
+    "project-a.*": {"cred": "CRED1"},
+    "env-(prod|staging)": {"cred": "CRED2"},
+}
+
+
+def test_resolve_exact_bucket_name():
+    index = S3BucketIndex(S3_BUCKETS)
+
+    bucket = index.resolve("bucket2")
+    assert bucket.name == "bucket2"
+    assert bucket.config is S3_BUCKETS["bucket2"]
+    assert bucket.endpoint_url == "https://cleversafe.example.com/"
+    assert bucket.region is None
+
+    assert index.resolve("bucket.with.dots").region == "us-east-1"
+
+
+def test_resolve_bucket_pattern():
+    """
+    Patterns should match whole bucket names, and the first matching pattern
+    in `S3_BUCKETS` should win.
+    """
+    index = S3BucketIndex(S3_BUCKETS)
+
+    assert index.resolve("project-xyz").name == "project-.*"
+    assert index.resolve("project-abc").name == "project-.*"
+    assert index.resolve("project-abc").region == "us-west-2"
+    assert index.resolve("env-staging").name == "env-(prod|staging)"
+    # "." in a bucket name is a regular expression
+    assert index.resolve("bucketXwithXdots").name == "bucket.with.dots"
+
+    assert index.resolve("bucket10") == UNCONFIGURED_BUCKET
+    assert index.resolve("my-project-xyz") == UNCONFIGURED_BUCKET
+    assert index.resolve("env-dev") == UNCONFIGURED_BUCKET
+
+
+def test_resolve_patterns_that_cannot_be_combined():
+    """
+    Patterns defining the same group names cannot be combined in a single
+    regular expression, but should still be matched.
+    """
+    s3_buckets = {
+        "(?P<env>prod)-data": {"cred": "CRED1"},
+        "(?P<env>dev)-data": {"cred": "CRED2"},
+    }
+    index = S3BucketIndex(s3_buckets)
+    assert index.resolve("dev-data").name == "(?P<env>dev)-data"
+    assert index.resolve("test-data") == UNCONFIGURED_BUCKET
+
+
+def test_bucket_index_rebuilt_on_config_change():
+    s3_buckets = dict(S3_BUCKETS)
+    index = get_s3_bucket_index(s3_buckets)
+    assert get_s3_bucket_index(s3_buckets) is index
+
+    s3_buckets = dict(S3_BUCKETS, bucket3={"cred": "CRED1"})
+    new_index = get_s3_bucket_index(s3_buckets)
+    assert new_index is not index
+    assert new_index.resolve("bucket3").name == "bucket3"
+
+
+def test_get_bucket_index_benchmark():
+    """
+    Getting the index of an unchanged configuration should not go through the
+    configured buckets.
+    """
+
+    class S3Buckets(dict):
+        iterations = 0
+
+        def __iter__(self):
+            S3Buckets.iterations += 1
+            return super(S3Buckets, self).__iter__()
+
+    s3_buckets = S3Buckets(
+        ("bucket-{}".format(i), {"cred": "CRED1"}) for i in range(1000)
+    )
+    index = get_s3_bucket_index(s3_buckets)
+    iterations = S3Buckets.iterations
+    for _ in range(100):
+        assert get_s3_bucket_index(s3_buckets) is index
+    assert S3Buckets.iterations == iterations
+
+
+def test_resolve_bucket_benchmark():
+    """
+    With 1000 configured buckets, resolving a bucket name should not try the
+    patterns one by one, and repeated resolutions should be memoized.
+    """
+    s3_buckets = {}
+    for i in range(500):
+        s3_buckets["bucket-{}".format(i)] = {"cred": "CRED1"}
+        s3_buckets["project-{}-.*".format(i)] = {"cred": "CRED2"}
+    index = S3BucketIndex(s3_buckets)
+    bucket_names = ["bucket-{}".format(i) for i in range(0, 500, 10)] + [
+        "project-{}-data".format(i) for i in range(0, 500, 10)
+    ]
+
+    with patch("re.match", side_effect=re.match) as mocked_match, patch(
+        "re.fullmatch", side_effect=re.fullmatch
+    ) as mocked_fullmatch:
+        for _ in range(10):
+            for bucket_name in bucket_names:
+                assert index.resolve(bucket_name).name is not None
+
+    # the patterns are compiled into a single expression...
+    assert len(index._patterns) == 1
+    # ...and no pattern is compiled or matched at request time
+    assert mocked_match.call_count == 0
+    assert mocked_fullmatch.call_count == 0
+    cache_info = index.resolve.cache_info()
+    assert cache_info.misses == len(bucket_names)
+    assert cache_info.hits == 9 * len(bucket_names)
+
+
+def test_bucket_region_cache():
+    now = 1000
+    bucket_regions = S3BucketRegions(ttl=60, timer=lambda: now)
+    boto = MagicMock()
+    boto.get_bucket_region.return_value = "us-west-2"
+
+    for _ in range(3):
+        assert bucket_regions.get_region("bucket1", {"cred": 1}, boto) == "us-west-2"
+    boto.get_bucket_region.assert_called_once_with("bucket1", {"cred": 1})
+
+    bucket_regions.get_region("bucket2", {"cred": 1}, boto)
+    assert boto.get_bucket_region.call_count == 2
+
+    # the cached region expires after `ttl` seconds
+    now += 61
+    bucket_regions.get_region("bucket1", {"cred": 1}, boto)
+    assert boto.get_bucket_region.call_count == 3
+
+
+def test_bucket_region_cache_db(db_session):
+    """
+    Regions cached in the database should be shared between caches, until
+    they expire.
+    """
+    now = 1000
+    db = MagicMock()
+    db.session.__enter__.return_value = db_session
+    boto = MagicMock()
+    boto.get_bucket_region.return_value = "us-west-2"
+
+    S3BucketRegions(ttl=60, timer=lambda: now).get_region(
+        "bucket-region-cache", {}, boto, db=db
+    )
+    assert boto.get_bucket_region.call_count == 1
+
+    assert (
+        S3BucketRegions(ttl=60, timer=lambda: now).get_region(
+            "bucket-region-cache", {}, boto, db=db
+        )
+        == "us-west-2"
+    )
+    assert boto.get_bucket_region.call_count == 1
+
+    now += 61
+    S3BucketRegions(ttl=60, timer=lambda: now).get_region(
+        "bucket-region-cache", {}, boto, db=db
+    )
+    assert boto.get_bucket_region.call_count == 2